@@ -1,9 +1,18 @@
+import argparse
 import os
 import requests
 from dotenv import load_dotenv
-from openai import OpenAI
-import json
 import logging
+from collections import Counter
+
+from airtable_client import AirtableTable, BatchWriter
+from airtable_mirror import select
+from instrumentation import add_metrics_arguments, report_stages
+from latex_utils import CLEAN, FIXABLE, NEEDS_MODEL, classify_latex
+from llm_cache import cache_summary
+from model_backends import BackendError, get_backend
+from record_packing import PACKED_MAX_TOKENS, add_packing_arguments, build_packed_prompt, clean_in_packs
+from usage_ledger import add_budget_arguments, budget_exhausted, configure_ledger, usage_summary, write_usage_report
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -11,12 +20,11 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 # Load environment variables from .env file
 load_dotenv()
 
-# Initialize OpenAI client
-openai_api_key = os.getenv("OPENAI_API_KEY")
-if not openai_api_key:
+# Initialize the shared OpenAI backend
+if not os.getenv("OPENAI_API_KEY"):
     logging.error("OPENAI_API_KEY not found in .env file.")
     exit(1)
-client = OpenAI(api_key=openai_api_key)
+gpt = get_backend("openai", "gpt-4o")
 
 # Airtable configuration from .env
 BASE_ID = os.getenv("BASE_ID")
@@ -28,114 +36,135 @@ if not all([BASE_ID, AIRTABLE_API_KEY, AIRTABLE_TABLE_ID]):
     logging.error("Missing required Airtable variables in .env file.")
     exit(1)
 
-# Construct the base URL using the base ID and table ID
-BASE_URL = f"https://api.airtable.com/v0/{BASE_ID}/{AIRTABLE_TABLE_ID}"
-
-# Headers for Airtable API
-HEADERS = {
-    "Authorization": f"Bearer {AIRTABLE_API_KEY}",
-    "Content-Type": "application/json"
-}
+# Shared, rate-limited Airtable client for the CopyCats table
+copycats_table = AirtableTable(BASE_ID, AIRTABLE_TABLE_ID, AIRTABLE_API_KEY)
 
 def fetch_records_by_model(model_name="GPT-4o"):
-    """Fetch records from CopyCats table where AI Model is the specified model"""
-    params = {
-        "filterByFormula": f"AND({{AI Model}} = '{model_name}', NOT({{Corrected Clone Question LM}} != ''))",
-        "fields": ["Clone Question LM", "Original Question", "AI Model"]
-    }
-    try:
-        response = requests.get(BASE_URL, headers=HEADERS, params=params)
-        response.raise_for_status()
-        records = response.json().get("records", [])
-        logging.info(f"Fetched {len(records)} records for model {model_name}")
-        return records
-    except requests.exceptions.HTTPError as e:
-        logging.error(f"Failed to fetch records: {e} - Response: {response.text}")
-        return []
+    """Stream records from CopyCats table where AI Model is the specified model, page by page"""
+    formula = f"AND({{AI Model}} = '{model_name}', NOT({{Corrected Clone Question LM}} != ''))"
+    return select(copycats_table, formula=formula,
+                  where=lambda f: f.get("AI Model") == model_name and not f.get("Corrected Clone Question LM"),
+                  fields=["Clone Question LM", "Original Question", "AI Model"])
+
+SYSTEM_PROMPT = "You are a LaTeX and Markdown formatting expert."
+INSTRUCTIONS = (
+    "You are an expert in Markdown and LaTeX formatting for MathJax. "
+    "Clean up the following text to ensure it uses proper Markdown and LaTeX syntax "
+    "for MathJax display. Requirements:\n"
+    "1. Enclose inline math in \\(...\\) and block math in \\[...\\]\n"
+    "2. Ensure proper spacing around math delimiters\n"
+    "3. Fix any broken LaTeX commands or syntax\n"
+    "4. Preserve non-mathematical text formatting\n"
+    "5. Remove any unnecessary line breaks or spaces"
+)
 
 def clean_text_with_gpt(text):
     """Clean and format text using GPT-4o"""
     if not text or text.strip() == "":
         return text
 
-    prompt = (
-        "You are an expert in Markdown and LaTeX formatting for MathJax. "
-        "Clean up the following text to ensure it uses proper Markdown and LaTeX syntax "
-        "for MathJax display. Requirements:\n"
-        "1. Enclose inline math in $...$ and block math in $$...$$\n"
-        "2. Ensure proper spacing around math delimiters\n"
-        "3. Fix any broken LaTeX commands or syntax\n"
-        "4. Preserve non-mathematical text formatting\n"
-        "5. Remove any unnecessary line breaks or spaces\n\n"
-        f"Text to clean:\n{text}"
-    )
+    prompt = f"{INSTRUCTIONS}\n\nText to clean:\n{text}"
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": "You are a LaTeX and Markdown formatting expert."},
-                {"role": "user", "content": prompt}
-            ],
+        completion = gpt.complete(
+            prompt,
+            system=SYSTEM_PROMPT,
             max_tokens=1000,
             temperature=0.2
         )
-        return response.choices[0].message.content.strip()
-    except Exception as e:
+        return completion.text.strip()
+    except BackendError as e:
         logging.error(f"Error cleaning text with GPT: {e}")
         return text
 
-def update_record(record_id, cleaned_question):
-    """Update a record with cleaned question text"""
-    data = {
-        "fields": {
-            "Corrected Clone Question LM": cleaned_question
-        }
-    }
+def clean_texts_with_gpt(texts, validate=None):
+    """Send several texts to GPT-4o in one packed request; returns the raw response ("" on failure)."""
     try:
-        response = requests.patch(f"{BASE_URL}/{record_id}", headers=HEADERS, data=json.dumps(data))
-        response.raise_for_status()
-        logging.info(f"Updated record {record_id} successfully")
-        return True
-    except requests.exceptions.HTTPError as e:
-        logging.error(f"Failed to update record {record_id}: {e} - Response: {response.text}")
-        return False
+        return gpt.complete(build_packed_prompt(INSTRUCTIONS, texts), system=SYSTEM_PROMPT,
+                            max_tokens=PACKED_MAX_TOKENS, temperature=0.2, validate=validate).text
+    except BackendError as e:
+        logging.error(f"Error cleaning {len(texts)} packed texts with GPT: {e}")
+        return ""
 
 def main():
+    parser = argparse.ArgumentParser(description="Clean the LaTeX in GPT-4o CopyCat questions")
+    add_budget_arguments(parser)
+    add_packing_arguments(parser)
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    configure_ledger(table="CopyCats", max_cost=args.max_cost, max_tokens=args.max_tokens)
+
     logging.info("Starting cleanup of GPT-4o generated questions...")
 
     # Test API connectivity
     try:
-        test_response = requests.get(BASE_URL, headers=HEADERS)
-        test_response.raise_for_status()
+        copycats_table.first()
         logging.info("Successfully connected to Airtable API")
     except requests.exceptions.HTTPError as e:
         logging.error(f"API connectivity test failed: {e}")
         return
 
-    # Fetch and process records
-    records = fetch_records_by_model("GPT-4o")
-    if not records:
-        logging.info("No records to process or fetch failed")
-        return
-
-    success_count = 0
-    total_records = len(records)
-
-    for i, record in enumerate(records, 1):
-        record_id = record["id"]
-        fields = record.get("fields", {})
-        original_question = fields.get("Original Question", [""])[0]  # Get first item if it's a list
-        clone_question = fields.get("Clone Question LM", "")
+    def report_update(record_id, record):
+        logging.info(f"Updated record {record_id} successfully")
 
-        logging.info(f"Processing record {i}/{total_records} (ID: {record_id})")
-        logging.info(f"Original Question reference: {original_question}")
+    # Records are processed as each page arrives; updates are sent 10 at a time
+    writer = BatchWriter(BASE_ID, AIRTABLE_TABLE_ID, AIRTABLE_API_KEY, on_written=report_update)
+    total_records = 0
+    prefilter_counts = Counter()
+    over_budget = 0
+    packable = []  # With --pack, (record ID, clone question) pairs cleaned after the scan
 
-        cleaned_question = clean_text_with_gpt(clone_question)
-        if update_record(record_id, cleaned_question):
-            success_count += 1
+    try:
+        for i, record in enumerate(fetch_records_by_model("GPT-4o"), 1):
+            total_records = i
+            record_id = record["id"]
+            fields = record.get("fields", {})
+            original_question = fields.get("Original Question", [""])[0]  # Get first item if it's a list
+            clone_question = fields.get("Clone Question LM", "")
+
+            logging.info(f"Processing record {i} (ID: {record_id})")
+            logging.info(f"Original Question reference: {original_question}")
+
+            # Clone questions that are already clean or fixable locally skip GPT-4o
+            category, cleaned_question = classify_latex(clone_question)
+            prefilter_counts[category] += 1
+            if category == NEEDS_MODEL:
+                if budget_exhausted():
+                    over_budget += 1  # Left uncorrected so the next run picks it up
+                    continue
+                if args.pack:
+                    packable.append((record_id, clone_question))
+                    continue
+                cleaned_question = clean_text_with_gpt(clone_question)
+            writer.update(record_id, {"Corrected Clone Question LM": cleaned_question})
+    except requests.exceptions.HTTPError as e:
+        logging.error(f"Failed to fetch records: {e} - Response: {e.response.text}")
+
+    if packable:
+        logging.info(f"Cleaning {len(packable)} clone questions in packed GPT-4o requests...")
+        cleaned_count = 0
+        for (record_id, _), cleaned_question in clean_in_packs(packable, lambda item: item[1], clean_texts_with_gpt,
+                                                                clean_text_with_gpt, args.pack_tokens,
+                                                                stop=budget_exhausted):
+            writer.update(record_id, {"Corrected Clone Question LM": cleaned_question})
+            cleaned_count += 1
+        over_budget += len(packable) - cleaned_count
+    writer.flush()
+
+    if not total_records:
+        logging.info("No records to process or fetch failed")
+        return
 
-    logging.info(f"Cleanup completed. Successfully processed {success_count}/{total_records} records")
+    logging.info(f"Cleanup completed. Successfully processed {writer.written}/{total_records} records")
+    logging.info(f"Pre-filter: {prefilter_counts[CLEAN]} already clean, {prefilter_counts[FIXABLE]} fixed locally, "
+                 f"{prefilter_counts[NEEDS_MODEL]} sent to GPT-4o")
+    if over_budget:
+        logging.info(f"Budget reached: {over_budget} questions that need GPT-4o were left for a later run")
+    if cache_summary():
+        logging.info(cache_summary())
+    logging.info(usage_summary())
+    logging.info(f"Usage report: {write_usage_report()}")
+    report_stages(args.metrics_json, log=logging.info)
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
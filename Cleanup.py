@@ -1,15 +1,21 @@
+import argparse
+import functools
 import os
-import requests
-import json
+from collections import Counter
 import logging
-import time
 from dotenv import load_dotenv
 
-load_dotenv()  # Ensure .env file is loaded
+from airtable_client import AirtableTable, BatchWriter
+from airtable_mirror import select
+from checkpoints import CheckpointJournal, journal_path
+from instrumentation import add_metrics_arguments, report_stages
+from latex_utils import CLEAN, FIXABLE, NEEDS_MODEL, classify_latex
+from llm_cache import cache_summary
+from model_backends import BackendError, get_backend
+from record_packing import PACKED_MAX_TOKENS, add_packing_arguments, build_packed_prompt, clean_in_packs
+from usage_ledger import add_budget_arguments, budget_exhausted, configure_ledger, usage_summary, write_usage_report
 
-# Load API keys from environment variables
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY")
+load_dotenv()  # Ensure .env file is loaded
 
 # Airtable configuration
 BASE_ID = "apph1PxO7uc4r7U6j"
@@ -24,158 +30,316 @@ if not AIRTABLE_API_KEY:
     logging.error("Missing required Airtable API key in .env file.")
     exit(1)
 
-# Construct the base URL
-BASE_URL = f"https://api.airtable.com/v0/{BASE_ID}/{TABLE_NAME}"
-
-# Headers for Airtable API
-HEADERS = {
-    "Authorization": f"Bearer {AIRTABLE_API_KEY}",
-    "Content-Type": "application/json"
-}
+# Shared, rate-limited Airtable client
+questions_table = AirtableTable(BASE_ID, TABLE_NAME, AIRTABLE_API_KEY)
 
 # Available AI models
 models = {
     '1': {'name': 'ChatGPT 4o', 'provider': 'openai', 'model': 'gpt-4o'},
     '2': {'name': 'GPT-3.5 Turbo', 'provider': 'openai', 'model': 'gpt-3.5-turbo'},
-    '3': {'name': 'Claude 3.5 Sonnet', 'provider': 'anthropic', 'model': 'claude-3-45-sonnet-20240620'},
+    '3': {'name': 'Claude 3.5 Sonnet', 'provider': 'anthropic', 'model': 'claude-3-5-sonnet-20240620'},
     '4': {'name': 'Claude 3.5 Haiku', 'provider': 'anthropic', 'model': 'claude-3-5-haiku-20241022'}
 }
 
-# Prompt user for model selection
-print("Select the AI model to use:")
-for key, model in models.items():
-    print(f"{key}: {model['name']}")
-
-choice = input("Enter the number corresponding to your choice: ").strip()
-
-if choice not in models:
-    print("Invalid selection. Exiting.")
-    exit(1)
-
-selected_model = models[choice]
-provider = selected_model['provider']
-model_name = selected_model['model']
-
-logging.info(f"Selected model: {selected_model['name']}")
-
-def fetch_records():
-    """Fetch up to 1000 records that need cleaning with pagination."""
-    params = {
-        "filterByFormula": "AND({Explanation 4o} != '', OR({Corrected Explanation} = '', {Corrected Explanation} = BLANK()))",
-        "fields": ["Explanation 4o", "Test Number", "Question Number"],
-        "maxRecords": 2000,
-        "pageSize": 100  # Airtable only returns 100 records per page
+# --cascade: cheapest and fastest first; a record moves to the next model only
+# if the previous one's call failed or its output fails the local LaTeX check
+CASCADE = ['4', '3']
+
+# Command-line options
+parser = argparse.ArgumentParser(description="Format Explanation 4o with the selected AI model")
+parser.add_argument("--resume", action="store_true",
+                    help="Skip records already written by an interrupted run and retry the rest")
+parser.add_argument("--no-prefilter", action="store_true",
+                    help="Send every explanation to the model, even ones that are already clean or fixable locally")
+parser.add_argument("--batch", action="store_true",
+                    help="Clean all pending records in one provider batch job (half price, results can take hours)")
+parser.add_argument("--cascade", action="store_true",
+                    help="Try Claude 3.5 Haiku first and escalate to Claude 3.5 Sonnet only when the "
+                         "result fails the local LaTeX check (skips the model menu)")
+add_packing_arguments(parser)
+add_budget_arguments(parser)
+add_metrics_arguments(parser)
+args = parser.parse_args()
+configure_ledger(table=TABLE_NAME, max_cost=args.max_cost, max_tokens=args.max_tokens)
+
+if args.cascade:
+    choices = CASCADE
+else:
+    # Prompt user for model selection
+    print("Select the AI model to use:")
+    for key, model in models.items():
+        print(f"{key}: {model['name']}")
+
+    choice = input("Enter the number corresponding to your choice: ").strip()
+
+    if choice not in models:
+        print("Invalid selection. Exiting.")
+        exit(1)
+    choices = [choice]
+
+# One long-lived client per model, reused for every record
+tiers = [{**models[choice], 'backend': get_backend(models[choice]['provider'], models[choice]['model'])}
+         for choice in choices]
+selected_model = tiers[0]
+
+logging.info("Selected model: " + " -> ".join(tier['name'] for tier in tiers))
+
+# Per-provider request settings
+REQUEST_OPTIONS = {
+    'openai': {},
+    'anthropic': {
+        'system': "You are a MathJax formatting expert. Follow the example format EXACTLY.",
+        'max_tokens': 1500,
+        'temperature': 0.0
     }
+}
 
-    records = []
-    offset = None
-
-    while True:
-        if offset:
-            params["offset"] = offset  # Add offset to request next page
-
-        try:
-            response = requests.get(BASE_URL, headers=HEADERS, params=params)
-            response.raise_for_status()
-            data = response.json()
-
-            records.extend(data.get("records", []))  # Append new records
+def fetch_records():
+    """Stream up to 2000 records that need cleaning, page by page."""
+    formula = "AND({Explanation 4o} != '', OR({Corrected Explanation} = '', {Corrected Explanation} = BLANK()))"
+    fields = ["Explanation 4o", "Test Number", "Question Number"]
+    return select(questions_table, formula=formula,
+                  where=lambda f: f.get("Explanation 4o") and not f.get("Corrected Explanation"),
+                  fields=fields, max_records=2000)
+
+def build_prompt(text):
+    """Build the formatting prompt for one explanation."""
+    return (
+        "Format the following mathematical explanation using proper Markdown and MathJax syntax, "
+        "with \\(...\\) for inline math and \\[...\\] for display math:\n\n"
+        f"{text}"
+    )
 
-            offset = data.get("offset")  # Get new offset for next page
-            if not offset:
-                break  # No more pages, exit loop
+PACKED_TASK = ("Format each of the following mathematical explanations using proper Markdown and MathJax syntax, "
+               "with \\(...\\) for inline math and \\[...\\] for display math.")
 
-        except requests.exceptions.HTTPError as e:
-            logging.error(f"Failed to fetch records: {e} - Response: {response.text}")
-            return records
+def prefilter(text):
+    """Classify text as clean, fixable locally or needing the model (see latex_utils.classify_latex)."""
+    if args.no_prefilter:
+        return NEEDS_MODEL, text
+    return classify_latex(text)
 
-    logging.info(f"Fetched {len(records)} records that need cleaning")
-    return records
+def passes_check(cleaned):
+    """True if a model's output is usable: non-empty and not something the pre-filter would send to the model."""
+    return bool(cleaned and cleaned.strip()) and classify_latex(cleaned)[0] != NEEDS_MODEL
 
-def clean_text_with_model(text):
-    """Clean and format text using the selected AI model."""
+def clean_text_with_model(text, tier=None):
+    """Clean and format text using the selected AI model (or the given cascade tier); None if the call failed."""
     if not text or text.strip() == "":
         return text
+    tier = tier or selected_model
 
-    prompt = (
-        "Format the following mathematical explanation using proper Markdown and MathJax syntax:\n\n"
-        f"{text}"
-    )
+    try:
+        return tier['backend'].complete(build_prompt(text), **REQUEST_OPTIONS[tier['provider']]).text.strip()
+    except BackendError as e:
+        logging.error(f"Error with {tier['name']}: {e}")
+        return None
+
+def clean_texts_with_model(texts, validate=None, tier=None):
+    """Send several explanations to the model in one packed request; returns the raw response ("" on failure)."""
+    tier = tier or selected_model
+    options = {**REQUEST_OPTIONS[tier['provider']], 'max_tokens': PACKED_MAX_TOKENS}
 
-    if provider == 'openai':
-        import openai
-        client = openai.OpenAI(api_key=OPENAI_API_KEY)  # Use new OpenAI client
-
-        try:
-            response = client.chat.completions.create(
-                model=model_name,
-                messages=[{"role": "user", "content": prompt}]
-            )
-            return response.choices[0].message.content.strip()
-        except Exception as e:
-            logging.error(f"Error with OpenAI API: {e}")
-            return text
-
-    elif provider == 'anthropic':
-        from anthropic import Anthropic
-        client = Anthropic(api_key=ANTHROPIC_API_KEY)
-        try:
-            response = client.messages.create(
-                model=model_name,
-                max_tokens=1500,
-                temperature=0.0,
-                system="You are a MathJax formatting expert. Follow the example format EXACTLY.",
-                messages=[{"role": "user", "content": prompt}]
-            )
-            return response.content[0].text.strip()
-        except Exception as e:
-            logging.error(f"Error with Anthropic API: {e}")
-            return text
-
-def update_record(record_id, cleaned_explanation):
-    """Update a record with cleaned explanation text."""
-    data = {
-        "fields": {
-            "Corrected Explanation": cleaned_explanation
-        }
-    }
     try:
-        response = requests.patch(f"{BASE_URL}/{record_id}", headers=HEADERS, data=json.dumps(data))
-        response.raise_for_status()
-        logging.info(f"Updated record {record_id} successfully")
-        return True
-    except requests.exceptions.HTTPError as e:
-        logging.error(f"Failed to update record {record_id}: {e} - Response: {response.text}")
-        return False
+        return tier['backend'].complete(build_packed_prompt(PACKED_TASK, texts), validate=validate, **options).text
+    except BackendError as e:
+        logging.error(f"Error with {tier['name']} on {len(texts)} packed explanations: {e}")
+        return ""
+
+def cascade_clean(text):
+    """Clean with each tier in turn until the output passes the LaTeX check.
+
+    Returns ``(cleaned_text, tier_name)``; ``tier_name`` is None when no tier
+    passed, in which case the last output a tier produced is kept, or None if
+    every call failed.
+    """
+    kept = None
+    for tier in tiers:
+        cleaned = clean_text_with_model(text, tier)
+        if passes_check(cleaned):
+            return cleaned, tier['name']
+        kept = cleaned if cleaned is not None else kept
+    return kept, None
+
+def clean_batch(records, tier=None):
+    """Clean every record's explanation in one batch job; failed requests come back as None."""
+    tier = tier or selected_model
+    explanations = {record["id"]: record.get("fields", {}).get("Explanation 4o", "") for record in records}
+    prompts = {record_id: build_prompt(text) for record_id, text in explanations.items() if text.strip()}
+    logging.info(f"Submitting {len(prompts)} explanations to the {tier['name']} batch API")
+    outcomes = tier['backend'].complete_batch(prompts, **REQUEST_OPTIONS[tier['provider']])
+
+    cleaned = {}
+    for record_id, text in explanations.items():
+        outcome = outcomes.get(record_id)
+        if isinstance(outcome, BackendError):
+            logging.error(f"Batch request for record {record_id} failed: {outcome}")
+            outcome = None
+        cleaned[record_id] = outcome.text.strip() if outcome else (None if text.strip() else text)
+    return cleaned
+
+def cascade_batch(records):
+    """``cascade_clean`` for batch mode: one batch job per tier, each holding only the records still failing.
+
+    Returns ``(cleaned, resolved_by)`` keyed by record ID.
+    """
+    cleaned, resolved_by = {}, {}
+    for tier in tiers:
+        if not records:
+            break
+        results = clean_batch(records, tier)
+        failing = []
+        for record in records:
+            record_id = record["id"]
+            if results[record_id] is not None or record_id not in cleaned:
+                cleaned[record_id] = results[record_id]
+            if passes_check(results[record_id]):
+                resolved_by[record_id] = tier['name']
+            else:
+                failing.append(record)
+        records = failing
+    return cleaned, resolved_by
+
+def cascade_packed(items):
+    """``cascade_clean`` for --pack: each tier cleans the texts still failing, several per request.
+
+    ``items`` are ``(record_id, text)`` pairs. Returns ``(cleaned, resolved_by)``
+    keyed by record ID; records left out of ``cleaned`` were not reached before
+    the budget ran out, and None means every call for the record failed.
+    """
+    cleaned, resolved_by = {}, {}
+    for tier in tiers:
+        if not items:
+            break
+        failing = []
+        for (record_id, text), result in clean_in_packs(items, lambda item: item[1],
+                                                        functools.partial(clean_texts_with_model, tier=tier),
+                                                        functools.partial(clean_text_with_model, tier=tier),
+                                                        args.pack_tokens, stop=budget_exhausted):
+            if result is not None or record_id not in cleaned:
+                cleaned[record_id] = result
+            if passes_check(result):
+                resolved_by[record_id] = tier['name']
+            else:
+                failing.append((record_id, text))
+        items = failing
+    return cleaned, resolved_by
 
 def main():
     try:
-        test_response = requests.get(BASE_URL, headers=HEADERS)
-        test_response.raise_for_status()
-        records = fetch_records()
+        questions_table.first()  # Connectivity check
 
-        print(f"\nProcessing {len(records)} records...")
+        processed_records = []  # Store processed record IDs
 
-        if len(records) == 0:
-            print("No records to process.")
-            return
+        # Per-record progress journal so --resume can pick up after a crash
+        journal = CheckpointJournal(journal_path("cleanup_explanations"), resume=args.resume)
 
-        processed_records = []  # Store processed record IDs
+        def report_update(record_id, record):
+            journal.record(record_id, "written")
+            logging.info(f"Updated record {record_id} successfully")
+            processed_records.append(record_id)  # Store successful updates
 
-        # Process records with a delay to respect rate limits
+        # Updates are queued and sent to Airtable 10 records at a time
+        writer = BatchWriter(BASE_ID, TABLE_NAME, AIRTABLE_API_KEY, on_written=report_update)
+
+        # Records are cleaned as each page arrives; the next page is fetched meanwhile.
+        # In batch mode everything is fetched first and cleaned in one batch job.
+        records = fetch_records()
+        batch_cleaned = None
+        if args.batch:
+            records = list(records)
+            batch_cleaned, batch_resolved_by = cascade_batch([
+                r for r in records
+                if not journal.is_done(r["id"])
+                and prefilter(r.get("fields", {}).get("Explanation 4o", ""))[0] == NEEDS_MODEL
+            ])
+
+        prefilter_counts = Counter()
+        tier_counts = Counter()  # Records whose output passed the LaTeX check, by the model that produced it
+        over_budget = 0
+        call_failures = 0  # Every model call failed; left unwritten for a later run
+        packable = []  # With --pack, (record ID, explanation) pairs cleaned after the scan
+        total = 0
         for i, record in enumerate(records):
+            total = i + 1
             record_id = record["id"]
             fields = record.get("fields", {})
             explanation = fields.get("Explanation 4o", "")
 
-            print(f"Processing record {i + 1}/{len(records)} - ID: {record_id}")
-
-            cleaned_explanation = clean_text_with_model(explanation)
-            if update_record(record_id, cleaned_explanation):
-                processed_records.append(record_id)  # Store successful updates
-
-            time.sleep(0.3)  # Adjusted delay to respect rate limits
+            if journal.is_done(record_id):
+                print(f"Skipping record {i + 1} - ID: {record_id} (already written)")
+                continue
+            journal.record(record_id, "fetched")
+
+            print(f"Processing record {i + 1} - ID: {record_id}")
+
+            # Explanations that are already clean or fixable locally skip the model
+            category, prefiltered = prefilter(explanation)
+            prefilter_counts[category] += 1
+            if category != NEEDS_MODEL:
+                cleaned_explanation = prefiltered
+            else:
+                if batch_cleaned is not None:
+                    cleaned_explanation = batch_cleaned[record_id]
+                    resolved_by = batch_resolved_by.get(record_id)
+                elif budget_exhausted():
+                    over_budget += 1  # Left unwritten so a later run (or --resume) picks it up
+                    continue
+                elif args.pack:
+                    packable.append((record_id, explanation))
+                    continue
+                else:
+                    cleaned_explanation, resolved_by = cascade_clean(explanation)
+                if cleaned_explanation is None:
+                    call_failures += 1
+                    journal.record(record_id, "failed", error="Every model call failed")
+                    continue
+                tier_counts[resolved_by] += 1
+                journal.record(record_id, "model-called")
+            writer.update(record_id, {"Corrected Explanation": cleaned_explanation})
+
+        if packable:
+            print(f"Cleaning {len(packable)} explanations in packed requests...")
+            packed_cleaned, packed_resolved_by = cascade_packed(packable)
+            for record_id, _ in packable:
+                if record_id not in packed_cleaned:
+                    over_budget += 1
+                    continue
+                if packed_cleaned[record_id] is None:
+                    call_failures += 1
+                    journal.record(record_id, "failed", error="Every model call failed")
+                    continue
+                tier_counts[packed_resolved_by.get(record_id)] += 1
+                journal.record(record_id, "model-called")
+                writer.update(record_id, {"Corrected Explanation": packed_cleaned[record_id]})
+
+        writer.flush()
+        for record_id, _, error in writer.failed:
+            journal.record(record_id, "failed", error=str(error))
+        logging.info(f"Checkpoint summary: {journal.counts()} (journal: {journal.path})")
+        journal.close()
+
+        if total == 0:
+            print("No records to process.")
+            return
 
+        logging.info(f"Processed {total} records that needed cleaning")
+        logging.info(f"Pre-filter: {prefilter_counts[CLEAN]} already clean, {prefilter_counts[FIXABLE]} fixed locally, "
+                     f"{prefilter_counts[NEEDS_MODEL]} sent to {selected_model['name']}")
+        if tier_counts:
+            resolved = ", ".join(f"{tier_counts[tier['name']]} by {tier['name']}" for tier in tiers)
+            every_tier = " at every tier" if len(tiers) > 1 else ""
+            logging.info(f"Resolved: {resolved}; {tier_counts[None]} failed the LaTeX check{every_tier} "
+                         f"(kept the last output)")
+        if call_failures:
+            logging.info(f"{call_failures} records were left unwritten because every model call for them failed")
+        if over_budget:
+            logging.info(f"Budget reached: {over_budget} records that need the model were left for a later run")
+        if cache_summary():
+            print(cache_summary())
+        print(usage_summary())
+        print(f"Usage report: {write_usage_report()}")
+        report_stages(args.metrics_json)
         if processed_records:
             print("\nSuccessfully processed the following records:")
             for record_id in processed_records:
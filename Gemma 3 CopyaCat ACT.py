@@ -1,9 +1,16 @@
-from airtable import Airtable
-import requests
+import argparse
+import functools
 import re
 from dotenv import load_dotenv
 import os
-import time
+
+from airtable_client import AirtableTable
+from clone_generation import (CLONE_SCHEMA, JSON_RESPONSE_FORMAT, add_pipeline_arguments, add_selection_arguments,
+                              check_clone, check_partial_clone, clone_key, clone_variant, parse_json_clone,
+                              run_generation)
+from instrumentation import add_metrics_arguments
+from model_backends import BackendError, get_backend
+from usage_ledger import add_budget_arguments
 
 # Load environment variables
 load_dotenv('/Users/scotthardin/PycharmProjects/CopyCat ACT/.env')
@@ -19,34 +26,27 @@ if not AIRTABLE_API_KEY or not BASE_ID:
 # Define table IDs
 QUESTIONS_TABLE = 'tbllwZpPeh9yHJ3fM'  # Questions table
 COPYCAT_TABLE = 'tblpE46FDmB0LmeTU'  # CopyCats table
+AI_MODEL = 'Gemma3'  # Value written to the CopyCats 'AI Model' field
 
 # Initialize Airtable clients
-airtable_questions = Airtable(BASE_ID, QUESTIONS_TABLE, api_key=AIRTABLE_API_KEY)  # Fixed syntax
-airtable_copycat = Airtable(BASE_ID, COPYCAT_TABLE, api_key=AIRTABLE_API_KEY)
-
-# Ollama local endpoint
-OLLAMA_API_URL = "http://localhost:11434/api/generate"
-
-# Prompt for Test Number
-test_number = input("Enter the Test Number: ")
-formula = f"AND({{Test Number}} = '{test_number}', {{AI Check}} = '✅ Match')"
-records = airtable_questions.get_all(formula=formula)
-
-for record in records:
-    original_id = record['id']
-    latex_markdown = record['fields']['LatexMarkdown']
+airtable_questions = AirtableTable(BASE_ID, QUESTIONS_TABLE, AIRTABLE_API_KEY)
+airtable_copycats = AirtableTable(BASE_ID, COPYCAT_TABLE, AIRTABLE_API_KEY)
 
-    prompt = f"""
-    Here is a question in LatexMarkdown format:
+# Ollama throughput settings
+OLLAMA_KEEP_ALIVE = "30m"  # Keep Gemma 3 loaded between questions
+OLLAMA_NUM_PARALLEL = int(os.getenv("OLLAMA_NUM_PARALLEL", 4))  # Parallel request slots on the server
 
-    {latex_markdown}
+# Shared Ollama backend: pooled local connection, retries and the response cache.
+# Streaming makes the 30s timeout apply between tokens rather than to the whole answer.
+gemma = get_backend("ollama", "gemma3", stream=True, keep_alive=OLLAMA_KEEP_ALIVE)
 
-    Please perform the following tasks:
 
-    1) Analyze the question as if you are a 17-year-old student. Think about why a student might choose each of the wrong answers.
-    2) Create a similar question with different values and/or context. Provide the new question in Markdown format, using LaTeX for math expressions (inline math between $, standalone equations between $$).
+def build_instructions(json_output=False):
+    """Static part of the clone-generation prompt, sent as a cacheable prefix.
 
-    Structure your response as follows:
+    ``json_output`` swaps the markdown section layout for ``JSON_RESPONSE_FORMAT``.
+    """
+    response_format = JSON_RESPONSE_FORMAT if json_output else """Structure your response as follows:
 
     **Analysis:**
 
@@ -60,72 +60,107 @@ for record in records:
 
     [Single letter]
 
-    Important: The **Answer:** section must contain only a single letter (A, B, C, D, or E) on its own line, with no additional text, explanations, or notes.
+    Important: The **Answer:** section must contain only a single letter (A, B, C, D, or E) on its own line, with no additional text, explanations, or notes."""
+    return f"""
+    Please perform the following tasks for the question in LatexMarkdown format at the end of this prompt:
+
+    1) Analyze the question as if you are a 17-year-old student. Think about why a student might choose each of the wrong answers.
+    2) Create a similar question with different values and/or context. Provide the new question in Markdown format, using LaTeX for math expressions (inline math between $, standalone equations between $$).
+
+    {response_format}
     """
 
-    max_retries = 5
-    response_text = None
-    for attempt in range(max_retries):
-        try:
-            response = requests.post(
-                OLLAMA_API_URL,
-                json={
-                    "model": "gemma3",
-                    "prompt": prompt,
-                    "stream": False
-                },
-                timeout=30
-            )
-            response.raise_for_status()
-            response_text = response.json().get("response", "")
-            if not response_text:
-                raise ValueError("Empty response from Ollama")
-            break
-        except requests.exceptions.HTTPError as e:
-            if e.response.status_code == 404:
-                print(f"404 Error: Check if Ollama is running and 'gemma3' is installed.")
-                break
-            wait_time = 2 ** attempt
-            print(f"Error. Retrying in {wait_time}s (attempt {attempt + 1}/{max_retries})")
-            time.sleep(wait_time)
-        except Exception as e:
-            print(f"Error for question {original_id}: {e}")
-            break
-
-    if response_text:
-        try:
-            # Extract Analysis, New Question, and Answer
-            analysis_match = re.search(r'\*\*Analysis:\*\*(.*?)\*\*New Question:\*\*', response_text, re.DOTALL)
-            new_question_match = re.search(r'\*\*New Question:\*\*(.*?)\*\*Answer:\*\*', response_text, re.DOTALL)
-            answer_match = re.search(r'\*\*Answer:\*\*\s*([A-E])', response_text, re.DOTALL)
-
-            if not (analysis_match and new_question_match and answer_match):
-                raise ValueError("Response format is incorrect.")
-
-            explanation = analysis_match.group(1).strip()  # For Explanation field
-            new_question = new_question_match.group(1).strip()
-            answer = answer_match.group(1).strip()
-
-            if answer not in ['A', 'B', 'C', 'D', 'E']:
-                raise ValueError(f"Answer '{answer}' is not valid (A-E).")
-        except Exception as e:
-            print(f"Error parsing response for question {original_id}: {e}")
-            continue
-
-        try:
-            airtable_copycat.insert({
-                'Clone Question LM': new_question,
-                'Answer': answer,
-                'Original Question': [original_id],
-                'AI Model': 'Gemma3',
-                'Explanation': explanation
-            })
-            print(f"Successfully added copycat question for {original_id}")
-        except Exception as e:
-            print(f"Error inserting record for question {original_id}: {e}")
-    else:
-        print(f"No response for question {original_id}. Skipping.")
 
-    time.sleep(1)  # Delay between requests
+def build_prompt(latex_markdown):
+    """Per-question part of the prompt, sent after ``build_instructions``."""
+    return f"""
+    Here is the question in LatexMarkdown format:
+
+    {latex_markdown}
+    """
+
+
+def call_ollama(prompt, original_id, validate=None, variant=None, prefix=None, check=None):
+    """Send a prompt to the local Ollama server through the shared backend; None on failure."""
+    try:
+        completion = gemma.complete(prompt, validate=validate, variant=variant, prefix=prefix, check=check)
+    except BackendError as e:
+        print(f"Error for question {original_id}: {e}")
+        return None
+    if not completion.cached:
+        speed = f", {completion.tokens_per_second:.1f} tokens/s" if completion.tokens_per_second else ""
+        print(f"Gemma 3 answered question {original_id} in {completion.latency:.1f}s "
+              f"({completion.output_tokens} tokens{speed})")
+    return completion.text
+
+
+def parse_response(response_text):
+    """Extract Analysis, New Question, and Answer, raising ValueError if unusable."""
+    analysis_match = re.search(r'\*\*Analysis:\*\*(.*?)\*\*New Question:\*\*', response_text, re.DOTALL)
+    new_question_match = re.search(r'\*\*New Question:\*\*(.*?)\*\*Answer:\*\*', response_text, re.DOTALL)
+    answer_match = re.search(r'\*\*Answer:\*\*\s*([A-E])', response_text, re.DOTALL)
+
+    if not (analysis_match and new_question_match and answer_match):
+        raise ValueError("Response format is incorrect.")
+
+    explanation = analysis_match.group(1).strip()  # For Explanation field
+    new_question = new_question_match.group(1).strip()
+    answer = answer_match.group(1).strip()
 
-print("Processing complete.")
\ No newline at end of file
+    if answer not in ['A', 'B', 'C', 'D', 'E']:
+        raise ValueError(f"Answer '{answer}' is not valid (A-E).")
+
+    return {'new_question': new_question, 'answer': answer, 'explanation': explanation}
+
+
+def is_valid_response(response_text, parse=parse_response):
+    """True if the response parses; unparseable responses are not cached so retries get a fresh one."""
+    try:
+        check_clone(parse(response_text))
+        return True
+    except ValueError:
+        return False
+
+
+def fetch_response(record, clone_index, journal, json_output=False, check=None):
+    """Worker run on the pool: call Gemma 3 for one clone of a record and return the raw response."""
+    original_id = record['id']
+    validate = functools.partial(is_valid_response, parse=parse_json_clone if json_output else parse_response)
+    response_text = call_ollama(build_prompt(record['fields']['LatexMarkdown']), original_id, validate=validate,
+                                variant=clone_variant(clone_index), prefix=build_instructions(json_output),
+                                check=check)
+    if not response_text:
+        print(f"No response for question {original_id}. Skipping.")
+        return None
+    journal.record(clone_key(original_id, clone_index), "model-called")
+    return response_text
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate CopyCat questions with Gemma 3 via Ollama")
+    parser.add_argument("--workers", type=int, default=OLLAMA_NUM_PARALLEL,
+                        help="Number of Ollama requests kept in flight (default: OLLAMA_NUM_PARALLEL or 4)")
+    parser.add_argument("--rpm", type=int, help="Maximum Ollama requests started per minute (default: no limit)")
+    parser.add_argument("--keep-alive", default=OLLAMA_KEEP_ALIVE,
+                        help="How long Ollama keeps the model loaded between requests, e.g. 30m or -1")
+    parser.add_argument("--no-stream", action="store_true",
+                        help="Wait for whole responses instead of streaming tokens")
+    parser.add_argument("--resume", action="store_true",
+                        help="Skip clones already written by an interrupted run and retry the rest")
+    add_selection_arguments(parser)
+    add_pipeline_arguments(parser)
+    add_budget_arguments(parser)
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    gemma.json_output = CLONE_SCHEMA if args.json else False
+    parse = parse_json_clone if args.json else parse_response
+    gemma.keep_alive = args.keep_alive
+    gemma.stream = args.early_abort or not args.no_stream
+    check = check_partial_clone if args.early_abort and not args.json else None
+
+    fetch = functools.partial(fetch_response, json_output=args.json, check=check)
+    run_generation(args, "gemma3", airtable_questions, airtable_copycats, AI_MODEL, fetch, parse)
+
+
+if __name__ == "__main__":
+    main()
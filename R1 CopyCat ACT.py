@@ -1,9 +1,18 @@
-from airtable import Airtable
+import argparse
+import functools
 import re
 from dotenv import load_dotenv
 import os
-import requests
-import time
+
+from airtable_client import AirtableTable
+from checkpoints import CheckpointJournal, journal_path
+from clone_generation import (CLONE_SCHEMA, JSON_RESPONSE_FORMAT, add_pipeline_arguments, add_selection_arguments,
+                              check_clone, check_partial_clone, clone_key, clone_variant, parse_json_clone,
+                              run_generation)
+from generation_engine import LatencyTracker, hedged
+from instrumentation import add_metrics_arguments
+from model_backends import get_backend
+from usage_ledger import add_budget_arguments
 
 # Load environment variables
 load_dotenv('/Users/scotthardin/PycharmProjects/CopyCat ACT/.env')
@@ -24,61 +33,90 @@ if not BASE_ID:
 # Define table IDs
 QUESTIONS_TABLE = 'tbllwZpPeh9yHJ3fM'  # Questions table ID
 COPYCAT_TABLE = 'tblpE46FDmB0LmeTU'  # CopyCats table ID
+AI_MODEL = 'DeepSeek R1'  # Value written to the CopyCats 'AI Model' field
+
+# Initialize Airtable clients
+airtable_questions = AirtableTable(BASE_ID, QUESTIONS_TABLE, AIRTABLE_API_KEY)
+airtable_copycats = AirtableTable(BASE_ID, COPYCAT_TABLE, AIRTABLE_API_KEY)
+
+
+# Shared DeepSeek backend: one pooled connection, retries and the response cache
+deepseek = get_backend("deepseek", "deepseek-reasoner", retry_delay=5)
+SYSTEM_PROMPT = "You are a helpful assistant."
+MAX_TOKENS = 1000  # Increased to allow more content
+
+# Backends --hedge can race against a slow R1 call: (provider, model, 'AI Model' value, backend options)
+HEDGE_BACKENDS = {
+    "gemma": ("ollama", "gemma3", "Gemma3", {"stream": True, "keep_alive": "30m"}),
+    "gpt-4o": ("openai", "gpt-4o", "GPT-4o", {}),
+}
+HEDGE_AFTER = 90  # Seconds before hedging until enough R1 latencies are known for a p90
+r1_latency = LatencyTracker(HEDGE_AFTER)
+hedge_winners = {}  # Clone key -> 'AI Model' of the hedge backend that answered first
+# CopyCat IDs of hedge wins, kept across runs so they count toward R1's clones but other clones by
+# the hedge models do not
+HEDGE_WINS_JOURNAL = journal_path("r1_hedge_wins")
+
+
+def call_deepseek_api(prompt, validate=None, variant=None, cancel=None, prefix=None, check=None):
+    """Call DeepSeek R1 and return the Completion (text, token counts, latency)."""
+    return deepseek.complete(
+        prompt,
+        system=SYSTEM_PROMPT,
+        max_tokens=MAX_TOKENS,
+        validate=validate,
+        variant=variant,
+        cancel=cancel,
+        prefix=prefix,
+        check=check
+    )
+
+
+def call_hedged(prompt, validate, variant, hedge_backend, hedge_model, prefix=None, check=None):
+    """Call DeepSeek, and the hedge backend too if R1 takes longer than its recent p90.
+
+    The first response that parses and passes the answer checks wins; the other
+    call stops retrying. Returns the Completion and the 'AI Model' that wrote it.
+    """
+    def primary(cancel):
+        completion = call_deepseek_api(prompt, validate, variant, cancel, prefix, check)
+        if not completion.cached:
+            r1_latency.add(completion.latency)
+        return completion
+
+    def secondary(cancel):
+        return hedge_backend.complete(prompt, system=SYSTEM_PROMPT, max_tokens=MAX_TOKENS, validate=validate,
+                                      variant=variant, cancel=cancel, prefix=prefix, check=check)
+
+    winner, completion = hedged(primary, secondary, r1_latency.deadline(),
+                                accept=lambda c: bool(c.text) and validate(c.text))
+    return completion, hedge_model if winner else AI_MODEL
+
+
+def build_instructions(json_output=False):
+    """Static part of the clone-generation prompt, sent as a cacheable prefix.
+
+    ``json_output`` swaps the markdown section layout for ``JSON_RESPONSE_FORMAT``.
+    """
+    response_format = JSON_RESPONSE_FORMAT if json_output else """Structure your response as follows:
 
-# Initialize Airtable client
-airtable_questions = Airtable(BASE_ID, QUESTIONS_TABLE, api_key=AIRTABLE_API_KEY)
-airtable_copycat = Airtable(BASE_ID, COPYCAT_TABLE, api_key=AIRTABLE_API_KEY)
+       **Analysis:**
 
+       [Your analysis here]
 
-# Custom function to call DeepSeek R1 API with retries
-def call_deepseek_api(prompt, retries=5, delay=5):
-    url = "https://api.deepseek.com/v1/chat/completions"  # Verify this endpoint
-    headers = {
-        "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
-        "Content-Type": "application/json"
-    }
-    data = {
-        "model": "deepseek-reasoner",
-        "messages": [
-            {"role": "system", "content": "You are a helpful assistant."},
-            {"role": "user", "content": prompt}
-        ],
-        "max_tokens": 1000,  # Increased to allow more content
-        "stream": False
-    }
+       **New Question:**
 
-    for attempt in range(retries):
-        try:
-            response = requests.post(url, json=data, headers=headers)
-            response.raise_for_status()
-            return response.json()['choices'][0]['message']['content']
-        except requests.exceptions.RequestException as e:
-            if attempt < retries - 1:
-                print(f"Attempt {attempt + 1} failed: {e}. Retrying in {delay} seconds...")
-                time.sleep(delay)
-            else:
-                print(f"Error calling DeepSeek API after {retries} attempts: {e}")
-                if e.response is not None:
-                    print(f"Response content: {e.response.text}")
-                return None
-
-
-# Prompt for Test Number
-test_number = input("Enter the Test Number: ")
-formula = f"AND({{Test Number}} = '{test_number}', {{AI Check}} = '✅ Match')"
-records = airtable_questions.get_all(formula=formula)
-
-for record in records:
-    original_id = record['id']
-    latex_markdown = record['fields']['LatexMarkdown']
+       [Complete question including the multiple choice answers, all with proper MathJax formatting]
 
-    # Updated prompt with example
-    prompt = f"""
-       Here is a question in LatexMarkdown format:
+       **Answer:**
 
-       {latex_markdown}
+       [Just the letter of the correct answer (A, B, C, D, or E) with no quotes or additional text]
+
+       **Explanation:**
 
-       Please perform the following tasks:
+       [Your explanation here with proper MathJax formatting]"""
+    return f"""
+       Please perform the following tasks for the question in LatexMarkdown format at the end of this prompt:
 
        1) Analyze the question as if you are a 17-year-old student. Think about why a student might choose each of the wrong answers.
 
@@ -101,72 +139,132 @@ for record in records:
 
        3) Provide an explanation of how to solve the new question, written as if you are a 17-year-old average math student explaining it to a peer. Use simple language and avoid advanced mathematical terms. Follow the same formatting rules for any math expressions in the explanation.
 
-       Structure your response as follows:
-
-       **Analysis:**
-
-       [Your analysis here]
+       {response_format}
+       """
 
-       **New Question:**
 
-       [Complete question including the multiple choice answers, all with proper MathJax formatting]
+def build_prompt(latex_markdown):
+    """Per-question part of the prompt, sent after ``build_instructions``."""
+    return f"""
+       Here is the question in LatexMarkdown format:
 
-       **Answer:**
+       {latex_markdown}
+       """
 
-       [Just the letter of the correct answer (A, B, C, D, or E) with no quotes or additional text]
 
-       **Explanation:**
+def parse_response(response_text):
+    """Split a DeepSeek response into its sections, raising ValueError if unusable."""
+    # Extract sections with fallbacks
+    analysis_match = re.search(
+        r'\*\*Analysis:\*\*(.*?)(?=\*\*New Question:\*\*|\*\*Answer:\*\*|\*\*Explanation:\*\*|$)', response_text,
+        re.DOTALL)
+    new_question_match = re.search(r'\*\*New Question:\*\*(.*?)(?=\*\*Answer:\*\*|\*\*Explanation:\*\*|$)',
+                                   response_text, re.DOTALL)
+    answer_match = re.search(r'\*\*Answer:\*\*(.*?)(?=\*\*Explanation:\*\*|$)', response_text, re.DOTALL)
+    explanation_match = re.search(r'\*\*Explanation:\*\*(.*)', response_text, re.DOTALL)
+
+    # Assign with fallbacks
+    analysis = analysis_match.group(1).strip() if analysis_match else "No analysis provided"
+    new_question = new_question_match.group(1).strip() if new_question_match else "No new question provided"
+    answer = answer_match.group(1).strip() if answer_match else ""
+    explanation = explanation_match.group(1).strip() if explanation_match else "No explanation provided"
+
+    if not answer and not new_question:
+        raise ValueError(f"Response format is incorrect. Missing critical sections. Raw response: {response_text}")
+
+    # Validate the answer if present
+    if answer and (len(answer) != 1 or not answer.isalpha()):
+        raise ValueError(f"Answer '{answer}' is not a single letter.")
+
+    return {
+        'analysis': analysis,
+        'new_question': new_question,
+        'answer': answer,
+        'explanation': explanation
+    }
 
-       [Your explanation here with proper MathJax formatting]
-       """
 
+def is_valid_response(response_text, parse=parse_response):
+    """True if the response parses; unparseable responses are not cached so retries get a fresh one."""
     try:
-        # Call DeepSeek R1 API
-        response_text = call_deepseek_api(prompt)
-        if not response_text:
-            continue
-        print(f"Raw response for question {original_id}: {response_text}")
-    except Exception as e:
-        print(f"Error calling DeepSeek API for question {original_id}: {e}")
-        continue
+        check_clone(parse(response_text))
+        return True
+    except ValueError:
+        return False
 
-    try:
-        # Extract sections with fallbacks
-        analysis_match = re.search(
-            r'\*\*Analysis:\*\*(.*?)(?=\*\*New Question:\*\*|\*\*Answer:\*\*|\*\*Explanation:\*\*|$)', response_text,
-            re.DOTALL)
-        new_question_match = re.search(r'\*\*New Question:\*\*(.*?)(?=\*\*Answer:\*\*|\*\*Explanation:\*\*|$)',
-                                       response_text, re.DOTALL)
-        answer_match = re.search(r'\*\*Answer:\*\*(.*?)(?=\*\*Explanation:\*\*|$)', response_text, re.DOTALL)
-        explanation_match = re.search(r'\*\*Explanation:\*\*(.*)', response_text, re.DOTALL)
-
-        # Assign with fallbacks
-        analysis = analysis_match.group(1).strip() if analysis_match else "No analysis provided"
-        new_question = new_question_match.group(1).strip() if new_question_match else "No new question provided"
-        answer = answer_match.group(1).strip() if answer_match else ""
-        explanation = explanation_match.group(1).strip() if explanation_match else "No explanation provided"
-
-        if not answer and not new_question:
-            raise ValueError(f"Response format is incorrect. Missing critical sections. Raw response: {response_text}")
-
-        # Validate the answer if present
-        if answer and (len(answer) != 1 or not answer.isalpha()):
-            raise ValueError(f"Answer '{answer}' is not a single letter.")
-    except Exception as e:
-        print(f"Error parsing response for question {original_id}: {e}")
-        continue
 
-    try:
-        # Insert into CopyCats table with the explanation
-        airtable_copycat.insert({
-            'Clone Question LM': new_question,
-            'Answer': answer,
-            'Original Question': [original_id],
-            'AI Model': 'DeepSeek R1',
-            'Explanation': explanation
-        })
-        print(f"Successfully added copycat question for original question {original_id}")
-    except Exception as e:
-        print(f"Error inserting record for question {original_id}: {e}")
-
-print("Processing complete.")
\ No newline at end of file
+def fetch_response(record, clone_index, journal, json_output=False, hedge=None, check=None):
+    """Worker run on the pool: call DeepSeek for one clone of a record and return the raw response.
+
+    ``hedge`` is an optional ``(backend, ai_model)`` raced against slow R1 calls;
+    ``check`` aborts streamed responses that are already malformed.
+    """
+    original_id = record['id']
+    key = clone_key(original_id, clone_index)
+    validate = functools.partial(is_valid_response, parse=parse_json_clone if json_output else parse_response)
+    instructions = build_instructions(json_output)
+    prompt = build_prompt(record['fields']['LatexMarkdown'])
+
+    # Call DeepSeek R1 API
+    ai_model = AI_MODEL
+    if hedge:
+        completion, ai_model = call_hedged(prompt, validate, clone_variant(clone_index), *hedge, prefix=instructions,
+                                           check=check)
+    else:
+        completion = call_deepseek_api(prompt, validate=validate, variant=clone_variant(clone_index),
+                                       prefix=instructions, check=check)
+    if not completion.text:
+        return None
+    if ai_model != AI_MODEL:
+        hedge_winners[key] = ai_model
+    journal.record(key, "model-called")
+    print(f"Got response for question {original_id} from {ai_model} ({completion.latency:.1f}s, "
+          f"{completion.input_tokens} in / {completion.output_tokens} out tokens)")
+    return completion.text
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate CopyCat questions with DeepSeek R1")
+    parser.add_argument("--workers", type=int, default=8, help="Number of DeepSeek requests kept in flight")
+    parser.add_argument("--rpm", type=int, help="Maximum DeepSeek requests started per minute")
+    parser.add_argument("--resume", action="store_true",
+                        help="Skip clones already written by an interrupted run and retry the rest")
+    parser.add_argument("--hedge", choices=HEDGE_BACKENDS,
+                        help="Also send a question to this backend when R1 is slower than its recent p90; "
+                             "the first valid answer is written with that backend's AI Model but counts "
+                             "toward R1's --clones-per-question. Calls are streamed so the loser stops early")
+    parser.add_argument("--hedge-after", type=float, default=HEDGE_AFTER,
+                        help=f"Hedging deadline in seconds until enough R1 latencies are known (default: {HEDGE_AFTER})")
+    add_selection_arguments(parser)
+    add_pipeline_arguments(parser)
+    add_budget_arguments(parser)
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    deepseek.json_output = CLONE_SCHEMA if args.json else False
+    deepseek.stream = args.early_abort or bool(args.hedge)  # Only a streamed call stops when cancelled
+    parse = parse_json_clone if args.json else parse_response
+    check = check_partial_clone if args.early_abort and not args.json else None
+    hedge = None
+    if args.hedge:
+        provider, model, hedge_model, options = HEDGE_BACKENDS[args.hedge]
+        options = {**options, "stream": True}
+        r1_latency.default = args.hedge_after
+        hedge = (get_backend(provider, model, json_output=deepseek.json_output, **options), hedge_model)
+
+    fetch = functools.partial(fetch_response, json_output=args.json, hedge=hedge, check=check)
+    hedge_wins = CheckpointJournal(HEDGE_WINS_JOURNAL, resume=True)
+    won = {copycat_id for copycat_id, status in hedge_wins.statuses.items() if status == "written"}
+
+    def record_hedge_win(key, record):
+        if key in hedge_winners:
+            hedge_wins.record(record['id'], "written", ai_model=hedge_winners.pop(key), clone=key)
+
+    run_generation(args, "r1", airtable_questions, airtable_copycats, AI_MODEL, fetch, parse,
+                   model_of=lambda key: hedge_winners.get(key, AI_MODEL),
+                   extra_clones={model: won for _, _, model, _ in HEDGE_BACKENDS.values()} if won else None,
+                   on_written=record_hedge_win)
+    hedge_wins.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,296 @@
+"""Shared Airtable client used by every batch script.
+
+All Airtable traffic goes through ``airtable_request``, which reuses one pooled
+``requests.Session`` (keep-alive instead of a new TLS handshake per call),
+throttles each base with a token bucket at Airtable's 5 requests/second limit,
+and backs off on 429 and 5xx responses instead of failing the run.
+
+``AirtableTable`` wraps the common read/write calls for one table (including
+``iterate``, which streams records while the next page is fetched in the
+background), and ``BatchWriter`` queues creates/updates and sends them 10
+records per request.
+"""
+import logging
+import queue
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from instrumentation import record_time, timed
+
+AIRTABLE_API_URL = "https://api.airtable.com/v0"
+MAX_BATCH_SIZE = 10  # Airtable's per-request record limit for create/update
+REQUESTS_PER_SECOND = 5  # Airtable's per-base rate limit
+RATE_LIMIT_PENALTY = 30  # Airtable blocks a base for 30 seconds after a 429
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+_session = None
+_session_lock = threading.Lock()
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+class TokenBucket:
+    """Thread-safe token bucket allowing ``rate`` acquisitions per second."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available, then take it."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def get_session():
+    """Return the process-wide pooled session, creating it on first use."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+        return _session
+
+
+def get_bucket(base_id):
+    """Return the token bucket shared by every request to ``base_id``."""
+    with _buckets_lock:
+        if base_id not in _buckets:
+            _buckets[base_id] = TokenBucket(REQUESTS_PER_SECOND)
+        return _buckets[base_id]
+
+
+def _retry_delay(response, attempt):
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    if response is not None and response.status_code == 429:
+        return RATE_LIMIT_PENALTY
+    return 2 ** attempt
+
+
+def airtable_request(method, base_id, path, api_key, params=None, json=None, max_retries=5):
+    """Send one throttled request to ``/v0/{base_id}/{path}`` and return the JSON body.
+
+    429 and 5xx responses (and connection errors) are retried, honouring
+    ``Retry-After`` when Airtable sends it. Other HTTP errors are raised as
+    ``requests.exceptions.HTTPError``.
+    """
+    url = f"{AIRTABLE_API_URL}/{base_id}/{path}"
+    headers = {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json"
+    }
+    bucket = get_bucket(base_id)
+    session = get_session()
+
+    for attempt in range(max_retries):
+        bucket.acquire()
+        response = None
+        try:
+            response = session.request(method, url, headers=headers, params=params, json=json, timeout=60)
+            if response.status_code not in RETRYABLE_STATUS:
+                response.raise_for_status()
+                return response.json()
+            error = requests.exceptions.HTTPError(
+                f"{response.status_code} Error for url: {url}", response=response)
+        except requests.exceptions.HTTPError:
+            raise
+        except requests.exceptions.RequestException as e:
+            error = e
+
+        if attempt == max_retries - 1:
+            raise error
+        delay = _retry_delay(response, attempt)
+        logging.warning(f"Airtable {method} {path} failed ({error}); retrying in {delay}s")
+        time.sleep(delay)
+
+
+class AirtableTable:
+    """Read/write helpers for one Airtable table, all going through ``airtable_request``."""
+
+    def __init__(self, base_id, table, api_key):
+        self.base_id = base_id
+        self.table = table
+        self.api_key = api_key
+
+    def request(self, method, path="", **kwargs):
+        full_path = f"{self.table}/{path}" if path else self.table
+        return airtable_request(method, self.base_id, full_path, self.api_key, **kwargs)
+
+    def page(self, formula=None, fields=None, offset=None, page_size=100, max_records=None):
+        """Fetch a single page of records; returns ``(records, next_offset)``."""
+        params = {"pageSize": page_size}
+        if formula:
+            params["filterByFormula"] = formula
+        if fields:
+            params["fields[]"] = fields
+        if offset:
+            params["offset"] = offset
+        if max_records:
+            params["maxRecords"] = max_records
+        start = time.perf_counter()
+        data = self.request("GET", params=params)
+        records = data.get("records", [])
+        record_time("fetch", time.perf_counter() - start, len(records))
+        return records, data.get("offset")
+
+    def iterate(self, formula=None, fields=None, max_records=None):
+        """Yield every matching record, following Airtable's ``offset`` pagination.
+
+        Pages are fetched on a background thread one page ahead of the caller,
+        so work on the current page overlaps the request for the next one and
+        at most two pages are held in memory.
+        """
+        pages = queue.Queue(maxsize=1)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=0.5)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def fetch():
+            offset = None
+            try:
+                while True:
+                    page, offset = self.page(formula=formula, fields=fields, offset=offset, max_records=max_records)
+                    if not put((page, None)) or not offset:
+                        break
+            except Exception as e:
+                put((None, e))
+                return
+            put((None, None))
+
+        threading.Thread(target=fetch, daemon=True).start()
+        try:
+            while True:
+                page, error = pages.get()
+                if error:
+                    raise error
+                if page is None:
+                    return
+                yield from page
+        finally:
+            stop.set()
+
+    def all(self, formula=None, fields=None, max_records=None):
+        """Fetch every matching record into a list."""
+        return list(self.iterate(formula=formula, fields=fields, max_records=max_records))
+
+    def first(self, formula=None, fields=None):
+        """Return the first matching record, or None."""
+        records, _ = self.page(formula=formula, fields=fields, max_records=1, page_size=1)
+        return records[0] if records else None
+
+    def get(self, record_id):
+        return self.request("GET", record_id)
+
+    def create(self, fields):
+        return self.request("POST", json={"fields": fields})
+
+    def update(self, record_id, fields):
+        return self.request("PATCH", record_id, json={"fields": fields})
+
+
+class BatchWriter:
+    """Collects pending creates/updates for one table and flushes them 10 at a time.
+
+    ``on_written(key, record)`` is called for every record Airtable confirms,
+    where ``key`` is whatever the caller passed to ``create``/``update`` (the
+    record ID for updates). Records that still fail after retries are kept in
+    ``failed`` as ``(key, fields, error)`` tuples.
+    """
+
+    def __init__(self, base_id, table, api_key, batch_size=MAX_BATCH_SIZE, on_written=None):
+        self.table = AirtableTable(base_id, table, api_key)
+        self.batch_size = min(batch_size, MAX_BATCH_SIZE)
+        self.on_written = on_written
+        self.written = 0
+        self.failed = []
+        self._creates = []
+        self._updates = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.flush()
+
+    def create(self, fields, key=None):
+        """Queue a new record; sends a batch once 10 creates are pending."""
+        self._creates.append((key, fields))
+        if len(self._creates) >= self.batch_size:
+            self._send("POST", self._creates)
+            self._creates = []
+
+    def update(self, record_id, fields):
+        """Queue a field update for an existing record."""
+        self._updates.append((record_id, fields))
+        if len(self._updates) >= self.batch_size:
+            self._send("PATCH", self._updates)
+            self._updates = []
+
+    def flush(self):
+        """Send everything still pending."""
+        for method, pending in (("POST", self._creates), ("PATCH", self._updates)):
+            for i in range(0, len(pending), self.batch_size):
+                self._send(method, pending[i:i + self.batch_size])
+        self._creates = []
+        self._updates = []
+
+    def _payload(self, method, batch):
+        if method == "POST":
+            return {"records": [{"fields": fields} for _, fields in batch]}
+        return {"records": [{"id": record_id, "fields": fields} for record_id, fields in batch]}
+
+    def _send(self, method, batch):
+        if not batch:
+            return
+        try:
+            # airtable_request already retries rate limits and server errors
+            with timed("write", len(batch)):
+                records = self.table.request(method, json=self._payload(method, batch)).get("records", [])
+        except requests.exceptions.RequestException as e:
+            status = e.response.status_code if e.response is not None else None
+            if status is not None and status not in RETRYABLE_STATUS and len(batch) > 1:
+                # Airtable rejects the whole batch if any record is invalid;
+                # resend one at a time so the good records still land.
+                for item in batch:
+                    self._send(method, [item])
+                return
+            self._fail(batch, e)
+            return
+
+        for (key, _), record in zip(batch, records):
+            self.written += 1
+            if self.on_written:
+                self.on_written(key, record)
+
+    def _fail(self, batch, error):
+        for key, fields in batch:
+            logging.error(f"Failed to write record {key}: {error}")
+            self.failed.append((key, fields, error))
@@ -0,0 +1,195 @@
+"""Local SQLite mirror of the Questions, CopyCats and Skills tables.
+
+Run ``python airtable_mirror.py`` to sync the mirror. The first sync downloads
+every record; later syncs only fetch records whose ``LAST_MODIFIED_TIME()`` is
+after the previous sync, so they take seconds instead of minutes. Use
+``--full`` to re-download everything and drop records deleted in Airtable.
+
+Scripts read through ``select``: when the ``AIRTABLE_MIRROR`` environment
+variable points at a mirror file, the table is brought up to date with an
+incremental sync and then queried locally; otherwise ``select`` falls back to
+paging Airtable with the script's formula.
+"""
+import argparse
+import json
+import logging
+import os
+import sqlite3
+from datetime import datetime, timedelta, timezone
+
+from dotenv import load_dotenv
+
+from airtable_client import AirtableTable
+
+MIRRORED_TABLES = {
+    "questions": "tbllwZpPeh9yHJ3fM",
+    "copycats": "tblpE46FDmB0LmeTU",
+    "skills": "tbl6l9Pu2uHM2XlvV",
+}
+DEFAULT_MIRROR_PATH = "airtable_mirror.sqlite"
+SYNC_OVERLAP = timedelta(minutes=5)  # Re-fetch a little history to absorb clock skew
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    table_id TEXT NOT NULL,
+    record_id TEXT NOT NULL,
+    created_time TEXT,
+    fields TEXT NOT NULL,
+    PRIMARY KEY (table_id, record_id)
+);
+CREATE TABLE IF NOT EXISTS sync_state (
+    table_id TEXT PRIMARY KEY,
+    last_synced TEXT NOT NULL
+);
+"""
+
+_synced = set()
+
+
+def resolve_table(table):
+    """Map a table name like "Questions" to its table ID; IDs pass through unchanged."""
+    return MIRRORED_TABLES.get(table.lower(), table)
+
+
+def connect(path=DEFAULT_MIRROR_PATH):
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def sync_table(conn, base_id, table_id, api_key, full=False):
+    """Pull new and modified records for one table into the mirror; returns the count."""
+    table_id = resolve_table(table_id)
+    row = conn.execute("SELECT last_synced FROM sync_state WHERE table_id = ?", (table_id,)).fetchone()
+    started = datetime.now(timezone.utc)
+
+    formula = None
+    if row and not full:
+        formula = f"IS_AFTER(LAST_MODIFIED_TIME(), '{row[0]}')"
+
+    seen = set()
+    count = 0
+    for record in AirtableTable(base_id, table_id, api_key).iterate(formula=formula):
+        conn.execute(
+            "INSERT OR REPLACE INTO records (table_id, record_id, created_time, fields) VALUES (?, ?, ?, ?)",
+            (table_id, record["id"], record.get("createdTime"), json.dumps(record.get("fields", {})))
+        )
+        seen.add(record["id"])
+        count += 1
+
+    if formula is None:
+        # A full download is authoritative, so drop records deleted in Airtable
+        existing = [r[0] for r in conn.execute("SELECT record_id FROM records WHERE table_id = ?", (table_id,))]
+        stale = [(table_id, record_id) for record_id in existing if record_id not in seen]
+        conn.executemany("DELETE FROM records WHERE table_id = ? AND record_id = ?", stale)
+
+    watermark = (started - SYNC_OVERLAP).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+    conn.execute("INSERT OR REPLACE INTO sync_state (table_id, last_synced) VALUES (?, ?)", (table_id, watermark))
+    conn.commit()
+    logging.info(f"Synced {count} {'records' if formula is None else 'changed records'} for table {table_id}")
+    return count
+
+
+class MirrorTable:
+    """Read-only view of one mirrored table, returning records in Airtable's shape."""
+
+    def __init__(self, path, table_id):
+        self.path = path
+        self.table_id = resolve_table(table_id)
+
+    def iterate(self, where=None, fields=None, max_records=None):
+        """Yield records whose fields satisfy ``where(fields)`` (all records if None)."""
+        conn = connect(self.path)
+        try:
+            rows = conn.execute(
+                "SELECT record_id, created_time, fields FROM records WHERE table_id = ?", (self.table_id,))
+            returned = 0
+            for record_id, created_time, raw_fields in rows:
+                record_fields = json.loads(raw_fields)
+                if where and not where(record_fields):
+                    continue
+                if fields:
+                    record_fields = {k: v for k, v in record_fields.items() if k in fields}
+                yield {"id": record_id, "createdTime": created_time, "fields": record_fields}
+                returned += 1
+                if max_records and returned >= max_records:
+                    return
+        finally:
+            conn.close()
+
+    def all(self, where=None, fields=None, max_records=None):
+        return list(self.iterate(where=where, fields=fields, max_records=max_records))
+
+    def get(self, record_id):
+        conn = connect(self.path)
+        try:
+            row = conn.execute(
+                "SELECT created_time, fields FROM records WHERE table_id = ? AND record_id = ?",
+                (self.table_id, record_id)
+            ).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            raise KeyError(f"Record {record_id} is not in the mirror")
+        return {"id": record_id, "createdTime": row[0], "fields": json.loads(row[1])}
+
+
+def open_mirror(table, base_id, api_key):
+    """Return a synced MirrorTable if AIRTABLE_MIRROR is set, else None.
+
+    The first call per table in a process runs an incremental sync so the
+    mirror reflects edits made since the last run.
+    """
+    path = os.getenv("AIRTABLE_MIRROR")
+    if not path:
+        return None
+    table_id = resolve_table(table)
+    if table_id not in _synced:
+        conn = connect(path)
+        try:
+            sync_table(conn, base_id, table_id, api_key)
+        finally:
+            conn.close()
+        _synced.add(table_id)
+    return MirrorTable(path, table_id)
+
+
+def select(table, formula=None, where=None, fields=None, max_records=None):
+    """Iterate records from the local mirror when one is configured, else from Airtable.
+
+    ``formula`` is used against Airtable and ``where`` (a predicate on the
+    record's fields) against the mirror, so callers pass both.
+    """
+    mirror = open_mirror(table.table, table.base_id, table.api_key)
+    if mirror:
+        return mirror.iterate(where=where, fields=fields, max_records=max_records)
+    return table.iterate(formula=formula, fields=fields, max_records=max_records)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Mirror Airtable tables into a local SQLite file")
+    parser.add_argument("tables", nargs="*", default=list(MIRRORED_TABLES),
+                        help="Tables to sync (default: questions copycats skills)")
+    parser.add_argument("--path", default=os.getenv("AIRTABLE_MIRROR", DEFAULT_MIRROR_PATH),
+                        help="SQLite file to write (default: $AIRTABLE_MIRROR or airtable_mirror.sqlite)")
+    parser.add_argument("--full", action="store_true", help="Re-download every record instead of only changes")
+    args = parser.parse_args()
+
+    api_key = os.getenv("AIRTABLE_API_KEY")
+    base_id = os.getenv("BASE_ID")
+    if not api_key or not base_id:
+        raise ValueError("AIRTABLE_API_KEY or BASE_ID is not set. Check your .env file.")
+
+    conn = connect(args.path)
+    try:
+        for table in args.tables:
+            sync_table(conn, base_id, table, api_key, full=args.full)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Append-only JSONL journal of per-record progress for long runs.
+
+Each line records one status change for one record (usually its Airtable
+record ID): ``fetched``, ``model-called``, ``parsed``, ``written`` or
+``failed``. When a run is started with ``--resume`` the journal is replayed
+and records that already reached ``written`` are skipped, so a crash halfway
+through a 2000-record run only costs the records that were in flight. Model
+calls for records that were called but not written are served from the LLM
+cache on the retry.
+"""
+import json
+import os
+import threading
+import time
+
+CHECKPOINT_DIR = "checkpoints"
+
+STATUSES = ("fetched", "model-called", "parsed", "written", "failed")
+
+
+def journal_path(job_name):
+    """Path of the journal for a job, e.g. ``checkpoints/r1_test_12.jsonl``."""
+    safe_name = "".join(c if c.isalnum() or c in "-_." else "_" for c in job_name)
+    return os.path.join(CHECKPOINT_DIR, f"{safe_name}.jsonl")
+
+
+class CheckpointJournal:
+    """Thread-safe per-record status journal.
+
+    Without ``resume`` any existing journal for the job is replaced so a
+    fresh run starts from nothing.
+    """
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.statuses = {}
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if resume and os.path.exists(path):
+            self._replay()
+        self._file = open(path, "a" if resume else "w", encoding="utf-8")
+        if resume and self._file.tell() > 0:
+            self._file.write("\n")  # Terminate a line left truncated by a crash
+
+    def _replay(self):
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # A crash can leave a truncated last line
+                self.statuses[entry["key"]] = entry["status"]
+
+    def record(self, key, status, **details):
+        """Append a status change for ``key``; extra details are stored alongside."""
+        if status not in STATUSES:
+            raise ValueError(f"Unknown checkpoint status '{status}'")
+        entry = {"key": key, "status": status, "time": time.time(), **details}
+        with self._lock:
+            self.statuses[key] = status
+            self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self._file.flush()
+
+    def status(self, key):
+        return self.statuses.get(key)
+
+    def is_done(self, key):
+        return self.statuses.get(key) == "written"
+
+    def counts(self):
+        counts = {}
+        for status in self.statuses.values():
+            counts[status] = counts.get(status, 0) + 1
+        return counts
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
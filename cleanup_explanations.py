@@ -1,9 +1,14 @@
+import argparse
 import os
 import requests
 from dotenv import load_dotenv
-import re
 import logging
 
+from airtable_client import AirtableTable, BatchWriter
+from airtable_mirror import select
+from instrumentation import add_metrics_arguments, report_stages
+from latex_utils import normalize_latex
+
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -20,109 +25,60 @@ if not all([BASE_ID, AIRTABLE_API_KEY]):
     logging.error("Missing required Airtable variables in .env file.")
     exit(1)
 
-# Headers for Airtable API
-HEADERS = {
-    "Authorization": f"Bearer {AIRTABLE_API_KEY}",
-    "Content-Type": "application/json"
-}
+# Shared, rate-limited Airtable client
+questions_table = AirtableTable(BASE_ID, QUESTIONS_TABLE, AIRTABLE_API_KEY)
 
 def clean_latex(text):
-    if not text:
-        return text
-        
-    # Replace $$ with \[ and \]
-    text = re.sub(r'\$\$(.*?)\$\$', r'\\[\1\\]', text)
-    
-    # Replace $ with \( and \)
-    text = re.sub(r'(?<!\\)\$(.*?)(?<!\\)\$', r'\\(\1\\)', text)
-    
-    # Fix spacing around delimiters
-    text = re.sub(r'([^\s])(\\[\(\[])', r'\1 \2', text)  # Add space before
-    text = re.sub(r'(\\[\)\]])([\w])', r'\1 \2', text)   # Add space after
-    
-    # Remove extra spaces inside delimiters
-    text = re.sub(r'\\[\(\[]\s+', r'\\(', text)
-    text = re.sub(r'\s+\\[\)\]]', r'\\)', text)
-    
-    # Fix common LaTeX issues
-    text = text.replace('\\\\', '\\')  # Remove double backslashes
-    text = re.sub(r'\\([^a-zA-Z\s\(\)\[\]])', r'\1', text)  # Remove unnecessary escapes
-    
-    # Ensure all delimiters are properly paired
-    open_inline = text.count('\\(')
-    close_inline = text.count('\\)')
-    open_display = text.count('\\[')
-    close_display = text.count('\\]')
-    
-    if open_inline != close_inline or open_display != close_display:
-        logging.warning(f"Mismatched delimiters: {open_inline} \\( vs {close_inline} \\), {open_display} \\[ vs {close_display} \\]")
-    
+    """Normalize the explanation's math delimiters, warning about any left unbalanced."""
+    text, problems = normalize_latex(text)
+    if problems:
+        logging.warning(f"Mismatched delimiters: {'; '.join(problems)}")
     return text
 
 def fetch_records():
-    """Fetch records from Questions table that have explanations"""
-    url = f"https://api.airtable.com/v0/{BASE_ID}/{QUESTIONS_TABLE}"
-    params = {
-        "filterByFormula": "NOT({Explanation 4o} = '')",
-        "fields": ["Explanation 4o"]
-    }
-    
-    try:
-        response = requests.get(url, headers=HEADERS, params=params)
-        response.raise_for_status()
-        records = response.json().get("records", [])
-        logging.info(f"Fetched {len(records)} records with explanations")
-        return records
-    except requests.exceptions.HTTPError as e:
-        logging.error(f"Failed to fetch records: {e}")
-        return []
+    """Stream records from the Questions table that have explanations, page by page"""
+    return select(questions_table, formula="NOT({Explanation 4o} = '')",
+                  where=lambda f: f.get("Explanation 4o"), fields=["Explanation 4o"])
 
-def update_record(record_id, cleaned_explanation):
-    """Update a record with cleaned explanation"""
-    url = f"https://api.airtable.com/v0/{BASE_ID}/{QUESTIONS_TABLE}/{record_id}"
-    data = {
-        "fields": {
-            "Explanation 4o": cleaned_explanation
-        }
-    }
+def main():
+    parser = argparse.ArgumentParser(description="Normalize the LaTeX delimiters in Explanation 4o")
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+
+    logging.info("Starting explanation cleanup script...")
     
+    def report_update(record_id, record):
+        logging.info(f"Successfully updated record {record_id}")
+
+    # Process each record as its page arrives; updates are sent to Airtable 10 records at a time
+    writer = BatchWriter(BASE_ID, QUESTIONS_TABLE, AIRTABLE_API_KEY, on_written=report_update)
+    total = 0
     try:
-        response = requests.patch(url, headers=HEADERS, json=data)
-        response.raise_for_status()
-        return True
+        for record in fetch_records():
+            total += 1
+            record_id = record["id"]
+            explanation = record.get("fields", {}).get("Explanation 4o", "")
+            
+            # Clean the explanation
+            cleaned_explanation = clean_latex(explanation)
+            
+            # Skip if no changes were made
+            if cleaned_explanation == explanation:
+                logging.info(f"No changes needed for record {record_id}")
+                continue
+            
+            # Queue the update
+            writer.update(record_id, {"Explanation 4o": cleaned_explanation})
     except requests.exceptions.HTTPError as e:
-        logging.error(f"Failed to update record {record_id}: {e}")
-        return False
+        logging.error(f"Failed to fetch records: {e}")
+    writer.flush()
 
-def main():
-    logging.info("Starting explanation cleanup script...")
-    
-    # Fetch records
-    records = fetch_records()
-    if not records:
+    if not total:
         logging.info("No records to process.")
         return
-    
-    # Process each record
-    success_count = 0
-    for record in records:
-        record_id = record["id"]
-        explanation = record.get("fields", {}).get("Explanation 4o", "")
-        
-        # Clean the explanation
-        cleaned_explanation = clean_latex(explanation)
-        
-        # Skip if no changes were made
-        if cleaned_explanation == explanation:
-            logging.info(f"No changes needed for record {record_id}")
-            continue
-        
-        # Update the record
-        if update_record(record_id, cleaned_explanation):
-            success_count += 1
-            logging.info(f"Successfully updated record {record_id}")
         
-    logging.info(f"Cleanup completed. Updated {success_count} records out of {len(records)}")
+    logging.info(f"Cleanup completed. Updated {writer.written} records out of {total}")
+    report_stages(args.metrics_json, log=logging.info)
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -1,9 +1,19 @@
 import os
-import time
 import logging
-import anthropic
+import time
+from collections import Counter
 from dotenv import load_dotenv
-from pyairtable import Table
+
+from airtable_client import AirtableTable, BatchWriter
+from airtable_mirror import select
+from generation_engine import AdaptiveLimiter, run_pool
+from instrumentation import add_metrics_arguments, report_stages
+from latex_utils import CLEAN, FIXABLE, NEEDS_MODEL, classify_latex
+from llm_cache import cache_summary
+from model_backends import BackendError, get_backend
+from record_packing import (DEFAULT_PACK_TOKENS, PACKED_MAX_TOKENS, add_packing_arguments, build_packed_prompt,
+                            clean_pack, pack_items)
+from usage_ledger import add_budget_arguments, budget_exhausted, configure_ledger, usage_summary, write_usage_report
 
 # Configure logging
 logging.basicConfig(
@@ -23,52 +33,79 @@ API_KEY = os.getenv("AIRTABLE_API_KEY")
 BASE_ID = os.getenv("BASE_ID")
 QUESTIONS_TABLE = "tbllwZpPeh9yHJ3fM"  # Questions table ID
 
-# Anthropic API configuration
-ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY")
-
 # Initialize clients
-airtable = Table(API_KEY, BASE_ID, QUESTIONS_TABLE)
-claude = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
+airtable = AirtableTable(BASE_ID, QUESTIONS_TABLE, API_KEY)
+# Haiku is less likely to be overloaded. Overloads are not retried in place: they
+# go to the adaptive limiter and the record is deferred to a later round.
+claude = get_backend("anthropic", "claude-3-haiku-20240307", retry_overloaded=False)
 
-def clean_with_claude(text):
-    """Clean LaTeX formatting using Claude API"""
-    if not text or text.strip() == "":
-        return text
-    
-    prompt = """
+DEFAULT_WORKERS = 4  # Upper bound for concurrent Claude calls
+DEFERRED_RETRY_ROUNDS = 3  # Extra passes over records deferred by overload
+DEFERRED_RETRY_DELAY = 60  # Seconds before the first retry round; grows each round
+
+SYSTEM_PROMPT = "You are an expert in LaTeX formatting for MathJax who fixes math syntax issues in explanations."
+
+# Static instructions, sent ahead of every explanation as a cached prompt prefix
+INSTRUCTIONS = """
 You are an expert in LaTeX formatting for MathJax. Your task is to fix the LaTeX syntax in the following math explanation text.
 
 Guidelines:
-1. Make sure all math expressions use proper LaTeX syntax with $ for inline math and $$ for display math
+1. Make sure all math expressions use proper LaTeX syntax with \\( ... \\) for inline math and \\[ ... \\] for display math
 2. Ensure special symbols like \\times, \\sqrt, \\frac, etc. are properly formatted
 3. Fix any issues with exponents (^) and subscripts (_)
 4. Preserve the original meaning and content
 5. Return ONLY the cleaned text without any explanation
 6. Do not add or remove content
 7. Do not change the structure or organization of the explanation
+"""
 
+def build_prompt(text):
+    """Build the per-explanation part of the cleaning prompt, sent after ``INSTRUCTIONS``."""
+    return """
 Here is the text to clean:
 
 {text}
 
 Cleaned text:
 """.format(text=text)
-    
+
+PACKED_TASK = "Fix the LaTeX syntax in each of the following math explanation texts."
+
+def clean_with_claude(text):
+    """Clean LaTeX formatting using Claude API"""
+    if not text or text.strip() == "":
+        return text
+
     try:
-        response = claude.messages.create(
-            model="claude-3-haiku-20240307",  # Changed to Haiku model which is less likely to be overloaded
-            max_tokens=4000,
-            temperature=0.1,
-            system="You are an expert in LaTeX formatting for MathJax who fixes math syntax issues in explanations.",
-            messages=[
-                {"role": "user", "content": prompt}
-            ]
-        )
-        return response.content[0].text.strip()
-    except Exception as e:
+        # Text that was already cleaned on an earlier run is served from the cache
+        completion = claude.complete(build_prompt(text), system=SYSTEM_PROMPT, max_tokens=4000, temperature=0.1,
+                                     prefix=INSTRUCTIONS)
+        return completion.text.strip()
+    except BackendError as e:
         logging.error(f"Error calling Claude API: {e}")
         return text
 
+def clean_batch(records):
+    """Clean every record's explanation in one Message Batches job.
+
+    Returns a dict of Airtable record ID to cleaned text; records whose
+    request failed are left out.
+    """
+    explanations = {record['id']: record['fields'].get('Explanation 4o', '') for record in records}
+    prompts = {record_id: build_prompt(text) for record_id, text in explanations.items() if text.strip()}
+    logging.info(f"Submitting {len(prompts)} explanations as a batch job...")
+    outcomes = claude.complete_batch(prompts, system=SYSTEM_PROMPT, max_tokens=4000, temperature=0.1,
+                                     prefix=INSTRUCTIONS)
+
+    cleaned = {}
+    for record_id, text in explanations.items():
+        outcome = outcomes.get(record_id)
+        if isinstance(outcome, BackendError):
+            logging.error(f"Batch request for record {record_id} failed: {outcome}")
+            continue
+        cleaned[record_id] = outcome.text.strip() if outcome else text
+    return cleaned
+
 def test_cleaning():
     """Test the cleaning process with a sample explanation."""
     sample_text = """
@@ -117,73 +154,182 @@ Then:
     
     return cleaned_text
 
-def process_records(limit=None, preview=True, record_id=None):
-    """Process records with explanations and clean their LaTeX formatting"""
+def clean_explanation(explanation):
+    """Clean one explanation, raising BackendError on failure."""
+    if not explanation.strip():
+        return explanation
+    completion = claude.complete(build_prompt(explanation), system=SYSTEM_PROMPT, max_tokens=4000, temperature=0.1,
+                                 prefix=INSTRUCTIONS)
+    return completion.text.strip()
+
+def clean_packed_explanations(explanations, validate=None):
+    """Send several explanations to Claude in one packed request and return the raw response."""
+    completion = claude.complete(build_packed_prompt(PACKED_TASK, explanations), system=SYSTEM_PROMPT,
+                                 max_tokens=PACKED_MAX_TOKENS, temperature=0.1, validate=validate,
+                                 prefix=INSTRUCTIONS)
+    return completion.text
+
+def explanation_of(record):
+    return record['fields'].get('Explanation 4o', '')
+
+def clean_records(records):
+    """Pool worker: clean a group of records (usually one) and return their explanations in order.
+
+    Raises BackendError on failure, so an overload defers the whole group.
+    """
+    return clean_pack([explanation_of(record) for record in records], clean_packed_explanations, clean_explanation)
+
+def process_records(limit=None, preview=True, record_id=None, batch=False, workers=DEFAULT_WORKERS,
+                    prefilter=True, metrics_json=None, pack=False, pack_tokens=DEFAULT_PACK_TOKENS):
+    """Process records with explanations and clean their LaTeX formatting.
+
+    Records are cleaned on a pool whose concurrency shrinks when Claude reports
+    overload (429/529) and grows back on success. Records that hit an overload
+    are deferred and retried in later rounds instead of being left unchanged.
+    With ``batch`` every record is fetched first and cleaned in one batch job
+    (half the price, no per-minute limits) instead. With ``prefilter`` only
+    explanations that the local LaTeX normalizer cannot handle are sent to Claude.
+    With ``pack`` short explanations are sent several per request (see ``record_packing``).
+    The stage timing report is also written to ``metrics_json`` when given.
+    """
     # Build filter formula
     filter_formula = "NOT({Explanation 4o} = '')"
     if record_id:
         filter_formula = f"AND({filter_formula}, {{Record ID}} = '{record_id}')"
     
-    # Get records - using pyairtable
+    # Get records
     fields = ["Explanation 4o", "Record ID", "Test Number", "Question Number"]
-    all_records = airtable.all(formula=filter_formula, fields=fields)
-    
-    if limit:
-        all_records = all_records[:limit]
-    
-    logging.info(f"Found {len(all_records)} records with explanations to process")
+    # Records stream in page by page (or from the local mirror); the limit is applied at the source
+    def matches(f):
+        return f.get('Explanation 4o') and (not record_id or f.get('Record ID') == record_id)
+
+    all_records = select(airtable, formula=filter_formula, where=matches, fields=fields, max_records=limit)
     
     # Process records
     processed = 0
-    updated = 0
     skipped = 0
     errors = 0
-    
-    for record in all_records:
-        try:
-            processed += 1
-            record_id = record.get('fields', {}).get('Record ID', 'Unknown')
-            test_number = record.get('fields', {}).get('Test Number', 'Unknown')
-            question_number = record.get('fields', {}).get('Question Number', 'Unknown')
-            explanation = record.get('fields', {}).get('Explanation 4o', '')
-            
-            logging.info(f"Processing record {record_id} (Test {test_number}, Question {question_number})...")
-            logging.info(f"Original text (first 150 chars): {explanation[:150]}...")
-            
-            # Clean explanation
-            cleaned_explanation = clean_with_claude(explanation)
-            
-            # Skip if no changes needed
-            if cleaned_explanation == explanation:
-                logging.info(f"No changes needed for record {record_id}")
-                skipped += 1
-                continue
-            
-            # If preview mode, just log changes
-            if preview:
-                logging.info(f"PREVIEW - Record {record_id} would be updated")
-                logging.info(f"PREVIEW - Original (first 150 chars): {explanation[:150]}...")
-                logging.info(f"PREVIEW - Cleaned (first 150 chars): {cleaned_explanation[:150]}...")
+
+    def report_update(airtable_id, record):
+        logging.info(f"Updated record {record['fields'].get('Record ID', airtable_id)}")
+
+    # Live updates are sent to Airtable 10 records at a time
+    writer = BatchWriter(BASE_ID, QUESTIONS_TABLE, API_KEY, on_written=report_update)
+
+    def apply_cleaned(record, cleaned_explanation):
+        nonlocal processed, skipped
+        processed += 1
+        record_id = record.get('fields', {}).get('Record ID', 'Unknown')
+        test_number = record.get('fields', {}).get('Test Number', 'Unknown')
+        question_number = record.get('fields', {}).get('Question Number', 'Unknown')
+        explanation = record.get('fields', {}).get('Explanation 4o', '')
+
+        logging.info(f"Processed record {record_id} (Test {test_number}, Question {question_number})")
+        logging.info(f"Original text (first 150 chars): {explanation[:150]}...")
+
+        # Skip if no changes needed
+        if cleaned_explanation == explanation:
+            logging.info(f"No changes needed for record {record_id}")
+            skipped += 1
+            return
+
+        # If preview mode, just log changes
+        if preview:
+            logging.info(f"PREVIEW - Record {record_id} would be updated")
+            logging.info(f"PREVIEW - Original (first 150 chars): {explanation[:150]}...")
+            logging.info(f"PREVIEW - Cleaned (first 150 chars): {cleaned_explanation[:150]}...")
+        else:
+            # Queue the update
+            writer.update(record['id'], {'Explanation 4o': cleaned_explanation})
+
+    prefilter_counts = Counter()
+    over_budget = []
+
+    def needing_claude(records):
+        """Apply already-clean and locally fixable explanations at once; yield the rest for Claude.
+
+        Once the budget is spent, records that need Claude are set aside instead.
+        """
+        for record in records:
+            if prefilter:
+                category, text = classify_latex(explanation_of(record))
+            else:
+                category, text = NEEDS_MODEL, None
+            prefilter_counts[category] += 1
+            if category != NEEDS_MODEL:
+                apply_cleaned(record, text)
+            elif budget_exhausted():
+                over_budget.append(record)
             else:
-                # Update record
-                airtable.update(record['id'], {'Explanation 4o': cleaned_explanation})
-                logging.info(f"Updated record {record_id}")
-                updated += 1
-                
-                # Sleep to avoid rate limits
-                time.sleep(0.2)
-                
-        except Exception as e:
-            logging.error(f"Error processing record: {e}")
-            errors += 1
+                yield record
+
+    deferred = []
+    limiter = AdaptiveLimiter(max_limit=workers)
+    if batch:
+        model_records = list(needing_claude(all_records))
+        batch_cleaned = clean_batch(model_records)
+        for record in model_records:
+            if record['id'] in batch_cleaned:
+                apply_cleaned(record, batch_cleaned[record['id']])
+            else:
+                errors += 1
+    else:
+        queue = needing_claude(all_records)
+        for round_number in range(DEFERRED_RETRY_ROUNDS + 1):
+            if round_number:
+                if budget_exhausted():
+                    break
+                delay = DEFERRED_RETRY_DELAY * round_number
+                logging.info(f"Retrying {len(deferred)} overload-deferred records in {delay}s "
+                             f"(round {round_number}/{DEFERRED_RETRY_ROUNDS})...")
+                time.sleep(delay)
+                queue, deferred = deferred, []
+
+            if pack:
+                groups = pack_items(queue, explanation_of, pack_tokens)
+            else:
+                groups = ([record] for record in queue)
+            for records, cleaned_explanations, error in run_pool(groups, clean_records, max_workers=workers,
+                                                                 limiter=limiter):
+                record_label = ", ".join(record['fields'].get('Record ID', record['id']) for record in records)
+                if error is None:
+                    for record, cleaned_explanation in zip(records, cleaned_explanations):
+                        apply_cleaned(record, cleaned_explanation)
+                elif getattr(error, 'overloaded', False):
+                    logging.warning(f"Claude overloaded for record {record_label}; deferred "
+                                    f"(concurrency now {limiter.limit})")
+                    deferred.extend(records)
+                else:
+                    logging.error(f"Error processing record {record_label}: {error}")
+                    errors += len(records)
+
+            if not deferred:
+                break
+
+    writer.flush()
+    errors += len(writer.failed)
     
     # Log summary
     logging.info("=" * 50)
     logging.info("Summary:")
     logging.info(f"Processed: {processed}")
-    logging.info(f"Updated: {updated}")
+    logging.info(f"Updated: {writer.written}")
     logging.info(f"Skipped (no changes): {skipped}")
     logging.info(f"Errors: {errors}")
+    logging.info(f"Pre-filter: {prefilter_counts[CLEAN]} already clean, {prefilter_counts[FIXABLE]} fixed locally, "
+                 f"{prefilter_counts[NEEDS_MODEL]} sent to Claude")
+    logging.info(f"Deferred (Claude overloaded, not cleaned): {len(deferred)}")
+    if deferred:
+        logging.info("Rerun to retry: " + ", ".join(r['fields'].get('Record ID', r['id']) for r in deferred))
+    if over_budget:
+        logging.info(f"Budget reached: {len(over_budget)} records that need Claude were not cleaned")
+    if limiter.overloads:
+        logging.info(f"Overload responses: {limiter.overloads} (final concurrency {limiter.limit})")
+    if cache_summary():
+        logging.info(cache_summary())
+    logging.info(usage_summary())
+    logging.info(f"Usage report: {write_usage_report()}")
+    report_stages(metrics_json, log=logging.info)
     logging.info("=" * 50)
 
 if __name__ == "__main__":
@@ -194,19 +340,36 @@ if __name__ == "__main__":
     parser.add_argument("--record", type=str, help="Process specific record ID")
     parser.add_argument("--live", action="store_true", help="Actually update records (default is preview only)")
     parser.add_argument("--test", action="store_true", help="Run a test clean on a sample explanation")
+    parser.add_argument("--batch", action="store_true",
+                        help="Clean all records in one Message Batches job (cheaper, results can take hours)")
+    parser.add_argument("--no-prefilter", action="store_true",
+                        help="Send every explanation to Claude, even ones that are already clean or fixable locally")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                        help="Maximum concurrent Claude calls; lowered automatically while Claude is overloaded")
+    add_packing_arguments(parser)
+    add_budget_arguments(parser)
+    add_metrics_arguments(parser)
     
     args = parser.parse_args()
+    configure_ledger(table="Questions", max_cost=args.max_cost, max_tokens=args.max_tokens)
     
     if args.test:
         test_cleaning()
         exit(0)
     
-    logging.info(f"Starting cleanup with options: limit={args.limit}, record={args.record}, live={args.live}")
+    logging.info(f"Starting cleanup with options: limit={args.limit}, record={args.record}, "
+                 f"live={args.live}, batch={args.batch}")
     
     process_records(
         limit=args.limit,
         preview=not args.live,
-        record_id=args.record
+        record_id=args.record,
+        batch=args.batch,
+        workers=args.workers,
+        prefilter=not args.no_prefilter,
+        metrics_json=args.metrics_json,
+        pack=args.pack,
+        pack_tokens=args.pack_tokens
     )
     
     logging.info("Cleanup completed!") 
\ No newline at end of file
@@ -1,8 +1,11 @@
-from airtable import Airtable
-import re
+import argparse
 from dotenv import load_dotenv
 import os
-import time
+
+from airtable_client import AirtableTable, BatchWriter
+from airtable_mirror import select
+from instrumentation import add_metrics_arguments, report_stages
+from latex_utils import clean_latex
 
 # Load environment variables
 load_dotenv()
@@ -13,40 +16,24 @@ BASE_ID = os.getenv('BASE_ID')
 QUESTIONS_TABLE = 'tbllwZpPeh9yHJ3fM'  # Questions table ID
 
 # Initialize Airtable client
-airtable = Airtable(BASE_ID, QUESTIONS_TABLE, api_key=AIRTABLE_API_KEY)
-
-def clean_latex(text):
-    if not text:
-        return text
-        
-    # Replace $$ with \[ and \]
-    text = re.sub(r'\$\$(.*?)\$\$', r'\\[\1\\]', text)
-    
-    # Replace $ with \( and \) but not \$
-    text = re.sub(r'(?<!\\)\$(.*?)(?<!\\)\$', r'\\(\1\\)', text)
-    
-    # Fix spacing around delimiters
-    text = re.sub(r'([^\s])(\\[\(\[])', r'\1 \2', text)  # Add space before
-    text = re.sub(r'(\\[\)\]])([\w])', r'\1 \2', text)   # Add space after
-    
-    # Remove extra spaces inside delimiters
-    text = re.sub(r'\\[\(\[]\s+', r'\\(', text)
-    text = re.sub(r'\s+\\[\)\]]', r'\\)', text)
-    
-    # Fix common LaTeX issues
-    text = text.replace('\\\\', '\\')  # Remove double backslashes
-    text = re.sub(r'\\([^a-zA-Z\s\(\)\[\]])', r'\1', text)  # Remove unnecessary escapes
-    
-    return text
+airtable = AirtableTable(BASE_ID, QUESTIONS_TABLE, AIRTABLE_API_KEY)
 
 def main():
+    parser = argparse.ArgumentParser(description="Normalize the LaTeX delimiters in every Explanation 4o")
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+
     print("Starting explanation cleanup...")
     
     # Get all records with explanations
-    records = airtable.get_all(fields=['Explanation 4o'])
+    records = list(select(airtable, fields=['Explanation 4o']))
     print(f"Found {len(records)} records")
     
-    updated_count = 0
+    def report_update(record_id, record):
+        print(f"Updated record {record_id}")
+
+    # Updates are sent to Airtable 10 records at a time
+    writer = BatchWriter(BASE_ID, QUESTIONS_TABLE, AIRTABLE_API_KEY, on_written=report_update)
     for record in records:
         explanation = record.get('fields', {}).get('Explanation 4o')
         if not explanation:
@@ -54,15 +41,15 @@ def main():
             
         cleaned_explanation = clean_latex(explanation)
         if cleaned_explanation != explanation:
-            try:
-                airtable.update(record['id'], {'Explanation 4o': cleaned_explanation})
-                updated_count += 1
-                print(f"Updated record {record['id']}")
-                time.sleep(0.2)  # Rate limiting
-            except Exception as e:
-                print(f"Error updating record {record['id']}: {e}")
+            writer.update(record['id'], {'Explanation 4o': cleaned_explanation})
+    writer.flush()
+
+    for record_id, _, error in writer.failed:
+        print(f"Error updating record {record_id}: {error}")
+    updated_count = writer.written
     
     print(f"\nCleanup completed. Updated {updated_count} records.")
+    report_stages(args.metrics_json)
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
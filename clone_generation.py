@@ -0,0 +1,409 @@
+"""Question selection and the generation pipeline shared by the CopyCat generator scripts.
+
+Every generator takes ``--tests`` naming the tests to clone: test numbers and
+ranges (``12``, ``1-5,8,12``), ``all`` for the whole question bank, or
+``unprocessed`` for every matching question the script's AI model has not
+cloned yet. All selected questions are fetched in one paged pass (or from the
+local mirror) and fed through a single generation pool, so one unattended run
+can cover the whole bank. Without ``--tests`` the script asks for a test
+number, as before.
+
+Before any model call the CopyCats table is read once to count the clones
+each original already has from the script's AI model. Questions that already
+have ``--clones-per-question`` clones are skipped, so re-running a test does
+not pay for duplicate generations or insert duplicate CopyCats.
+
+Raw responses are parsed by ``parse_clone`` in the process-pool stage
+(``generation_engine.parse_in_processes``): the script's own section parser,
+then ``check_clone`` to validate the answer letter against the choices and
+normalize the LaTeX.
+
+With ``--json`` the prompt ends with ``JSON_RESPONSE_FORMAT`` instead of the
+markdown section layout, the backend is put in JSON mode with
+``CLONE_SCHEMA``, and ``parse_json_clone`` reads the reply with one
+``json.loads`` instead of the section regexes.
+
+With ``--early-abort`` the markdown response is streamed and
+``check_partial_clone`` looks at it as it grows. A generation that is clearly
+malformed is cut off and retried at once instead of being read to the end:
+no section heading after ``MAX_CHARS_BEFORE_HEADING`` characters, an answer
+before any new question, a new question that opens with a preamble or a
+number, or an answer that is not a single letter A-E. Only the headings the
+script's parser reads count (bold ``**Answer:**`` by default, also a bare
+``Answer:`` line with ``LOOSE_SECTION_HEADING``), and only the first New
+Question and Answer sections are checked, since those are the ones parsed.
+
+``run_generation`` is the pipeline every generator runs once its backend is
+configured: select the questions, skip clones the checkpoint journal already
+has, call ``fetch`` on the worker pool, parse in the process pool, insert the
+CopyCats in batches and print the journal, cache, usage and stage summaries.
+A script only supplies its prompt, its parser and its backend call.
+"""
+import functools
+import json
+import re
+from collections import Counter
+
+from airtable_client import BatchWriter
+from airtable_mirror import select
+from checkpoints import CheckpointJournal, journal_path
+from generation_engine import parse_in_processes, run_pool
+from instrumentation import report_stages, timed
+from latex_utils import clean_latex
+from llm_cache import cache_summary
+from usage_ledger import budget_exhausted, configure_ledger, usage_summary, write_usage_report
+
+AI_CHECK_MATCH = '✅ Match'
+SELECTION_KEYWORDS = ("all", "unprocessed")
+DEFAULT_CLONES_PER_QUESTION = 1
+DEFAULT_PARSE_PROCESSES = 2
+
+ANSWER_LETTERS = ('A', 'B', 'C', 'D', 'E')
+# Choice labels after whitespace: "(A)", "A)", "A." or "A:", one per line or several
+# on a line ("A. 3   B. 4")
+CHOICE_LABEL = re.compile(r'(?:^|(?<=\s))\(?([A-E])[).:]', re.MULTILINE)
+
+# Section headings of the markdown layout, as the R1 and Gemma parsers read them: "**Answer:**"
+SECTION_HEADING = re.compile(r'\*\*(Analysis|New Question|Answer|Explanation):\*\*')
+# The photo parser also accepts a bare "Answer:" line
+LOOSE_SECTION_HEADING = re.compile(r'\*\*(Analysis|New Question|Answer|Explanation):\*\*'
+                                   r'|^[ \t]*(Analysis|New Question|Answer|Explanation):', re.MULTILINE)
+# How a new question must not begin: "9.", "Here is a new question", "Consider the following"
+QUESTION_PREAMBLE = re.compile(r"(\d+\s*[.)]\s|here is\b|here's\b|here are\b|sure\b|consider the following\b)",
+                               re.IGNORECASE)
+MAX_CHARS_BEFORE_HEADING = 800
+
+# Structured output requested with --json; E is optional because some tests have four choices
+CLONE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "analysis": {"type": "string"},
+        "question": {"type": "string"},
+        "choices": {
+            "type": "object",
+            "properties": {letter: {"type": "string"} for letter in ANSWER_LETTERS},
+            "required": ["A", "B", "C", "D"],
+        },
+        "answer": {"type": "string", "enum": list(ANSWER_LETTERS)},
+        "explanation": {"type": "string"},
+    },
+    "required": ["analysis", "question", "choices", "answer", "explanation"],
+}
+
+JSON_RESPONSE_FORMAT = """Respond with a single JSON object and nothing else, using these fields:
+
+{
+  "analysis": "Your analysis of the original question",
+  "question": "The new question only, without its answer choices",
+  "choices": {"A": "...", "B": "...", "C": "...", "D": "...", "E": "..."},
+  "answer": "The letter of the correct choice",
+  "explanation": "How to solve the new question"
+}
+
+Put the answer choices in "choices" only, not in "question". Leave out "E" if the original question has
+four choices. Use the same LaTeX formatting in every field and escape backslashes as JSON requires."""
+
+
+def add_selection_arguments(parser):
+    """Add ``--tests`` and ``--clones-per-question`` to a generator's argument parser."""
+    parser.add_argument("--tests",
+                        help="Tests to clone: numbers and ranges such as 12 or 1-5,8, 'all', or 'unprocessed' "
+                             "(prompted for when omitted)")
+    parser.add_argument("--clones-per-question", type=int, default=DEFAULT_CLONES_PER_QUESTION,
+                        help="Skip questions that already have this many clones from this AI model "
+                             f"and top up the rest (default: {DEFAULT_CLONES_PER_QUESTION})")
+
+
+def add_pipeline_arguments(parser):
+    """Add ``--parse-processes`` and ``--json`` to a generator's argument parser."""
+    parser.add_argument("--parse-processes", type=int, default=DEFAULT_PARSE_PROCESSES,
+                        help="Processes that parse and validate responses while the network workers "
+                             f"keep calling the model (default: {DEFAULT_PARSE_PROCESSES})")
+    parser.add_argument("--json", action="store_true",
+                        help="Ask the model for a JSON object (JSON mode or structured output) "
+                             "instead of markdown sections")
+    parser.add_argument("--early-abort", action="store_true",
+                        help="Stream responses and cut off ones whose sections are clearly malformed, "
+                             "retrying at once (markdown layout only)")
+
+
+def parse_tests(spec):
+    """Expand ``"1-5,8"`` into ``['1', '2', '3', '4', '5', '8']``."""
+    tests = []
+    for part in spec.replace(" ", "").split(","):
+        if not part:
+            continue
+        start, dash, end = part.partition("-")
+        if dash and start.isdigit() and end.isdigit():
+            if int(end) < int(start):
+                raise ValueError(f"Invalid test range '{part}'")
+            tests.extend(str(n) for n in range(int(start), int(end) + 1))
+        else:
+            tests.append(part)
+    if not tests:
+        raise ValueError(f"No test numbers in '{spec}'")
+    return tests
+
+
+def resolve_selection(args):
+    """Return the ``--tests`` value, asking for a test number when it was not given."""
+    if not args.tests:
+        args.tests = input("Enter the Test Number: ").strip()
+    return args.tests
+
+
+def job_name(prefix, spec):
+    """Checkpoint job name for a selection, e.g. ``r1_test_12`` or ``r1_tests_1-5,8``."""
+    spec = spec.strip().lower()
+    if spec in SELECTION_KEYWORDS:
+        return f"{prefix}_{spec}"
+    tests = parse_tests(spec)
+    if len(tests) == 1:
+        return f"{prefix}_test_{tests[0]}"
+    return f"{prefix}_tests_{spec.replace(' ', '')}"
+
+
+def existing_clones(copycats_table, ai_model, extra_clones=None):
+    """Count the CopyCats ``ai_model`` has produced for each original question record ID.
+
+    ``extra_clones`` maps another 'AI Model' value to the IDs of CopyCats written
+    under it that count as ``ai_model``'s own, such as R1's hedge wins.
+    """
+    counts = Counter()
+    for model, ids in {ai_model: None, **(extra_clones or {})}.items():
+        records = select(copycats_table, formula=f"{{AI Model}} = '{model}'",
+                         where=lambda f, model=model: f.get('AI Model') == model,
+                         fields=['Original Question', 'AI Model'])
+        for record in records:
+            if ids is None or record['id'] in ids:
+                counts.update(record['fields'].get('Original Question', []))
+    print(f"{len(counts)} questions already have {ai_model} clones ({sum(counts.values())} CopyCats)")
+    return counts
+
+
+def select_questions(questions_table, spec, existing=None):
+    """Stream the AI-checked questions selected by ``spec`` in one paged pass.
+
+    ``unprocessed`` keeps only questions with no clone in ``existing`` (the
+    counts from ``existing_clones``).
+    """
+    spec = spec.strip().lower()
+    tests = None if spec in SELECTION_KEYWORDS else parse_tests(spec)
+
+    formula = f"{{AI Check}} = '{AI_CHECK_MATCH}'"
+    if tests:
+        test_filter = ", ".join(f"{{Test Number}} = '{test}'" for test in tests)
+        formula = f"AND(OR({test_filter}), {formula})"
+    wanted = set(tests or ())
+
+    def where(fields):
+        return fields.get('AI Check') == AI_CHECK_MATCH and (
+            not wanted or str(fields.get('Test Number', '')) in wanted)
+
+    records = select(questions_table, formula=formula, where=where)
+    if spec != "unprocessed":
+        return records
+    if existing is None:
+        raise ValueError("'unprocessed' needs the existing clone counts")
+    return (record for record in records if not existing.get(record['id']))
+
+
+def plan_clones(records, existing, clones_per_question=DEFAULT_CLONES_PER_QUESTION):
+    """Yield ``(record, clone_index)`` for every clone still missing.
+
+    ``clone_index`` counts this model's clones of the question from 0, so a
+    question with one clone and a target of three yields indexes 1 and 2.
+    """
+    for record in records:
+        have = existing.get(record['id'], 0)
+        if have >= clones_per_question:
+            print(f"Skipping question {record['id']}: already has {have} clone(s)")
+            continue
+        for clone_index in range(have, clones_per_question):
+            yield record, clone_index
+
+
+def clone_key(record_id, clone_index):
+    """Journal and writer key for one clone; the first clone keeps the plain record ID."""
+    return record_id if clone_index == 0 else f"{record_id}#{clone_index + 1}"
+
+
+def clone_variant(clone_index):
+    """LLM cache variant so extra clones of a question get fresh responses."""
+    return None if clone_index == 0 else f"clone-{clone_index + 1}"
+
+
+def check_clone(clone):
+    """Validate a parsed clone and normalize its LaTeX, raising ValueError if unusable."""
+    answer = clone.get('answer', '').strip()
+    if answer not in ANSWER_LETTERS:
+        raise ValueError(f"Answer '{answer}' is not a single letter A-E.")
+    # Only check against the labels when they were all found: A, B, C, ... with none missing
+    choices = sorted(set(CHOICE_LABEL.findall(clone.get('new_question', ''))))
+    if choices and choices == list(ANSWER_LETTERS[:len(choices)]) and answer not in choices:
+        raise ValueError(f"Answer '{answer}' is not one of the choices {''.join(choices)}.")
+    clone['answer'] = answer
+    for field in ('new_question', 'explanation'):
+        if clone.get(field):
+            clone[field] = clean_latex(clone[field])
+    return clone
+
+
+def parse_json_clone(response_text):
+    """Read a ``--json`` response into the clone fields, raising ValueError if unusable.
+
+    The choices are appended to the question as ``(A) ...`` lines, the layout
+    the markdown prompts ask for.
+    """
+    try:
+        data = json.loads(response_text)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Response is not valid JSON: {e}") from e
+    if not isinstance(data, dict):
+        raise ValueError("Response is not a JSON object.")
+
+    question = data.get('question')
+    choices = data.get('choices')
+    if not isinstance(question, str) or not question.strip():
+        raise ValueError("JSON response has no question.")
+    if not isinstance(choices, dict) or not choices:
+        raise ValueError("JSON response has no choices.")
+    unknown = [label for label in choices if label not in ANSWER_LETTERS]
+    if unknown:
+        raise ValueError(f"Unknown choice labels {unknown}.")
+
+    choice_lines = [f"({letter}) {str(choices[letter]).strip()}" for letter in ANSWER_LETTERS if letter in choices]
+    analysis = str(data.get('analysis') or '').strip()
+    return {
+        'analysis': analysis,
+        'new_question': question.strip() + "\n" + "\n".join(choice_lines),
+        'answer': str(data.get('answer') or '').strip(),
+        'explanation': str(data.get('explanation') or '').strip() or analysis,
+    }
+
+
+def check_partial_clone(text, heading=SECTION_HEADING):
+    """Return why a partly streamed markdown response is already unusable, or None while it may still parse.
+
+    ``heading`` matches the section headings the script's parser reads; only the
+    first New Question and Answer sections are checked.
+    """
+    headings = [(match.group(match.lastindex), match.start(), match.end()) for match in heading.finditer(text)]
+    if not headings:
+        if len(text.strip()) > MAX_CHARS_BEFORE_HEADING:
+            return f"no section heading in the first {MAX_CHARS_BEFORE_HEADING} characters"
+        return None
+
+    names = [name for name, _, _ in headings]
+    if 'Answer' in names and 'New Question' not in names[:names.index('Answer')]:
+        return "Answer section before any New Question"
+
+    for name in ('New Question', 'Answer'):
+        if name not in names:
+            continue
+        i = names.index(name)
+        section_end = headings[i + 1][1] if i + 1 < len(headings) else None
+        body = text[headings[i][2]:section_end].lstrip()
+        if name == 'New Question' and ('\n' in body or section_end is not None):
+            first_line = body.split('\n', 1)[0]
+            if QUESTION_PREAMBLE.match(first_line):
+                return f"New Question starts with a preamble: {first_line[:40]!r}"
+        elif name == 'Answer' and body:
+            if body[0] not in ANSWER_LETTERS:
+                return f"Answer starts with {body[:10]!r}, not a letter A-E"
+            if len(body) > 1 and (body[1].isalnum() or body[1] == '_'):
+                return f"Answer is {body[:10]!r}, not a single letter"
+    return None
+
+
+def parse_clone(parse, response_text):
+    """Parse a raw response with the script's ``parse`` and check the result.
+
+    Module-level so ``functools.partial(parse_clone, parse_response)`` can be
+    sent to the parse processes. The two steps are timed as the ``parse`` and
+    ``validate`` stages.
+    """
+    with timed("parse"):
+        clone = parse(response_text)
+    with timed("validate"):
+        return check_clone(clone)
+
+
+def run_generation(args, job_prefix, questions_table, copycats_table, ai_model, fetch, parse, model_of=None,
+                   extra_clones=None, on_written=None):
+    """Generate and insert the clones selected by ``args`` (see the module docstring).
+
+    ``fetch(record, clone_index, journal)`` runs on the worker pool and returns
+    the raw response text, or None when the model gave nothing usable.
+    ``parse`` is the script's section parser, sent to the parse processes.
+    ``model_of(key)`` returns the 'AI Model' to write for a clone when it is
+    not always ``ai_model``; ``extra_clones`` (see ``existing_clones``) are
+    CopyCats under other models that count toward ``--clones-per-question``.
+    ``on_written(key, record)`` is called with each inserted CopyCat.
+    """
+    configure_ledger(table="CopyCats", max_cost=args.max_cost, max_tokens=args.max_tokens)
+
+    # Select every question for the requested tests in one paged pass
+    selection = resolve_selection(args)
+    # Count existing clones once so questions that already have enough never reach the model
+    existing = existing_clones(copycats_table, ai_model, extra_clones)
+    records = select_questions(questions_table, selection, existing)
+
+    # The journal records which clones were already written so --resume never duplicates them
+    journal = CheckpointJournal(journal_path(job_name(job_prefix, selection)), resume=args.resume)
+
+    def pending_clones():
+        for record, clone_index in plan_clones(records, existing, args.clones_per_question):
+            if budget_exhausted():
+                return  # Calls already in flight still finish and are written
+            key = clone_key(record['id'], clone_index)
+            if journal.is_done(key):
+                print(f"Skipping clone {key}: already written in an earlier run")
+                continue
+            journal.record(key, "fetched")
+            yield record, clone_index
+
+    def report_insert(key, record):
+        journal.record(key, "written", copycat_id=record['id'])
+        if on_written:
+            on_written(key, record)
+        print(f"Successfully added copycat question for original question {key}")
+
+    # Clones are queued as each call finishes and inserted 10 per request
+    with BatchWriter(copycats_table.base_id, copycats_table.table, copycats_table.api_key,
+                     on_written=report_insert) as copycat_writer:
+        responses = run_pool(pending_clones(), lambda job: fetch(*job, journal),
+                             max_workers=args.workers, requests_per_minute=args.rpm)
+        # Responses are parsed and checked on separate processes while the workers keep calling the model
+        for (record, clone_index), clone, error in parse_in_processes(
+                responses, functools.partial(parse_clone, parse), args.parse_processes):
+            original_id = record['id']
+            key = clone_key(original_id, clone_index)
+            if error:
+                journal.record(key, "failed", error=str(error))
+                print(f"Error processing question {original_id}: {error}")
+                continue
+            if not clone:
+                journal.record(key, "failed", error=f"No usable response from {ai_model}")
+                continue
+            journal.record(key, "parsed")
+
+            copycat_writer.create({
+                'Clone Question LM': clone['new_question'],
+                'Answer': clone['answer'],
+                'Original Question': [original_id],
+                'AI Model': model_of(key) if model_of else ai_model,
+                'Explanation': clone['explanation']
+            }, key=key)
+
+    for key, _, error in copycat_writer.failed:
+        journal.record(key, "failed", error=str(error))
+    print(f"Checkpoint summary: {journal.counts()} (journal: {journal.path})")
+    journal.close()
+
+    if cache_summary():
+        print(cache_summary())
+    print(usage_summary())
+    print(f"Usage report: {write_usage_report()}")
+    report_stages(args.metrics_json)
+    print("Processing complete.")
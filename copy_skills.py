@@ -1,7 +1,8 @@
-from airtable import Airtable
 import os
 from dotenv import load_dotenv
-import time
+
+from airtable_client import AirtableTable, BatchWriter
+from airtable_mirror import select
 
 # Load environment variables
 load_dotenv()
@@ -22,61 +23,89 @@ COPYCATS_TABLE = 'tblpE46FDmB0LmeTU'   # CopyCats table
 SKILLS_TABLE = 'tbl6l9Pu2uHM2XlvV'     # Skills table
 
 # Initialize Airtable clients
-questions_table = Airtable(BASE_ID, QUESTIONS_TABLE, api_key=AIRTABLE_API_KEY)
-copycats_table = Airtable(BASE_ID, COPYCATS_TABLE, api_key=AIRTABLE_API_KEY)
+questions_table = AirtableTable(BASE_ID, QUESTIONS_TABLE, AIRTABLE_API_KEY)
+copycats_table = AirtableTable(BASE_ID, COPYCATS_TABLE, AIRTABLE_API_KEY)
+
+_questions = None
+_questions_by_number = None
+
+def load_questions():
+    """Fetch every original question once, indexed by record ID.
+
+    Only the fields the joins need are requested, so this is a handful of
+    paged requests (or a local mirror query) instead of one GET per clone.
+    """
+    global _questions
+    if _questions is None:
+        records = select(questions_table, fields=['Skill', 'Test Number', 'Question Number'])
+        _questions = {record['id']: record['fields'] for record in records}
+    return _questions
 
 def get_original_question_id(test_num, question_num):
     """Get the record ID of the original question based on test and question numbers."""
-    formula = f"AND({{Test Number}} = '{test_num}', {{Question Number}} = '{question_num}')"
-    records = questions_table.get_all(formula=formula)
-    return records[0]['id'] if records else None
+    global _questions_by_number
+    if _questions_by_number is None:
+        _questions_by_number = {
+            (str(fields.get('Test Number', '')), str(fields.get('Question Number', ''))): record_id
+            for record_id, fields in load_questions().items()
+        }
+    return _questions_by_number.get((str(test_num), str(question_num)))
 
 def copy_skills():
-    # Get all CopyCat records
-    copycat_records = copycats_table.get_all()
-    print(f"Found {len(copycat_records)} CopyCat records")
+    # Prefetch all original questions and join them to the CopyCats in memory
+    questions = load_questions()
+    copycat_records = list(select(copycats_table, fields=['Original Question', 'Skill']))
+    print(f"Found {len(copycat_records)} CopyCat records and {len(questions)} original questions")
     
-    updated_count = 0
     skipped_count = 0
+    unchanged_count = 0
     error_count = 0
+
+    def report_update(record_id, record):
+        print(f"Updated record {record_id} with skills: {record['fields'].get('Skill')}")
+
+    # Only changed records are written, 10 at a time
+    writer = BatchWriter(BASE_ID, COPYCATS_TABLE, AIRTABLE_API_KEY, on_written=report_update)
     
     for record in copycat_records:
-        try:
-            # Get the Original Question reference
-            original_question_id = record['fields'].get('Original Question')
-            if not original_question_id:
-                print(f"Skipping record {record['id']}: No Original Question reference")
-                skipped_count += 1
-                continue
-                
-            # Get the original question record
-            original_question = questions_table.get(original_question_id[0])
-            
-            # Get the skills from the original question
-            skills = original_question['fields'].get('Skill', [])
-            
-            # Update the CopyCat record with the skills
-            if skills:
-                copycats_table.update(record['id'], {
-                    'Skill': skills
-                })
-                print(f"Updated record {record['id']} with skills: {skills}")
-                updated_count += 1
-            else:
-                print(f"Skipping record {record['id']}: No skills found in original question {original_question_id[0]}")
-                skipped_count += 1
-            
-            # Add a small delay to avoid rate limits
-            time.sleep(0.2)
-            
-        except Exception as e:
-            print(f"Error processing record {record['id']}: {str(e)}")
+        # Get the Original Question reference
+        original_question_id = record['fields'].get('Original Question')
+        if not original_question_id:
+            print(f"Skipping record {record['id']}: No Original Question reference")
+            skipped_count += 1
+            continue
+
+        original_question = questions.get(original_question_id[0])
+        if original_question is None:
+            print(f"Error processing record {record['id']}: Original question {original_question_id[0]} not found")
             error_count += 1
             continue
+            
+        # Get the skills from the original question
+        skills = original_question.get('Skill', [])
+        if not skills:
+            print(f"Skipping record {record['id']}: No skills found in original question {original_question_id[0]}")
+            skipped_count += 1
+            continue
+
+        # Skip clones whose skills already match
+        if set(record['fields'].get('Skill', [])) == set(skills):
+            unchanged_count += 1
+            continue
+
+        writer.update(record['id'], {
+            'Skill': skills
+        })
+
+    writer.flush()
+    for record_id, _, error in writer.failed:
+        print(f"Error processing record {record_id}: {error}")
+    error_count += len(writer.failed)
     
     print("\nSummary:")
     print(f"Total records processed: {len(copycat_records)}")
-    print(f"Successfully updated: {updated_count}")
+    print(f"Successfully updated: {writer.written}")
+    print(f"Already up to date: {unchanged_count}")
     print(f"Skipped: {skipped_count}")
     print(f"Errors: {error_count}")
 
@@ -0,0 +1,273 @@
+"""Bounded worker pool shared by the CopyCat generator scripts.
+
+Model calls (DeepSeek R1, Gemma 3 via Ollama) are slow and spend almost all of
+their time waiting on the network, so the generators hand their records to
+``run_pool`` which keeps several calls in flight at once and yields each result
+as soon as it finishes. Inserts into the CopyCats table can then happen while
+the remaining calls are still running.
+
+``parse_in_processes`` is the optional second stage: raw responses from the
+network workers are parsed and validated on a process pool, so CPU work never
+holds up the threads waiting on the network.
+
+``AdaptiveLimiter`` lets the pool size itself: concurrency is halved when the
+API reports overload (429/529) and grows back by one after a run of successes.
+
+``hedged`` cuts tail latency for a single call. If the primary has not
+produced an acceptable answer by a deadline (usually the p90 of its recent
+latencies from a ``LatencyTracker``), the same request also goes to a
+secondary. The first accepted answer wins and the other call is told to stop.
+"""
+import logging
+import math
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+from instrumentation import count, drain_samples, merge_samples
+
+
+class RateLimiter:
+    """Spaces out call starts so no more than ``per_minute`` begin each minute."""
+
+    def __init__(self, per_minute=None):
+        self.interval = 60.0 / per_minute if per_minute else 0.0
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+
+    def wait(self):
+        """Block until the caller is allowed to start its next request."""
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class AdaptiveLimiter:
+    """AIMD concurrency limit driven by overload errors.
+
+    Any error with a true ``overloaded`` attribute (``BackendError`` for 429
+    and 529 responses) halves ``limit`` and pauses new calls for ``backoff``
+    seconds, doubling the pause while overloads continue. After ``limit``
+    successes in a row the limit grows by one, up to ``max_limit``. A burst
+    of overloads from calls that were already in flight only halves the
+    limit once per ``cooldown`` seconds.
+    """
+
+    def __init__(self, max_limit, min_limit=1, initial=None, backoff=5.0, max_backoff=120.0, cooldown=5.0):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = initial or max_limit
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.cooldown = cooldown
+        self.overloads = 0
+        self._successes = 0
+        self._pause = backoff
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Block while the limiter is backing off after an overload."""
+        with self._lock:
+            delay = self._paused_until - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def record(self, error=None):
+        """Report the outcome of one call; ``error`` is the exception it raised, if any."""
+        with self._lock:
+            now = time.monotonic()
+            if error is not None and getattr(error, "overloaded", False):
+                self.overloads += 1
+                self._successes = 0
+                if now - self._last_decrease >= self.cooldown:
+                    self.limit = max(self.min_limit, self.limit // 2)
+                    self._last_decrease = now
+                    self._paused_until = now + self._pause
+                    self._pause = min(self._pause * 2, self.max_backoff)
+            elif error is None:
+                self._successes += 1
+                self._pause = self.backoff
+                if self._successes >= self.limit and self.limit < self.max_limit:
+                    self.limit += 1
+                    self._successes = 0
+
+
+def run_pool(items, worker, max_workers=4, requests_per_minute=None, limiter=None):
+    """Run ``worker(item)`` for every item with at most ``max_workers`` in flight.
+
+    Yields ``(item, result, error)`` tuples in completion order; ``error`` is the
+    exception raised by the worker, or None. Items are pulled from ``items``
+    lazily, so a generator of records is never fully buffered. With an
+    ``AdaptiveLimiter`` the number of calls in flight follows ``limiter.limit``
+    and every outcome is reported to it.
+    """
+    rate_limiter = RateLimiter(requests_per_minute)
+    items = iter(items)
+    exhausted = object()
+
+    def call(item):
+        rate_limiter.wait()
+        if limiter:
+            limiter.wait()
+        return worker(item)
+
+    def capacity():
+        return min(max_workers, limiter.limit) if limiter else max_workers
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        pending = {}
+
+        def fill():
+            while len(pending) < capacity():
+                item = next(items, exhausted)
+                if item is exhausted:
+                    return
+                pending[pool.submit(call, item)] = item
+
+        fill()
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                item = pending.pop(future)
+                error = future.exception()
+                if limiter:
+                    limiter.record(error)
+                if error is None:
+                    yield item, future.result(), None
+                else:
+                    yield item, None, error
+                fill()
+
+
+class LatencyTracker:
+    """Rolling window of recent call latencies; ``deadline()`` is their percentile.
+
+    Until ``min_samples`` latencies are known ``deadline()`` returns ``default``.
+    """
+
+    def __init__(self, default, percentile=90, window=50, min_samples=5):
+        self.default = default
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def deadline(self):
+        with self._lock:
+            ordered = sorted(self._latencies)
+        if len(ordered) < self.min_samples:
+            return self.default
+        return ordered[max(0, math.ceil(len(ordered) * self.percentile / 100) - 1)]
+
+
+def hedged(primary, secondary, deadline, accept=None):
+    """Run ``primary``, and ``secondary`` as well if it is slow or fails.
+
+    Both are called with a ``threading.Event`` that is set when the other call
+    wins; backends stop retrying once it is set (``Backend.complete(cancel=...)``).
+    ``secondary`` starts after ``deadline`` seconds, or at once if the primary
+    fails or returns a result ``accept`` rejects. Returns ``(index, result)``
+    for the first accepted result, 0 for the primary and 1 for the secondary.
+    If neither is accepted the last result is returned, or the last error raised.
+    """
+    cancels = (threading.Event(), threading.Event())
+    calls = (primary, secondary)
+    executor = ThreadPoolExecutor(max_workers=2)
+    futures = {}
+
+    def start(index):
+        futures[executor.submit(calls[index], cancels[index])] = index
+        if index:
+            count("hedges_started")
+
+    try:
+        start(0)
+        pending = set(futures)
+        done, _ = wait(pending, timeout=deadline)
+        if not done:
+            logging.info(f"No answer within {deadline:.0f}s; hedging with the secondary backend")
+            start(1)
+            pending = set(futures)
+
+        last_result, last_error = None, None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    last_error = e
+                    continue
+                if accept is None or accept(result):
+                    cancels[1 - index].set()
+                    if index:
+                        count("hedge_wins")
+                    return index, result
+                last_result, last_error = (index, result), None
+            if not pending and len(futures) == 1:
+                start(1)  # The primary failed before the deadline: fall back at once
+                pending = {future for future, index in futures.items() if index == 1}
+
+        if last_result is not None:
+            return last_result
+        raise last_error
+    finally:
+        executor.shutdown(wait=False)
+
+
+def _parse_with_metrics(parse, raw):
+    """Process-pool entry point: run ``parse`` and return its stage timings with the result."""
+    drain_samples()  # A forked worker starts with a copy of the parent's samples
+    try:
+        result, error = parse(raw), None
+    except Exception as e:
+        result, error = None, e
+    return result, error, drain_samples()
+
+
+def parse_in_processes(results, parse, processes=2):
+    """Parse ``run_pool`` results on a process pool as they arrive.
+
+    ``results`` yields ``(item, raw, error)``; every raw result is sent to
+    ``parse(raw)`` in a worker process (``parse`` must be picklable, i.e. a
+    module-level function or a ``functools.partial`` of one). Yields
+    ``(item, parsed, error)`` in completion order; items that failed or came
+    back empty in the first stage pass straight through.
+    """
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        pending = {}
+
+        def finished(futures):
+            for future in futures:
+                item = pending.pop(future)
+                error = future.exception()
+                if error:
+                    yield item, None, error
+                    continue
+                parsed, error, samples = future.result()
+                merge_samples(samples)
+                yield item, parsed, error
+
+        for item, raw, error in results:
+            if error is not None or raw is None:
+                yield item, None, error
+            else:
+                pending[pool.submit(_parse_with_metrics, parse, raw)] = item
+            yield from finished([future for future in pending if future.done()])
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            yield from finished(done)
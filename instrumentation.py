@@ -0,0 +1,127 @@
+"""Lightweight stage timers and counters for the batch scripts.
+
+The shared modules time their hot paths under a stage name:
+
+- ``fetch``: Airtable page reads (``AirtableTable.page``)
+- ``model``: model calls, including retries; cache hits are not timed
+- ``parse`` and ``validate``: clone parsing and checking (``clone_generation``)
+- ``prefilter``: the local LaTeX classifier in the cleaners
+- ``write``: Airtable batch creates and updates (``BatchWriter``)
+
+Each sample is one call, plus how many records it covered. Call
+``report_stages`` at the end of a run. It prints p50/p95/p99 per stage and
+records per minute of wall time, and with ``--metrics-json`` it also writes
+the report as JSON. Timings taken in the parse processes travel back with the
+results (``drain_samples``/``merge_samples``), so they are counted too.
+"""
+import json
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+STAGE_ORDER = ("fetch", "prefilter", "model", "parse", "validate", "write")
+
+_lock = threading.Lock()
+_samples = {}   # stage -> [(seconds, items), ...]
+_counters = {}
+_started = time.time()
+
+
+def add_metrics_arguments(parser):
+    """Add ``--metrics-json`` to a script's argument parser."""
+    parser.add_argument("--metrics-json", metavar="PATH",
+                        help="Also write the per-stage timing report to this JSON file")
+
+
+def record_time(stage, seconds, items=1):
+    with _lock:
+        _samples.setdefault(stage, []).append((seconds, items))
+
+
+@contextmanager
+def timed(stage, items=1):
+    """Time the block as one sample of ``stage`` covering ``items`` records."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_time(stage, time.perf_counter() - start, items)
+
+
+def count(name, n=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def drain_samples():
+    """Remove and return this process's samples and counters (for sending to the parent)."""
+    global _samples, _counters
+    with _lock:
+        samples, counters = _samples, _counters
+        _samples, _counters = {}, {}
+    return samples, counters
+
+
+def merge_samples(drained):
+    """Add samples and counters returned by ``drain_samples`` in another process."""
+    samples, counters = drained
+    with _lock:
+        for stage, values in samples.items():
+            _samples.setdefault(stage, []).extend(values)
+        for name, n in counters.items():
+            _counters[name] = _counters.get(name, 0) + n
+
+
+def _percentile(ordered, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+def stage_stats():
+    """Per-stage statistics and counters for the run so far."""
+    wall = time.time() - _started
+    with _lock:
+        samples = {stage: list(values) for stage, values in _samples.items()}
+        counters = dict(_counters)
+    stages = {}
+    for stage in sorted(samples, key=lambda s: (STAGE_ORDER.index(s) if s in STAGE_ORDER else len(STAGE_ORDER), s)):
+        durations = sorted(seconds for seconds, _ in samples[stage])
+        items = sum(n for _, n in samples[stage])
+        stages[stage] = {
+            "calls": len(durations),
+            "records": items,
+            "total_seconds": sum(durations),
+            "p50": _percentile(durations, 50),
+            "p95": _percentile(durations, 95),
+            "p99": _percentile(durations, 99),
+            "max": durations[-1],
+            "records_per_minute": items / (wall / 60) if wall else 0.0,
+        }
+    return {"wall_seconds": wall, "stages": stages, "counters": counters}
+
+
+def stage_report():
+    """Multi-line timing table for the end of a run."""
+    stats = stage_stats()
+    lines = [f"Stage timings over {stats['wall_seconds'] / 60:.1f} min "
+             "(total in s, percentiles in ms per call, rate in records per minute of wall time):",
+             f"  {'stage':<10}{'calls':>8}{'records':>9}{'total':>10}{'p50':>10}{'p95':>10}{'p99':>10}{'rate':>9}"]
+    for stage, s in stats["stages"].items():
+        lines.append(f"  {stage:<10}{s['calls']:>8}{s['records']:>9}{s['total_seconds']:>10.1f}"
+                     f"{s['p50'] * 1000:>10.1f}{s['p95'] * 1000:>10.1f}{s['p99'] * 1000:>10.1f}"
+                     f"{s['records_per_minute']:>9.1f}")
+    if not stats["stages"]:
+        lines.append("  (nothing timed)")
+    if stats["counters"]:
+        lines.append("  counters: " + ", ".join(f"{name}={n}" for name, n in sorted(stats["counters"].items())))
+    return "\n".join(lines)
+
+
+def report_stages(json_path=None, log=print):
+    """Log the timing report and, when ``json_path`` is given, write it as JSON too."""
+    log(stage_report())
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(stage_stats(), f, indent=2)
+        log(f"Stage timings written to {json_path}")
@@ -0,0 +1,333 @@
+"""Single-pass LaTeX delimiter normalizer shared by the explanation cleaners.
+
+``normalize_latex`` walks an explanation once with one compiled token
+pattern. Along the way it:
+
+- converts ``$...$`` to ``\\(...\\)`` and ``$$...$$`` to ``\\[...\\]``;
+- puts a space before opening and after closing delimiters where text touches
+  them, and trims spaces just inside them;
+- reports delimiters that are unbalanced or mismatched.
+
+Everything else is copied through unchanged. That includes escapes such as
+``\\$``, ``\\%``, ``\\{``, ``\\}`` and ``\\,`` and the ``\\\\`` row breaks of
+``cases`` and matrices, which the old chain collapsed or stripped. Normalizing
+twice gives the same text as normalizing once; ``tests/latex_golden.json``
+holds the expected output for each kind of input.
+
+Inline ``$`` only pairs with a ``$`` on the same line and ``$$`` pairs across
+lines. A ``$`` followed by a digit never closes inline math, so "costs $5 and
+$3" is read as currency. A dollar sign left without a partner stays literal
+and is reported; the old chain could not pair ``$$`` across lines and turned
+each half into an empty ``\\(\\)``.
+
+``classify_latex`` builds on it to pre-filter the model cleaners: texts that are
+already clean, or that the normalizer alone can fix, never reach the model.
+It only trusts texts that already have delimited math and no signs of
+stripped delimiters such as "(x)" or "(m = 2)"; everything else still goes to
+the model.
+``latex_problems`` is the matching check for model output: it lists what a
+MathJax/KaTeX renderer would trip over, so the cleanup cascade can tell whether
+a cheap model's answer is good enough.
+
+Run ``python latex_utils.py --bench`` to time it against the old regex chain on
+every explanation in the Questions table (or the local mirror).
+"""
+import argparse
+import os
+import re
+import time
+from collections import Counter
+
+from instrumentation import timed
+
+# Only text around delimiters is tokenized: \\ (so the backslash before "(" in
+# "\\(" is not read as a delimiter), a backslash before punctuation, and dollar
+# signs. Ordinary \commands, the bulk of most explanations, are copied through
+# with the surrounding text.
+TOKEN = re.compile(r'(\\\\|\\[^a-zA-Z\s]|\$\$?)')
+WORD_CHAR = re.compile(r'\w')
+
+# Delimiter written for each way of opening math, and the one that closes it
+OPENING = {'$': '\\(', '$$': '\\[', '\\(': '\\(', '\\[': '\\['}
+CLOSER_FOR = {'$': '\\)', '$$': '\\]', '\\(': '\\)', '\\[': '\\]'}
+
+# Categories returned by classify_latex
+CLEAN = "clean"
+FIXABLE = "fixable"
+NEEDS_MODEL = "needs-model"
+
+MATH_SPAN = re.compile(r'\\\(.*?\\\)|\\\[.*?\\\]', re.DOTALL)
+# LaTeX that only makes sense inside math: commands, braced scripts, or x^2
+BARE_MATH = re.compile(r'\\[a-zA-Z]+|[\^_]\{|\w\^\w')
+BRACE = re.compile(r'\\[{}]|[{}]')
+LEFT_RIGHT = re.compile(r'\\(left|right)(?![a-zA-Z])')
+MAX_EXTRA_PASSES = 3
+# A parenthesised group outside math that looks like math whose delimiters were
+# stripped: "(x)", "(m = 2)", "(x - 1)"
+PAREN_GROUP = re.compile(r'\(([^()\n]{1,80})\)')
+STRIPPED_MATH = re.compile(r'^\s*[a-z]\s*$|[\\^_=<>]|\w\s*[-+*/]\s*\w')
+# Escapes the pre-filter must never lose when it writes normalized text
+PRESERVED_ESCAPES = ('\\$', '\\%', '\\{', '\\}', '\\\\')
+
+
+def _last_char(out):
+    for piece in reversed(out):
+        if piece:
+            return piece[-1]
+    return ''
+
+
+def normalize_latex(text):
+    """Normalize math delimiters in one pass.
+
+    Returns ``(normalized_text, problems)`` where ``problems`` lists the
+    unbalanced or mismatched delimiters that could not be fixed.
+    """
+    normalized, problems = _normalize_pass(text)
+    # A "$" left literal can end up next to another one ("$$$5"), which the next
+    # pass would read differently; settle those rare texts so the result is stable
+    for _ in range(MAX_EXTRA_PASSES):
+        if not problems or '$' not in normalized:
+            break
+        again, problems = _normalize_pass(normalized)
+        if again == normalized:
+            break
+        normalized = again
+    return normalized, problems
+
+
+def _normalize_pass(text):
+    if not text:
+        return text, []
+
+    out = []
+    append = out.append
+    problems = []
+    opened = None       # How the current math span was opened: '$', '$$', '\\(' or '\\['
+    open_index = 0      # Index in ``out`` of the opening delimiter
+    space_index = None  # Index of a space inserted before it, if any
+    trimmed = ''        # Whitespace trimmed after it, restored if the span is abandoned
+    trim_next = False
+
+    def abandon():
+        """Turn an unclosed ``$`` or ``$$`` back into literal text."""
+        problems.append(f"unclosed {opened} at offset {len(''.join(out[:open_index]))}")
+        out[open_index] = opened + trimmed
+        if space_index is not None:
+            out[space_index] = ''
+
+    # split() alternates plain text and tokens, so the loop below sees each
+    # character once. It is the hot path: opening and closing are inlined.
+    pieces = TOKEN.split(text)
+    last_piece = len(pieces) - 1
+    for i in range(0, len(pieces), 2):
+        chunk = pieces[i]
+        if chunk:
+            if opened == '$' and '\n' in chunk:
+                abandon()  # Inline math never spans lines
+                opened = None
+                trim_next = False
+            elif trim_next:
+                stripped = chunk.lstrip()
+                trimmed += chunk[:len(chunk) - len(stripped)]
+                chunk = stripped
+            append(chunk)
+        if i == last_piece:
+            break
+        token = pieces[i + 1]
+        trim_next = False  # Only the whitespace right after an opening delimiter is trimmed
+
+        if token[0] == '$':
+            if opened == '$' and token == '$' and pieces[i + 2][:1].isdigit():
+                append(token)  # "$5 and $3": a dollar sign before a digit is currency, not a closer
+                continue
+            if opened == '$':
+                # "$x$$y$": a second dollar straight after the closing one opens the next span
+                action = 'reopen' if token == '$$' else 'close'
+            elif opened == '$$' and token == '$$':
+                action = 'close'
+            elif opened:
+                problems.append(f"stray {token} inside {opened} math")
+                append(token)
+                continue
+            else:
+                action, new_kind = 'open', token
+        else:
+            char = token[1]
+            if char == '(' or char == '[':
+                if opened:
+                    problems.append(f"\\{char} opened inside {opened} math")
+                    append('\\' + char)
+                    continue
+                action, new_kind = 'open', '\\' + char
+            elif char == ')' or char == ']':
+                if not opened or CLOSER_FOR[opened] != '\\' + char:
+                    problems.append(f"unexpected \\{char}" + (f" inside {opened} math" if opened else ""))
+                    append('\\' + char)
+                    continue
+                action = 'close'
+            else:
+                append(token)  # \\, \$, \{, \%, \, and the like stay as they are
+                continue
+
+        if action != 'open':
+            # Trim whitespace just inside the closing delimiter, but keep a control space ("\\ ")
+            while out and out[-1].isspace():
+                out.pop()
+            if out:
+                stripped = out[-1].rstrip()
+                if stripped.endswith('\\') and not out[-1].endswith('\\'):
+                    stripped += ' '
+                out[-1] = stripped
+            append(CLOSER_FOR[opened])
+            opened = None
+            if action == 'close':
+                if WORD_CHAR.match(pieces[i + 2]):
+                    append(' ')
+                continue
+            new_kind = '$'
+
+        # Open a math span, separated from the text before it by a space
+        space_index = None
+        last = _last_char(out)
+        if last and not last.isspace():
+            space_index = len(out)
+            append(' ')
+        opened, open_index, trimmed, trim_next = new_kind, len(out), '', True
+        append(OPENING[new_kind])
+
+    if opened == '$' or opened == '$$':
+        abandon()
+    elif opened:
+        problems.append(f"unclosed {opened}")
+    return ''.join(out), problems
+
+
+def clean_latex(text):
+    """Return ``text`` with its math delimiters normalized."""
+    return normalize_latex(text)[0]
+
+
+def _render_problems(normalized):
+    """Problems in already-normalized text: unbalanced braces or \\left/\\right, math outside delimiters."""
+    problems = []
+    for span in MATH_SPAN.findall(normalized):
+        depth = 0
+        for brace in BRACE.findall(span):
+            if brace == '{':
+                depth += 1
+            elif brace == '}':
+                depth -= 1
+                if depth < 0:
+                    break
+        if depth:
+            problems.append(f"unbalanced braces in {span[:40]!r}")
+        sides = LEFT_RIGHT.findall(span)
+        if sides.count('left') != sides.count('right'):
+            problems.append(f"unmatched \\left/\\right in {span[:40]!r}")
+    if BARE_MATH.search(MATH_SPAN.sub(' ', normalized)):
+        problems.append("math outside delimiters")
+    return problems
+
+
+def latex_problems(text):
+    """List what would stop ``text`` rendering: bad delimiters, braces or math outside delimiters."""
+    if not text or not text.strip():
+        return []
+    normalized, problems = normalize_latex(text)
+    return problems + _render_problems(normalized)
+
+
+def _stripped_math(normalized):
+    """True if text outside math has parenthesised groups that look like math, e.g. "(x)" or "(m = 2)"."""
+    outside = MATH_SPAN.sub(' ', normalized)
+    return any(STRIPPED_MATH.search(group) for group in PAREN_GROUP.findall(outside))
+
+
+def classify_latex(text):
+    """Decide whether ``text`` needs a model to clean it.
+
+    Returns ``(category, text)``. ``CLEAN`` texts come back unchanged and
+    ``FIXABLE`` ones with the local normalization applied. Only texts with at
+    least one delimited math span qualify. ``NEEDS_MODEL`` texts come back
+    unchanged for the model: those with unbalanced delimiters or braces, math
+    such as ``x^2`` or ``\\frac`` outside any delimiters, groups like "(x)" that
+    look like math with stripped delimiters, or no delimited math at all.
+    """
+    if not text or not text.strip():
+        return CLEAN, text
+    with timed("prefilter"):
+        normalized, problems = normalize_latex(text)
+        needs_model = (problems or _render_problems(normalized) or not MATH_SPAN.search(normalized)
+                       or _stripped_math(normalized)
+                       or any(text.count(escape) != normalized.count(escape) for escape in PRESERVED_ESCAPES))
+    if needs_model:
+        return NEEDS_MODEL, text
+    return (CLEAN if normalized == text else FIXABLE), normalized
+
+
+def _regex_chain_clean_latex(text):
+    """The sequential regex chain ``normalize_latex`` replaced; kept for ``--bench``."""
+    if not text:
+        return text
+    text = re.sub(r'\$\$(.*?)\$\$', r'\\[\1\\]', text)
+    text = re.sub(r'(?<!\\)\$(.*?)(?<!\\)\$', r'\\(\1\\)', text)
+    text = re.sub(r'([^\s])(\\[\(\[])', r'\1 \2', text)
+    text = re.sub(r'(\\[\)\]])([\w])', r'\1 \2', text)
+    text = re.sub(r'\\[\(\[]\s+', r'\\(', text)
+    text = re.sub(r'\s+\\[\)\]]', r'\\)', text)
+    text = text.replace('\\\\', '\\')
+    text = re.sub(r'\\([^a-zA-Z\s\(\)\[\]])', r'\1', text)
+    # It then scanned the text four more times to check the delimiters balanced
+    text.count('\\('), text.count('\\)'), text.count('\\['), text.count('\\]')
+    return text
+
+
+def benchmark(texts, repeat=5):
+    """Time the regex chain and ``normalize_latex`` over ``texts``; returns seconds per pass for each."""
+    timings = {}
+    for name, clean in (("regex chain", _regex_chain_clean_latex), ("single pass", normalize_latex)):
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for text in texts:
+                clean(text)
+            best = min(best, time.perf_counter() - start)
+        timings[name] = best
+    return timings
+
+
+def main():
+    from dotenv import load_dotenv
+
+    from airtable_client import AirtableTable
+    from airtable_mirror import MIRRORED_TABLES, select
+
+    parser = argparse.ArgumentParser(description="Normalize LaTeX delimiters in explanations")
+    parser.add_argument("--bench", action="store_true",
+                        help="Time the single-pass normalizer against the old regex chain on every explanation")
+    parser.add_argument("--field", default="Explanation 4o", help="Questions field to read (default: Explanation 4o)")
+    parser.add_argument("--repeat", type=int, default=5, help="Benchmark repetitions; the best run is reported")
+    args = parser.parse_args()
+
+    load_dotenv()
+    table = AirtableTable(os.getenv("BASE_ID"), MIRRORED_TABLES["questions"], os.getenv("AIRTABLE_API_KEY"))
+    texts = [record['fields'][args.field]
+             for record in select(table, formula=f"NOT({{{args.field}}} = '')",
+                                  where=lambda f: f.get(args.field), fields=[args.field])]
+    print(f"Loaded {len(texts)} texts ({sum(len(t) for t in texts) / 1e6:.1f} MB)")
+
+    problems = sum(1 for text in texts if normalize_latex(text)[1])
+    print(f"{problems} texts have unbalanced or mismatched delimiters")
+    categories = Counter(classify_latex(text)[0] for text in texts)
+    print(f"Pre-filter: {categories[CLEAN]} clean, {categories[FIXABLE]} fixable locally, "
+          f"{categories[NEEDS_MODEL]} need the model")
+    if args.bench:
+        timings = benchmark(texts, args.repeat)
+        for name, seconds in timings.items():
+            print(f"{name}: {seconds * 1000:.1f} ms per pass")
+        print(f"Speed-up: {timings['regex chain'] / timings['single pass']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""Persistent, content-addressed cache for model responses.
+
+Every model call in the generators and cleaners goes through
+``cached_completion``. The cache key is a SHA-256 of the provider, model,
+system prompt, user prompt and temperature, so re-running a script after a
+crash (or on text that was already cleaned) reuses the earlier response
+instead of paying for the call again.
+
+Entries live in a SQLite file (``LLM_CACHE`` environment variable, default
+``llm_cache.sqlite``; set it to ``off`` to disable caching) and are evicted
+least-recently-used once the cache grows past ``LLM_CACHE_MAX_MB``.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_CACHE_PATH = "llm_cache.sqlite"
+DEFAULT_MAX_MB = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    response TEXT NOT NULL,
+    input_tokens INTEGER NOT NULL DEFAULT 0,
+    output_tokens INTEGER NOT NULL DEFAULT 0,
+    size INTEGER NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access);
+"""
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def make_key(provider, model, system, prompt, temperature=None, variant=None):
+    """Hash everything that determines a response into a cache key.
+
+    ``variant`` lets callers that deliberately want several different
+    responses to one prompt (e.g. a second clone of the same question) keep
+    them apart.
+    """
+    payload = json.dumps([provider, model, system or "", prompt, temperature, variant], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LLMCache:
+    """SQLite-backed response cache with size-bounded LRU eviction."""
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_bytes=DEFAULT_MAX_MB * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.saved_input_tokens = 0
+        self.saved_output_tokens = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(SCHEMA)
+
+    def get(self, key):
+        """Return ``(response, input_tokens, output_tokens)`` for a key, or None."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response, input_tokens, output_tokens FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            self.hits += 1
+            self.saved_input_tokens += row[1]
+            self.saved_output_tokens += row[2]
+            return row
+
+    def put(self, key, response, input_tokens=0, output_tokens=0):
+        size = len(response.encode("utf-8"))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, input_tokens, output_tokens, size, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, response, input_tokens or 0, output_tokens or 0, size, time.time())
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        while total > self.max_bytes:
+            rows = self._conn.execute(
+                "SELECT key, size FROM responses ORDER BY last_access LIMIT 100").fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                total -= size
+                if total <= self.max_bytes:
+                    break
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "saved_input_tokens": self.saved_input_tokens,
+            "saved_output_tokens": self.saved_output_tokens,
+        }
+
+    def summary(self):
+        stats = self.stats()
+        return (f"LLM cache: {stats['hits']} hits, {stats['misses']} misses "
+                f"({stats['hit_rate']:.0%} hit rate), saved {stats['saved_input_tokens']} input "
+                f"and {stats['saved_output_tokens']} output tokens")
+
+
+def get_cache():
+    """Return the process-wide cache, or None if caching is turned off."""
+    global _cache
+    path = os.getenv("LLM_CACHE", DEFAULT_CACHE_PATH)
+    if path.lower() == "off":
+        return None
+    with _cache_lock:
+        if _cache is None:
+            max_mb = float(os.getenv("LLM_CACHE_MAX_MB", DEFAULT_MAX_MB))
+            _cache = LLMCache(path, int(max_mb * 1024 * 1024))
+        return _cache
+
+
+def cached_completion(provider, model, system, prompt, call, temperature=None, variant=None, validate=None):
+    """Return the cached response for this request, or run ``call()`` and cache it.
+
+    ``call`` must return ``(text, input_tokens, output_tokens)``. Empty
+    responses, exceptions and responses rejected by ``validate(text)`` are
+    never cached, so failed calls are retried on the next run.
+    """
+    cache = get_cache()
+    if cache is None:
+        return call()[0]
+
+    key = make_key(provider, model, system, prompt, temperature, variant)
+    entry = cache.get(key)
+    if entry is not None:
+        return entry[0]
+
+    text, input_tokens, output_tokens = call()
+    if text and (validate is None or validate(text)):
+        cache.put(key, text, input_tokens, output_tokens)
+    return text
+
+
+def cache_summary():
+    """One-line hit/miss report for the end of a run, or None if caching is off."""
+    cache = get_cache()
+    return cache.summary() if cache else None
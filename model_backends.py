@@ -0,0 +1,748 @@
+"""Provider-agnostic model backends shared by the generators and cleaners.
+
+``get_backend("deepseek")`` or ``get_backend("anthropic", "claude-3-haiku-20240307")``
+(also accepted as ``"anthropic:claude-3-haiku-20240307"``) returns a backend
+whose ``complete`` method sends one prompt and returns a ``Completion`` with
+the text, token counts and latency. Every backend of a provider shares one
+long-lived client (SDK client or pooled ``requests.Session``), so calls reuse
+connections instead of paying for a new TLS handshake each time. Responses go
+through the LLM cache, and ``acomplete`` offers the same call for asyncio code.
+For bulk offline work ``complete_batch`` submits many prompts as one
+Anthropic Message Batches or OpenAI Batch job (half price, separate rate
+limits) and waits for the results. Submitted batch IDs are kept in
+``checkpoints/batches.json`` until their results are collected, so a rerun
+after a crash polls the same jobs instead of paying for them again, and
+transient errors while polling are retried. ``ANTHROPIC_BASE_URL``,
+``OPENAI_BASE_URL`` and ``DEEPSEEK_API_URL`` point the clients at another
+server, e.g. a local stub.
+
+``json_output`` asks for a bare JSON object instead of free text: JSON mode on
+DeepSeek and OpenAI, a prefilled ``{`` on Anthropic, and ``format`` on
+Ollama. Passing a JSON schema instead of ``True`` also constrains the shape
+where the provider supports it (OpenAI and Ollama structured outputs).
+
+``prefix`` carries the static part of a prompt, e.g. a long instruction
+block, and is sent ahead of the per-record ``prompt``. Anthropic gets it as a
+separate block marked with ``cache_control``. DeepSeek, OpenAI and Ollama
+cache repeated prompt prefixes on their own, so keeping the static text first
+is all they need. Tokens served from the provider's prefix cache are reported
+as ``Completion.cached_input_tokens``, and hits and misses are counted.
+
+With ``stream`` the answer is read as it is generated. A ``check`` passed to
+``complete`` then sees the partial text after every chunk. Once it returns a
+reason the output is unusable, the stream is closed and the attempt is retried
+at once, without the usual backoff. This saves the time and output tokens of
+a generation that was going nowhere. Early aborts are counted as
+``early_aborts``. A streamed call also stops reading as soon as its ``cancel``
+event is set, e.g. when the other side of a hedged request has already won.
+
+Failures are raised as ``BackendError`` after the backend's own retries.
+Every completion, cached or not, is recorded in the run's usage ledger
+(``usage_ledger``).
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from checkpoints import CHECKPOINT_DIR
+from instrumentation import count, record_time, timed
+from llm_cache import cached_completion, get_cache, make_key
+from usage_ledger import record_usage
+
+DEFAULT_MODELS = {
+    "deepseek": "deepseek-reasoner",
+    "openai": "gpt-4o",
+    "anthropic": "claude-3-haiku-20240307",
+    "ollama": "gemma3",
+}
+DEEPSEEK_API_URL = os.getenv("DEEPSEEK_API_URL", "https://api.deepseek.com/v1/chat/completions")
+OLLAMA_API_URL = os.getenv("OLLAMA_API_URL", "http://localhost:11434/api/generate")
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504, 529}
+BATCH_POLL_INTERVAL = 30  # Seconds between batch status checks
+BATCH_POLL_RETRIES = 10  # Transient errors tolerated in a row while polling a batch
+BATCH_STATE_PATH = os.path.join(CHECKPOINT_DIR, "batches.json")  # Submitted batches not yet collected
+
+_clients = {}
+_clients_lock = threading.Lock()
+_batch_state_lock = threading.Lock()
+
+
+class BackendError(Exception):
+    """A model call failed; ``status_code`` is the HTTP status when there was one."""
+
+    def __init__(self, message, status_code=None, retryable=None, aborted=False):
+        super().__init__(message)
+        self.status_code = status_code
+        if retryable is None:
+            retryable = status_code is None or status_code in RETRYABLE_STATUS
+        self.retryable = retryable
+        self.aborted = aborted  # Cut off by a streaming check; retried without waiting
+
+    @property
+    def overloaded(self):
+        """True for rate-limit (429) and overload (529) responses."""
+        return self.status_code in (429, 529)
+
+
+class Completion:
+    """Result of one model call."""
+
+    def __init__(self, text, provider, model, input_tokens=0, output_tokens=0, reasoning_tokens=0,
+                 latency=0.0, cached=False, tokens_per_second=None, cached_input_tokens=0, cache_write_tokens=0):
+        self.text = text
+        self.provider = provider
+        self.model = model
+        self.input_tokens = input_tokens
+        self.output_tokens = output_tokens
+        self.reasoning_tokens = reasoning_tokens
+        self.latency = latency
+        self.cached = cached
+        self.tokens_per_second = tokens_per_second  # Generation speed, when the provider reports it
+        self.cached_input_tokens = cached_input_tokens  # Input tokens read from the provider's prefix cache
+        self.cache_write_tokens = cache_write_tokens  # Input tokens written to it (billed extra by Anthropic)
+
+
+def _load_batch_state():
+    try:
+        with open(BATCH_STATE_PATH, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+
+def _save_batch_id(fingerprint, batch_id):
+    """Remember (or with ``batch_id=None`` forget) the batch submitted for a request fingerprint."""
+    with _batch_state_lock:
+        state = _load_batch_state()
+        if batch_id is None:
+            state.pop(fingerprint, None)
+        else:
+            state[fingerprint] = batch_id
+        os.makedirs(os.path.dirname(BATCH_STATE_PATH), exist_ok=True)
+        temp_path = BATCH_STATE_PATH + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f, indent=2)
+        os.replace(temp_path, BATCH_STATE_PATH)
+
+
+def get_client(provider):
+    """Return the long-lived client for a provider, creating it on first use.
+
+    SDK retries are turned off because ``Backend`` does its own retrying and
+    needs to see rate-limit and overload errors as they happen.
+    """
+    with _clients_lock:
+        if provider not in _clients:
+            if provider == "openai":
+                import openai
+                _clients[provider] = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"),
+                                                base_url=os.getenv("OPENAI_BASE_URL"), max_retries=0)
+            elif provider == "anthropic":
+                import anthropic
+                _clients[provider] = anthropic.Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"),
+                                                      base_url=os.getenv("ANTHROPIC_BASE_URL"), max_retries=0)
+            else:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=2, pool_maxsize=32)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _clients[provider] = session
+        return _clients[provider]
+
+
+class Backend:
+    """Base class: retries, timing and caching around a provider-specific ``_call``."""
+
+    provider = None
+    max_batch_requests = 10000  # Requests per submitted batch job
+    reports_prefix_cache = True  # Whether responses say how many input tokens came from the prefix cache
+
+    def __init__(self, model=None, max_retries=5, retry_delay=2, timeout=None, retry_overloaded=True,
+                 json_output=False, stream=False):
+        self.model = model or DEFAULT_MODELS[self.provider]
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.timeout = timeout
+        # Callers with an AdaptiveLimiter turn this off so 429/529 reach the limiter at once
+        self.retry_overloaded = retry_overloaded
+        self.json_output = json_output  # False, True for any JSON object, or a JSON schema
+        self.stream = stream
+
+    @property
+    def name(self):
+        return f"{self.provider}:{self.model}"
+
+    def complete(self, prompt, system=None, max_tokens=None, temperature=None,
+                 use_cache=True, validate=None, variant=None, cancel=None, prefix=None, check=None):
+        """Send one prompt (after the static ``prefix``, if any) and return a ``Completion``.
+
+        ``validate`` and ``variant`` are passed to the LLM cache: responses
+        ``validate`` rejects are not cached, and ``variant`` separates
+        deliberate repeat generations of the same prompt. Once ``cancel`` (a
+        ``threading.Event``) is set, no further attempts are made, a streamed
+        answer stops being read, and the call raises a non-retryable ``BackendError``. ``check(partial_text)`` is
+        only used when streaming; it returns None while the output may still be
+        usable, or the reason to abort it.
+        """
+        produced = []
+
+        def call():
+            with timed("model"):
+                completion = self._call_with_retries(prompt, system, max_tokens, temperature, cancel, prefix, check)
+            if prefix and self.reports_prefix_cache:
+                count("prefix_cache_hits" if completion.cached_input_tokens else "prefix_cache_misses")
+            produced.append(completion)
+            return completion.text, completion.input_tokens, completion.output_tokens
+
+        if not use_cache:
+            call()
+            record_usage(produced[0])
+            return produced[0]
+
+        text = cached_completion(self.provider, self.model, system, (prefix or "") + prompt, call,
+                                 temperature=temperature, variant=variant, validate=validate)
+        completion = produced[0] if produced else Completion(text, self.provider, self.model, cached=True)
+        if completion.cached:
+            count("cache_hits")
+        record_usage(completion)
+        return completion
+
+    def complete_batch(self, prompts, system=None, max_tokens=None, temperature=None,
+                       poll_interval=BATCH_POLL_INTERVAL, use_cache=True, prefix=None):
+        """Run many prompts as provider batch jobs and wait for them to finish.
+
+        ``prompts`` maps a custom ID (e.g. an Airtable record ID) to a prompt;
+        ``prefix`` is sent ahead of each of them, as in ``complete``.
+        Returns a dict mapping every ID to a ``Completion`` or a ``BackendError``.
+        Prompts already in the LLM cache are answered locally and not submitted,
+        and new results are cached, so rerunning after a failed job only
+        resubmits what is still missing.
+        """
+        cache = get_cache() if use_cache else None
+        results = {}
+        pending = {}
+        for custom_id, prompt in prompts.items():
+            key = make_key(self.provider, self.model, system, (prefix or "") + prompt, temperature)
+            entry = cache.get(key) if cache else None
+            if entry is not None:
+                results[custom_id] = Completion(entry[0], self.provider, self.model, cached=True)
+                record_usage(results[custom_id])
+                count("cache_hits")
+            else:
+                pending[custom_id] = prompt
+        if not pending:
+            return results
+
+        start = time.monotonic()
+        items = list(pending.items())
+        batches = []
+        for i in range(0, len(items), self.max_batch_requests):
+            chunk = dict(items[i:i + self.max_batch_requests])
+            fingerprint = self._batch_fingerprint(chunk, system, max_tokens, temperature, prefix)
+            batch_id = self._resumable_batch(fingerprint, poll_interval)
+            if batch_id is None:
+                batch_id = self._submit_batch(chunk, system, max_tokens, temperature, prefix)
+                _save_batch_id(fingerprint, batch_id)
+                logging.info(f"Submitted {self.name} batch {batch_id} ({len(chunk)} requests)")
+            batches.append((fingerprint, batch_id))
+
+        for fingerprint, batch_id in batches:
+            while True:
+                done, progress = self._poll(self._batch_status, batch_id, poll_interval)
+                if done:
+                    break
+                logging.info(f"{self.name} batch {batch_id}: {progress}")
+                time.sleep(poll_interval)
+            outcomes = self._poll(lambda b: list(self._batch_results(b)), batch_id, poll_interval)
+            _save_batch_id(fingerprint, None)
+            for custom_id, outcome in outcomes:
+                if isinstance(outcome, Completion):
+                    outcome.latency = time.monotonic() - start
+                    record_usage(outcome, batch=True)
+                    if cache is not None and outcome.text:
+                        key = make_key(self.provider, self.model, system, (prefix or "") + pending[custom_id],
+                                       temperature)
+                        cache.put(key, outcome.text, outcome.input_tokens, outcome.output_tokens)
+                results[custom_id] = outcome
+
+        record_time("model", time.monotonic() - start, len(pending))  # One sample for the whole batch job
+        for custom_id in pending:
+            results.setdefault(custom_id, BackendError(f"No result for {custom_id} in the {self.name} batch"))
+        return results
+
+    def _batch_fingerprint(self, prompts, system, max_tokens, temperature, prefix):
+        """Hash of everything that goes into a batch job, so a rerun can recognise the same job."""
+        request = [self.provider, self.model, system, prefix, max_tokens, temperature, self.json_output,
+                   sorted(prompts.items())]
+        return hashlib.sha256(json.dumps(request, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def _resumable_batch(self, fingerprint, poll_interval=BATCH_POLL_INTERVAL):
+        """ID of a batch an earlier run submitted for the same requests, if it can still be polled."""
+        batch_id = _load_batch_state().get(fingerprint)
+        if batch_id is None:
+            return None
+        try:
+            self._poll(self._batch_status, batch_id, poll_interval)
+        except BackendError as e:
+            logging.warning(f"Cannot resume {self.name} batch {batch_id} ({e}); submitting a new one")
+            _save_batch_id(fingerprint, None)
+            return None
+        logging.info(f"Resuming {self.name} batch {batch_id} submitted by an earlier run")
+        return batch_id
+
+    def _poll(self, action, batch_id, delay=BATCH_POLL_INTERVAL):
+        """Run a batch status or results call, retrying transient errors so a long wait survives them."""
+        for attempt in range(BATCH_POLL_RETRIES):
+            try:
+                return action(batch_id)
+            except BackendError as e:
+                if not e.retryable or attempt == BATCH_POLL_RETRIES - 1:
+                    raise
+                logging.warning(f"Polling {self.name} batch {batch_id} failed ({e}); retrying in {delay}s "
+                                f"(attempt {attempt + 1}/{BATCH_POLL_RETRIES})")
+                time.sleep(delay)
+
+    async def acomplete(self, prompt, **kwargs):
+        """Async version of ``complete``; runs the call on a worker thread."""
+        return await asyncio.to_thread(self.complete, prompt, **kwargs)
+
+    def _call_with_retries(self, prompt, system, max_tokens, temperature, cancel=None, prefix=None, check=None):
+        for attempt in range(self.max_retries):
+            if cancel is not None and cancel.is_set():
+                raise BackendError(f"{self.name} call cancelled", retryable=False)
+            start = time.monotonic()
+            try:
+                completion = self._call(prompt, system, max_tokens, temperature, prefix,
+                                        self._stream_check(check, cancel) if self.stream else None)
+            except BackendError as e:
+                if not e.retryable or (e.overloaded and not self.retry_overloaded) \
+                        or attempt == self.max_retries - 1:
+                    raise
+                if e.aborted:
+                    logging.info(f"{e}; retrying now (attempt {attempt + 1}/{self.max_retries})")
+                    continue
+                delay = self.retry_delay * 2 ** attempt
+                logging.warning(f"{self.name} call failed ({e}); retrying in {delay}s "
+                                f"(attempt {attempt + 1}/{self.max_retries})")
+                if cancel is not None:
+                    cancel.wait(delay)  # Wakes early when the call is cancelled
+                else:
+                    time.sleep(delay)
+                continue
+            completion.latency = time.monotonic() - start
+            return completion
+
+    def _call(self, prompt, system, max_tokens, temperature, prefix=None, check=None):
+        raise NotImplementedError
+
+    def _stream_check(self, check, cancel):
+        """``check`` for the stream readers, also ending the read once ``cancel`` is set."""
+        if cancel is None:
+            return check
+
+        def check_or_cancel(text):
+            if cancel.is_set():
+                raise BackendError(f"{self.name} call cancelled", retryable=False)
+            return check(text) if check else None
+        return check_or_cancel
+
+    def _abort_if_malformed(self, text, check):
+        """Raise an aborted ``BackendError`` once ``check`` rejects the partial output."""
+        reason = check(text) if check else None
+        if reason:
+            count("early_aborts")
+            raise BackendError(f"{self.name} output aborted early: {reason}", retryable=True, aborted=True)
+
+    def _submit_batch(self, prompts, system, max_tokens, temperature, prefix=None):
+        raise BackendError(f"{self.provider} has no batch API", retryable=False)
+
+    def _batch_status(self, batch_id):
+        """Return ``(done, progress)`` for a submitted batch; API failures are raised as ``BackendError``."""
+        raise NotImplementedError
+
+    def _batch_results(self, batch_id):
+        """Yield ``(custom_id, Completion or BackendError)`` for a finished batch.
+
+        API failures while reading the results are raised as ``BackendError``.
+        """
+        raise NotImplementedError
+
+
+class DeepSeekBackend(Backend):
+    provider = "deepseek"
+
+    def _call(self, prompt, system, max_tokens, temperature, prefix=None, check=None):
+        messages = [{"role": "system", "content": system}] if system else []
+        messages.append({"role": "user", "content": (prefix or "") + prompt})  # Context caching is automatic
+        data = {"model": self.model, "messages": messages, "stream": self.stream}
+        if self.stream:
+            data["stream_options"] = {"include_usage": True}
+        if max_tokens:
+            data["max_tokens"] = max_tokens
+        if temperature is not None:
+            data["temperature"] = temperature
+        if self.json_output:
+            data["response_format"] = {"type": "json_object"}
+        headers = {
+            "Authorization": f"Bearer {os.getenv('DEEPSEEK_API_KEY')}",
+            "Content-Type": "application/json"
+        }
+        try:
+            response = get_client(self.provider).post(DEEPSEEK_API_URL, json=data, headers=headers,
+                                                      timeout=self.timeout, stream=self.stream)
+            response.raise_for_status()
+            if self.stream:
+                text, usage = self._read_stream(response, check)
+            else:
+                body = response.json()
+                text, usage = body["choices"][0]["message"]["content"], body.get("usage", {})
+        except requests.exceptions.RequestException as e:
+            status = e.response.status_code if e.response is not None else None
+            detail = f" - Response: {e.response.text}" if e.response is not None else ""
+            raise BackendError(f"DeepSeek API error: {e}{detail}", status) from e
+
+        details = usage.get("completion_tokens_details") or {}
+        return Completion(text, self.provider, self.model,
+                          usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0),
+                          details.get("reasoning_tokens", 0),
+                          cached_input_tokens=usage.get("prompt_cache_hit_tokens", 0))
+
+    def _read_stream(self, response, check=None):
+        """Collect a streamed answer (server-sent events); returns the text and the usage dict.
+
+        R1's reasoning arrives first as ``reasoning_content``; ``check`` still runs on every
+        chunk (seeing only the answer text) so a cancelled call stops during the reasoning too.
+        """
+        pieces, usage = [], {}
+        with response:
+            for line in response.iter_lines():
+                if not line.startswith(b"data:"):
+                    continue  # Blank lines and keep-alive comments
+                payload = line[5:].strip()
+                if payload == b"[DONE]":
+                    break
+                chunk = json.loads(payload)
+                usage = chunk.get("usage") or usage
+                for choice in chunk.get("choices") or []:
+                    piece = (choice.get("delta") or {}).get("content")
+                    if piece:
+                        pieces.append(piece)
+                self._abort_if_malformed("".join(pieces), check)
+        return "".join(pieces), usage
+
+
+class OpenAIBackend(Backend):
+    provider = "openai"
+    max_batch_requests = 50000  # Batch API limit per input file
+
+    def _body(self, prompt, system, max_tokens, temperature, prefix=None):
+        messages = [{"role": "system", "content": system}] if system else []
+        messages.append({"role": "user", "content": (prefix or "") + prompt})  # Prompt caching is automatic
+        body = {"model": self.model, "messages": messages}
+        if max_tokens:
+            body["max_tokens"] = max_tokens
+        if temperature is not None:
+            body["temperature"] = temperature
+        if isinstance(self.json_output, dict):
+            body["response_format"] = {"type": "json_schema",
+                                       "json_schema": {"name": "response", "schema": self.json_output}}
+        elif self.json_output:
+            body["response_format"] = {"type": "json_object"}
+        return body
+
+    def _call(self, prompt, system, max_tokens, temperature, prefix=None, check=None):
+        import openai
+        kwargs = self._body(prompt, system, max_tokens, temperature, prefix)
+        if self.timeout:
+            kwargs["timeout"] = self.timeout
+        if self.stream:
+            kwargs.update(stream=True, stream_options={"include_usage": True})
+        try:
+            response = get_client(self.provider).chat.completions.create(**kwargs)
+            if self.stream:
+                text, usage = self._read_stream(response, check)
+            else:
+                text, usage = response.choices[0].message.content, response.usage
+        except openai.APIError as e:
+            raise BackendError(f"OpenAI API error: {e}", getattr(e, "status_code", None)) from e
+
+        details = getattr(usage, "prompt_tokens_details", None)
+        return Completion(text, self.provider, self.model,
+                          usage.prompt_tokens if usage else 0, usage.completion_tokens if usage else 0,
+                          cached_input_tokens=getattr(details, "cached_tokens", 0) or 0)
+
+    def _read_stream(self, stream, check=None):
+        """Collect a streamed answer; returns the text and the usage sent with the last chunk."""
+        pieces, usage = [], None
+        with stream:
+            for chunk in stream:
+                usage = chunk.usage or usage
+                piece = chunk.choices[0].delta.content if chunk.choices else None
+                if piece:
+                    pieces.append(piece)
+                    self._abort_if_malformed("".join(pieces), check)
+        return "".join(pieces), usage
+
+    def _submit_batch(self, prompts, system, max_tokens, temperature, prefix=None):
+        import openai
+        lines = [
+            json.dumps({"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions",
+                        "body": self._body(prompt, system, max_tokens, temperature, prefix)}, ensure_ascii=False)
+            for custom_id, prompt in prompts.items()
+        ]
+        client = get_client(self.provider)
+        try:
+            input_file = client.files.create(file=("batch.jsonl", "\n".join(lines).encode("utf-8")), purpose="batch")
+            batch = client.batches.create(input_file_id=input_file.id, endpoint="/v1/chat/completions",
+                                          completion_window="24h")
+        except openai.APIError as e:
+            raise BackendError(f"OpenAI batch submission failed: {e}", getattr(e, "status_code", None)) from e
+        return batch.id
+
+    def _batch_status(self, batch_id):
+        import openai
+        try:
+            batch = get_client(self.provider).batches.retrieve(batch_id)
+        except openai.APIError as e:
+            raise BackendError(f"OpenAI batch status failed: {e}", getattr(e, "status_code", None)) from e
+        counts = batch.request_counts
+        progress = f"{batch.status}, {counts.completed}/{counts.total} done" if counts else batch.status
+        return batch.status in ("completed", "failed", "expired", "cancelled"), progress
+
+    def _batch_results(self, batch_id):
+        import openai
+        client = get_client(self.provider)
+        try:
+            batch = client.batches.retrieve(batch_id)
+            files = [client.files.content(file_id).text
+                     for file_id in (batch.output_file_id, batch.error_file_id) if file_id]
+        except openai.APIError as e:
+            raise BackendError(f"OpenAI batch results failed: {e}", getattr(e, "status_code", None)) from e
+        for content in files:
+            for line in content.splitlines():
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                response = entry.get("response") or {}
+                if entry.get("error") or response.get("status_code") != 200:
+                    error = entry.get("error") or response.get("body", {}).get("error")
+                    yield entry["custom_id"], BackendError(f"OpenAI batch request failed: {error}",
+                                                           response.get("status_code"))
+                    continue
+                body = response["body"]
+                usage = body.get("usage") or {}
+                details = usage.get("prompt_tokens_details") or {}
+                yield entry["custom_id"], Completion(body["choices"][0]["message"]["content"], self.provider,
+                                                     self.model, usage.get("prompt_tokens", 0),
+                                                     usage.get("completion_tokens", 0),
+                                                     cached_input_tokens=details.get("cached_tokens", 0))
+
+
+class AnthropicBackend(Backend):
+    provider = "anthropic"
+    default_max_tokens = 1024  # The Messages API requires max_tokens
+    max_batch_requests = 100000  # Message Batches limit per batch
+
+    def _params(self, prompt, system, max_tokens, temperature, prefix=None):
+        content = prompt
+        if prefix:
+            # The system prompt and the marked block are cached together as one prefix
+            content = [{"type": "text", "text": prefix, "cache_control": {"type": "ephemeral"}},
+                       {"type": "text", "text": prompt}]
+        params = {
+            "model": self.model,
+            "max_tokens": max_tokens or self.default_max_tokens,
+            "messages": [{"role": "user", "content": content}]
+        }
+        if system:
+            params["system"] = system
+        if temperature is not None:
+            params["temperature"] = temperature
+        if self.json_output:
+            # No JSON mode on the Messages API: start the answer with "{" so it can only be an object
+            params["messages"].append({"role": "assistant", "content": "{"})
+        return params
+
+    def _text(self, message):
+        text = message.content[0].text
+        return "{" + text if self.json_output else text
+
+    def _completion(self, message):
+        # input_tokens excludes cache reads and writes; count them so totals match the other providers
+        usage = message.usage
+        cache_read = getattr(usage, "cache_read_input_tokens", 0) or 0
+        cache_write = getattr(usage, "cache_creation_input_tokens", 0) or 0
+        return Completion(self._text(message), self.provider, self.model,
+                          usage.input_tokens + cache_read + cache_write, usage.output_tokens,
+                          cached_input_tokens=cache_read, cache_write_tokens=cache_write)
+
+    def _call(self, prompt, system, max_tokens, temperature, prefix=None, check=None):
+        import anthropic
+        kwargs = self._params(prompt, system, max_tokens, temperature, prefix)
+        if self.timeout:
+            kwargs["timeout"] = self.timeout
+        try:
+            if self.stream:
+                response = self._stream_message(kwargs, check)
+            else:
+                response = get_client(self.provider).messages.create(**kwargs)
+        except anthropic.APIError as e:
+            raise BackendError(f"Anthropic API error: {e}", getattr(e, "status_code", None)) from e
+
+        return self._completion(response)
+
+    def _stream_message(self, kwargs, check=None):
+        """Stream a message, checking the text as it grows; returns the final message."""
+        prefill = "{" if self.json_output else ""
+        pieces = []
+        with get_client(self.provider).messages.stream(**kwargs) as stream:
+            for piece in stream.text_stream:
+                pieces.append(piece)
+                self._abort_if_malformed(prefill + "".join(pieces), check)
+            return stream.get_final_message()
+
+    def _submit_batch(self, prompts, system, max_tokens, temperature, prefix=None):
+        import anthropic
+        batch_requests = [{"custom_id": custom_id,
+                           "params": self._params(prompt, system, max_tokens, temperature, prefix)}
+                          for custom_id, prompt in prompts.items()]
+        try:
+            batch = get_client(self.provider).messages.batches.create(requests=batch_requests)
+        except anthropic.APIError as e:
+            raise BackendError(f"Anthropic batch submission failed: {e}", getattr(e, "status_code", None)) from e
+        return batch.id
+
+    def _batch_status(self, batch_id):
+        import anthropic
+        try:
+            batch = get_client(self.provider).messages.batches.retrieve(batch_id)
+        except anthropic.APIError as e:
+            raise BackendError(f"Anthropic batch status failed: {e}", getattr(e, "status_code", None)) from e
+        counts = batch.request_counts
+        progress = (f"{batch.processing_status}, {counts.processing} processing, "
+                    f"{counts.succeeded} succeeded, {counts.errored} errored")
+        return batch.processing_status == "ended", progress
+
+    def _batch_results(self, batch_id):
+        import anthropic
+        try:
+            entries = list(get_client(self.provider).messages.batches.results(batch_id))
+        except anthropic.APIError as e:
+            raise BackendError(f"Anthropic batch results failed: {e}", getattr(e, "status_code", None)) from e
+        for entry in entries:
+            result = entry.result
+            if result.type != "succeeded":
+                error = getattr(result, "error", None)
+                yield entry.custom_id, BackendError(f"Anthropic batch request {result.type}: {error}",
+                                                    retryable=result.type != "errored")
+                continue
+            yield entry.custom_id, self._completion(result.message)
+
+
+class OllamaBackend(Backend):
+    """Local Ollama server.
+
+    With ``stream`` the response is read token by token, so ``timeout`` bounds
+    the gap between tokens instead of the whole generation and long answers no
+    longer time out. ``keep_alive`` (e.g. ``"30m"``, or -1 for forever) keeps
+    the model loaded between calls. Concurrent calls use Ollama's parallel
+    request slots (``OLLAMA_NUM_PARALLEL`` on the server).
+    """
+
+    provider = "ollama"
+    reports_prefix_cache = False  # The loaded model reuses a shared prompt prefix but does not say so
+
+    def __init__(self, model=None, max_retries=5, retry_delay=1, timeout=30, retry_overloaded=True,
+                 json_output=False, stream=False, keep_alive=None):
+        super().__init__(model, max_retries=max_retries, retry_delay=retry_delay, timeout=timeout,
+                         retry_overloaded=retry_overloaded, json_output=json_output, stream=stream)
+        self.keep_alive = keep_alive
+
+    def _call(self, prompt, system, max_tokens, temperature, prefix=None, check=None):
+        data = {"model": self.model, "prompt": (prefix or "") + prompt, "stream": self.stream}
+        if system:
+            data["system"] = system
+        if self.json_output:
+            data["format"] = self.json_output if isinstance(self.json_output, dict) else "json"
+        if self.keep_alive is not None:
+            keep_alive = self.keep_alive
+            if isinstance(keep_alive, str) and keep_alive.lstrip("-").isdigit():
+                keep_alive = int(keep_alive)  # Bare numbers (e.g. -1) must be sent as numbers, not durations
+            data["keep_alive"] = keep_alive
+        options = {}
+        if max_tokens:
+            options["num_predict"] = max_tokens
+        if temperature is not None:
+            options["temperature"] = temperature
+        if options:
+            data["options"] = options
+        try:
+            response = get_client(self.provider).post(OLLAMA_API_URL, json=data, timeout=self.timeout,
+                                                      stream=self.stream)
+            response.raise_for_status()
+            if self.stream:
+                text, body = self._read_stream(response, check)
+            else:
+                body = response.json()
+                text = body.get("response", "")
+        except requests.exceptions.HTTPError as e:
+            status = e.response.status_code
+            if status == 404:
+                raise BackendError(f"404 Error: Check if Ollama is running and '{self.model}' is installed.",
+                                   status, retryable=False) from e
+            raise BackendError(f"Ollama error: {e}", status, retryable=True) from e
+        except requests.exceptions.Timeout as e:
+            raise BackendError(f"Ollama timed out after {self.timeout}s without output", retryable=True) from e
+        except requests.exceptions.RequestException as e:
+            raise BackendError(f"Ollama error: {e}", retryable=False) from e
+
+        if not text:
+            raise BackendError("Empty response from Ollama", retryable=False)
+        eval_count = body.get("eval_count", 0)
+        eval_seconds = body.get("eval_duration", 0) / 1e9  # Ollama reports durations in nanoseconds
+        return Completion(text, self.provider, self.model, body.get("prompt_eval_count", 0), eval_count,
+                          tokens_per_second=eval_count / eval_seconds if eval_seconds else None)
+
+    def _read_stream(self, response, check=None):
+        """Collect a streamed generation; returns the text and the final stats chunk."""
+        pieces = []
+        with response:
+            try:
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    chunk = json.loads(line)
+                    if chunk.get("error"):
+                        raise BackendError(f"Ollama error: {chunk['error']}", retryable=True)
+                    pieces.append(chunk.get("response", ""))
+                    self._abort_if_malformed("".join(pieces), check)
+                    if chunk.get("done"):
+                        return "".join(pieces), chunk
+            except requests.exceptions.ConnectionError as e:
+                # requests reports a read timeout in the middle of a stream as a ConnectionError
+                raise BackendError(f"Ollama stream stalled or dropped: {e}",
+                                   retryable=True) from e
+        raise BackendError("Ollama stream ended before the generation finished", retryable=True)
+
+
+BACKENDS = {
+    "deepseek": DeepSeekBackend,
+    "openai": OpenAIBackend,
+    "anthropic": AnthropicBackend,
+    "ollama": OllamaBackend,
+}
+
+
+def get_backend(name, model=None, **options):
+    """Build a backend from a provider name, optionally written as ``provider:model``."""
+    provider, _, name_model = name.partition(":")
+    if provider not in BACKENDS:
+        raise ValueError(f"Unknown model backend '{provider}'. Choose from: {', '.join(BACKENDS)}")
+    return BACKENDS[provider](model or name_model or None, **options)
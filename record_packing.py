@@ -0,0 +1,124 @@
+"""Pack several short texts into one cleanup request.
+
+Many explanations and clone questions are only a few hundred characters, so a
+cleanup call per record spends most of its time and tokens on the round trip
+and the instructions. With ``--pack`` the cleaners group short texts into one
+request of up to ``--pack-tokens`` estimated input tokens. Each text is
+wrapped in a numbered envelope:
+
+    <record id="1">
+    ...
+    </record>
+
+and the model is asked to return the same envelopes holding the cleaned
+texts. ``split_packed_response`` maps them back. A text whose envelope is
+missing, repeated, empty or much shorter than the original did not round-trip
+and is cleaned on its own with the script's single-record function, so a
+confused packed answer never costs more than the calls packing saved. Texts
+longer than ``SHORT_TEXT_TOKENS`` are always sent on their own.
+
+The stage report counts ``packed_requests``, ``packed_records`` and
+``pack_fallbacks``.
+"""
+import re
+
+from instrumentation import count
+
+DEFAULT_PACK_TOKENS = 1500  # Estimated input tokens of texts per packed request
+MAX_PACKED_RECORDS = 8
+SHORT_TEXT_TOKENS = 300  # Longer texts are not packed
+PACKED_MAX_TOKENS = 4000  # Output limit for packed requests; fits every cleanup model
+CHARS_PER_TOKEN = 4  # Rough estimate; the budget only needs to be approximate
+MIN_LENGTH_RATIO = 0.5  # A cleaned text much shorter than its original was probably cut or merged
+
+ENVELOPE = re.compile(r'<record id="(\d+)">(.*?)</record>', re.DOTALL)
+
+PACKED_FORMAT = """The texts below are wrapped in numbered envelopes: <record id="1"> ... </record>. Clean each text \
+on its own. Return every envelope with the same id, in the same order, holding only that text's cleaned \
+version, and write nothing outside the envelopes."""
+
+
+def add_packing_arguments(parser):
+    """Add ``--pack`` and ``--pack-tokens`` to a cleaner's argument parser."""
+    parser.add_argument("--pack", action="store_true",
+                        help="Clean several short texts per model request and split the answer back per record")
+    parser.add_argument("--pack-tokens", type=int, default=DEFAULT_PACK_TOKENS,
+                        help=f"Estimated input tokens of texts per packed request (default: {DEFAULT_PACK_TOKENS})")
+
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def pack_items(items, text_of, token_budget=DEFAULT_PACK_TOKENS, max_records=MAX_PACKED_RECORDS):
+    """Group ``items`` into lists whose texts fit ``token_budget``; long texts come alone.
+
+    Works on a stream: a group is yielded as soon as the next item would not fit.
+    """
+    group, tokens = [], 0
+    for item in items:
+        size = estimate_tokens(text_of(item))
+        if size > min(SHORT_TEXT_TOKENS, token_budget):
+            yield [item]
+            continue
+        if group and (tokens + size > token_budget or len(group) >= max_records):
+            yield group
+            group, tokens = [], 0
+        group.append(item)
+        tokens += size
+    if group:
+        yield group
+
+
+def build_packed_prompt(task, texts):
+    """Prompt asking for ``task`` to be done on each of ``texts``, wrapped in envelopes."""
+    envelopes = "\n\n".join(f'<record id="{i}">\n{text}\n</record>' for i, text in enumerate(texts, 1))
+    return f"{task}\n\n{PACKED_FORMAT}\n\n{envelopes}"
+
+
+def split_packed_response(response_text, texts):
+    """Cleaned text for each of ``texts``, in order, or None where it did not round-trip."""
+    found = {}
+    for number, body in ENVELOPE.findall(response_text or ""):
+        found.setdefault(int(number), []).append(body.strip())
+    cleaned = []
+    for i, text in enumerate(texts, 1):
+        bodies = found.get(i, [])
+        ok = len(bodies) == 1 and bodies[0] and len(bodies[0]) >= len(text.strip()) * MIN_LENGTH_RATIO
+        cleaned.append(bodies[0] if ok else None)
+    return cleaned
+
+
+def clean_pack(texts, complete, clean_one):
+    """Clean a group of texts with one call and return the cleaned texts in order.
+
+    ``complete(texts, validate)`` sends the texts as one request built with
+    ``build_packed_prompt`` and returns the response text; passing
+    ``validate`` to the backend keeps answers that lost a text out of the LLM
+    cache. ``clean_one(text)`` cleans a text on its own, for single
+    groups and for texts the packed answer lost.
+    """
+    if len(texts) == 1:
+        return [clean_one(texts[0])]
+
+    def validate(response_text):
+        return None not in split_packed_response(response_text, texts)
+
+    unpacked = split_packed_response(complete(texts, validate), texts)
+    lost = unpacked.count(None)
+    count("packed_requests")
+    count("packed_records", len(texts) - lost)
+    count("pack_fallbacks", lost)
+    return [clean_one(text) if cleaned is None else cleaned for text, cleaned in zip(texts, unpacked)]
+
+
+def clean_in_packs(items, text_of, complete, clean_one, token_budget=DEFAULT_PACK_TOKENS, stop=None):
+    """Yield ``(item, cleaned_text)`` for ``items``, cleaning them in packs (see ``clean_pack``).
+
+    ``stop()`` is checked before each request; once it returns True the
+    remaining items are not yielded.
+    """
+    for group in pack_items(items, text_of, token_budget):
+        if stop and stop():
+            return
+        yield from zip(group, clean_pack([text_of(item) for item in group], complete, clean_one))
@@ -0,0 +1,79 @@
+import json
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+# The scripts and shared modules live at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class StubServer:
+    """Local HTTP server answering every request with ``handle(method, path, body)``.
+
+    ``handle`` returns ``(status, body)``: bytes, a JSON-serializable object, or
+    an iterator of byte chunks written and flushed one at a time (for streams).
+    Requests are kept in ``requests`` as ``(method, path, body)``.
+    """
+
+    def __init__(self, handle):
+        self.handle = handle
+        self.requests = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _respond(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                stub.requests.append((self.command, self.path, body))
+                status, payload = stub.handle(self.command, self.path, body)
+                self.send_response(status)
+                if isinstance(payload, (bytes, dict, list)):
+                    data = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                    return
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                try:
+                    for chunk in payload:
+                        self.wfile.write(chunk)
+                        self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # The client gave up on the stream
+                self.close_connection = True
+
+            do_GET = do_POST = do_DELETE = _respond
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stub_server():
+    """Start ``StubServer(handle)`` servers that are shut down after the test."""
+    servers = []
+
+    def start(handle):
+        servers.append(StubServer(handle))
+        return servers[-1]
+
+    yield start
+    for server in servers:
+        server.close()
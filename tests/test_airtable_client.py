@@ -0,0 +1,109 @@
+import json
+import time
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+import requests
+
+import airtable_client
+from airtable_client import AirtableTable, BatchWriter
+
+
+@pytest.fixture
+def airtable(stub_server, monkeypatch):
+    """Point the client at a stub answering with ``handle(method, path, query, body)``; 429s are retried at once."""
+    monkeypatch.setattr(airtable_client, "_session", None)
+    monkeypatch.setattr(airtable_client, "_buckets", {})
+    monkeypatch.setattr(airtable_client, "RATE_LIMIT_PENALTY", 0)
+
+    def start(handle):
+        def respond(method, path, body):
+            url = urlsplit(path)
+            return handle(method, url.path, parse_qs(url.query), json.loads(body) if body else None)
+        server = stub_server(respond)
+        monkeypatch.setattr(airtable_client, "AIRTABLE_API_URL", f"{server.url}/v0")
+        return server
+    return start
+
+
+def created(payload):
+    return {"records": [{"id": f"rec{i}", "fields": record["fields"]} for i, record in enumerate(payload["records"])]}
+
+
+def test_rate_limited_batch_is_retried(airtable):
+    responses = [(429, {"errors": [{"type": "RATE_LIMIT"}]})]
+    server = airtable(lambda method, path, query, body: responses.pop(0) if responses else (200, created(body)))
+    written = []
+
+    with BatchWriter("appTest", "Table", "key", on_written=lambda key, record: written.append(key)) as writer:
+        writer.create({"Name": "a"}, key="a")
+        writer.create({"Name": "b"}, key="b")
+
+    assert written == ["a", "b"]
+    assert (writer.written, writer.failed) == (2, [])
+    assert len(server.requests) == 2
+
+
+def test_invalid_record_is_narrowed_down(airtable):
+    def handle(method, path, query, body):
+        if any(record["fields"].get("Name") == "bad" for record in body["records"]):
+            return 422, {"error": {"type": "INVALID_VALUE_FOR_COLUMN"}}
+        return 200, created(body)
+
+    server = airtable(handle)
+    written = []
+    with BatchWriter("appTest", "Table", "key", on_written=lambda key, record: written.append(key)) as writer:
+        for name in ("a", "bad", "c"):
+            writer.create({"Name": name}, key=name)
+
+    assert written == ["a", "c"]
+    assert [(key, fields) for key, fields, _ in writer.failed] == [("bad", {"Name": "bad"})]
+    assert isinstance(writer.failed[0][2], requests.exceptions.HTTPError)
+    assert [len(json.loads(body)["records"]) for _, _, body in server.requests] == [3, 1, 1, 1]
+
+
+def test_iterate_follows_offsets(airtable):
+    pages = {None: ("page2", ["r1", "r2"]), "page2": ("page3", ["r3"]), "page3": (None, ["r4", "r5"])}
+    seen_queries = []
+
+    def handle(method, path, query, body):
+        seen_queries.append(query)
+        next_offset, ids = pages[query.get("offset", [None])[0]]
+        data = {"records": [{"id": record_id, "fields": {}} for record_id in ids]}
+        if next_offset:
+            data["offset"] = next_offset
+        return 200, data
+
+    airtable(handle)
+    table = AirtableTable("appTest", "Table", "key")
+    records = table.all(formula="{Done} = 0", fields=["Name"])
+
+    assert [record["id"] for record in records] == ["r1", "r2", "r3", "r4", "r5"]
+    assert [query.get("offset") for query in seen_queries] == [None, ["page2"], ["page3"]]
+    assert all(query["filterByFormula"] == ["{Done} = 0"] and query["fields[]"] == ["Name"] for query in seen_queries)
+
+
+def test_iterate_raises_a_page_error_after_the_earlier_records(airtable):
+    def handle(method, path, query, body):
+        if "offset" in query:
+            return 404, {"error": "NOT_FOUND"}
+        return 200, {"records": [{"id": "r1", "fields": {}}], "offset": "page2"}
+
+    airtable(handle)
+    seen = []
+    with pytest.raises(requests.exceptions.HTTPError):
+        for record in AirtableTable("appTest", "Table", "key").iterate():
+            seen.append(record["id"])
+    assert seen == ["r1"]
+
+
+def test_iterate_stops_prefetching_when_the_caller_stops(airtable):
+    server = airtable(lambda method, path, query, body: (200, {"records": [{"id": "r", "fields": {}}],
+                                                             "offset": "more"}))
+    records = AirtableTable("appTest", "Table", "key").iterate()
+    assert next(records)["id"] == "r"
+    records.close()
+    time.sleep(1.5)  # The prefetch thread notices the stop within its 0.5s put timeout
+    fetched = len(server.requests)
+    time.sleep(1)
+    assert len(server.requests) == fetched <= 3
@@ -0,0 +1,96 @@
+import functools
+import importlib
+
+import pytest
+
+from generation_engine import AdaptiveLimiter
+from model_backends import BackendError
+
+OVERLOADED = BackendError("Overloaded", 529)
+
+
+class FakeWriter:
+    def __init__(self, *args, on_written=None):
+        self.updates = {}
+        self.failed = []
+        self.written = 0
+
+    def update(self, record_id, fields):
+        self.updates[record_id] = fields['Explanation 4o']
+        self.written += 1
+
+    def flush(self):
+        pass
+
+
+@pytest.fixture
+def cleaner(monkeypatch, tmp_path):
+    """The script module, with Airtable replaced and overload pauses and retry rounds that do not wait."""
+    monkeypatch.chdir(tmp_path)  # The script logs to cleanup_explanations.log in the working directory
+    monkeypatch.setenv("LLM_CACHE", "off")
+    module = importlib.import_module("cleanup_explanations_claude")
+    writers = []
+
+    def writer(*args, **kwargs):
+        writers.append(FakeWriter(*args, **kwargs))
+        return writers[-1]
+
+    records = [{'id': f'rec{n}', 'fields': {'Record ID': str(n), 'Explanation 4o': f'explanation {n}'}}
+               for n in range(1, 5)]
+    monkeypatch.setattr(module, "select", lambda *args, **kwargs: iter(records))
+    monkeypatch.setattr(module, "BatchWriter", writer)
+    monkeypatch.setattr(module, "DEFERRED_RETRY_DELAY", 0)
+    monkeypatch.setattr(module, "AdaptiveLimiter", functools.partial(AdaptiveLimiter, backoff=0))
+    module.writers = writers
+    return module
+
+
+def overloaded_until(calls, failures):
+    """Fake single-record cleaner that is overloaded for the first ``failures[text]`` calls per text."""
+    def clean(text):
+        calls.append(text)
+        if failures.get(text, 0):
+            failures[text] -= 1
+            raise OVERLOADED
+        return f"cleaned {text}"
+    return clean
+
+
+def test_overloaded_records_are_deferred_and_retried(cleaner, monkeypatch):
+    calls = []
+    monkeypatch.setattr(cleaner, "clean_explanation",
+                        overloaded_until(calls, {'explanation 2': 1, 'explanation 3': 2}))
+
+    cleaner.process_records(preview=False, prefilter=False, workers=2)
+
+    assert cleaner.writers[0].updates == {f'rec{n}': f'cleaned explanation {n}' for n in range(1, 5)}
+    assert calls.count('explanation 2') == 2 and calls.count('explanation 3') == 3
+
+
+def test_records_still_overloaded_after_the_last_round_are_not_written(cleaner, monkeypatch):
+    calls = []
+    monkeypatch.setattr(cleaner, "clean_explanation", overloaded_until(calls, {'explanation 4': 99}))
+
+    cleaner.process_records(preview=False, prefilter=False, workers=2)
+
+    assert 'rec4' not in cleaner.writers[0].updates
+    assert len(cleaner.writers[0].updates) == 3
+    assert calls.count('explanation 4') == cleaner.DEFERRED_RETRY_ROUNDS + 1
+
+
+def test_overloaded_pack_is_deferred_as_a_group(cleaner, monkeypatch):
+    packed_calls = []
+
+    def clean_packed(texts, validate=None):
+        packed_calls.append(texts)
+        if len(packed_calls) == 1:
+            raise OVERLOADED
+        return "\n".join(f'<record id="{i}">\ncleaned {text}\n</record>' for i, text in enumerate(texts, 1))
+
+    monkeypatch.setattr(cleaner, "clean_packed_explanations", clean_packed)
+    monkeypatch.setattr(cleaner, "clean_explanation", lambda text: pytest.fail("no single-record fallback"))
+
+    cleaner.process_records(preview=False, prefilter=False, workers=1, pack=True)
+
+    assert packed_calls[0] == packed_calls[1] == [f'explanation {n}' for n in range(1, 5)]
+    assert cleaner.writers[0].updates == {f'rec{n}': f'cleaned explanation {n}' for n in range(1, 5)}
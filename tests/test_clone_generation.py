@@ -0,0 +1,77 @@
+import clone_generation
+from clone_generation import LOOSE_SECTION_HEADING, check_partial_clone, existing_clones
+
+QUESTION = r"""**New Question:**
+
+What is the value of \( x \) if \( 2x + 3 = 9 \)?
+(A) \( 1 \)
+(B) \( 2 \)
+(C) \( 3 \)
+(D) \( 4 \)
+(E) \( 5 \)
+
+**Answer:**
+
+C
+"""
+
+# Both parse with R1's parse_response and pass check_clone, answer C
+EXPLANATION_MENTIONS_ANSWER = ("**Analysis:**\n\nA student might add 3 instead of subtracting it.\n\n" + QUESTION
+                               + "\n**Explanation:**\n\nSubtract 3 and divide by 2.\n"
+                               "Answer: the correct choice is C because \\( x = 3 \\).\n")
+ANALYSIS_MENTIONS_ANSWER = ("**Analysis:**\nAnswer: B is tempting if you forget to subtract 3 first.\n\n" + QUESTION
+                            + "\n**Explanation:**\n\nSubtract 3 from both sides, then divide by 2.\n")
+
+
+def stream_reasons(text, **kwargs):
+    """Reasons ``check_partial_clone`` gives at every prefix of ``text``, as a stream would see it."""
+    return [reason for reason in (check_partial_clone(text[:end], **kwargs) for end in range(len(text) + 1))
+            if reason]
+
+
+def test_valid_responses_are_never_aborted():
+    assert stream_reasons(EXPLANATION_MENTIONS_ANSWER) == []
+    assert stream_reasons(ANALYSIS_MENTIONS_ANSWER) == []
+
+
+def test_only_first_answer_section_is_checked():
+    text = QUESTION + "\n**Explanation:**\n\nSee above.\n\n**Answer:**\n\nthe correct choice is C"
+    assert stream_reasons(text) == []
+
+
+def test_malformed_answer_is_aborted():
+    text = QUESTION.replace("\n\nC\n", "\n\nThe answer is C\n")
+    assert check_partial_clone(text).startswith("Answer starts with 'The answer'")
+    assert check_partial_clone(QUESTION.replace("\n\nC\n", "\n\nCD\n")).startswith("Answer is 'CD")
+
+
+def test_answer_before_question_is_aborted():
+    assert check_partial_clone("**Analysis:**\nEasy.\n\n**Answer:**\n\nC") == "Answer section before any New Question"
+
+
+def test_question_preamble_is_aborted():
+    text = "**New Question:**\n\nHere is a new question about lines.\n"
+    assert check_partial_clone(text).startswith("New Question starts with a preamble")
+    assert check_partial_clone("**New Question:**\n\n9. What is \\( x \\)?\n").startswith("New Question starts")
+
+
+def test_missing_headings_are_aborted():
+    assert check_partial_clone("word " * 200) == "no section heading in the first 800 characters"
+    assert check_partial_clone("word " * 10) is None
+
+
+def test_loose_headings_for_the_photo_parser():
+    text = "Analysis:\nEasy.\n\nNew Question:\nWhat is \\( x \\)?\n(A) 1\n(B) 2\n\nAnswer:\nmaybe B"
+    assert check_partial_clone(text) is None
+    assert check_partial_clone(text, heading=LOOSE_SECTION_HEADING).startswith("Answer starts with 'maybe")
+
+
+def test_existing_clones_counts_only_listed_extra_clones(monkeypatch):
+    rows = [{'id': 'recR1', 'fields': {'AI Model': 'DeepSeek R1', 'Original Question': ['q1']}},
+            {'id': 'recWin', 'fields': {'AI Model': 'Gemma3', 'Original Question': ['q2']}},
+            {'id': 'recGemma', 'fields': {'AI Model': 'Gemma3', 'Original Question': ['q3']}}]
+    monkeypatch.setattr(clone_generation, "select",
+                        lambda table, formula=None, where=None, fields=None: [r for r in rows if where(r['fields'])])
+
+    assert existing_clones(None, 'DeepSeek R1') == {'q1': 1}
+    assert existing_clones(None, 'DeepSeek R1', {'Gemma3': {'recWin'}}) == {'q1': 1, 'q2': 1}
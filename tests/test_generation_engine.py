@@ -0,0 +1,132 @@
+import threading
+import time
+
+import pytest
+
+from generation_engine import AdaptiveLimiter, hedged, run_pool
+from model_backends import BackendError
+
+OVERLOADED = BackendError("Overloaded", 529)
+
+
+def test_primary_wins_without_hedging():
+    secondary_calls = []
+    winner, result = hedged(lambda cancel: "primary", lambda cancel: secondary_calls.append(1), deadline=5)
+    assert (winner, result) == (0, "primary")
+    assert secondary_calls == []
+
+
+def test_secondary_wins_and_cancels_the_slow_primary():
+    primary_stopped = threading.Event()
+
+    def primary(cancel):
+        # Stands in for a streamed call that checks ``cancel`` between chunks
+        if cancel.wait(5):
+            primary_stopped.set()
+            raise RuntimeError("cancelled")
+        return "primary"
+
+    start = time.monotonic()
+    winner, result = hedged(primary, lambda cancel: "secondary", deadline=0.05)
+    assert (winner, result) == (1, "secondary")
+    assert primary_stopped.wait(1)
+    assert time.monotonic() - start < 2
+
+
+def test_rejected_secondary_does_not_win():
+    def primary(cancel):
+        time.sleep(0.2)
+        return "good"
+
+    winner, result = hedged(primary, lambda cancel: "bad", deadline=0.05, accept=lambda text: text == "good")
+    assert (winner, result) == (0, "good")
+
+
+def test_failed_primary_falls_back_at_once():
+    def primary(cancel):
+        raise RuntimeError("primary down")
+
+    start = time.monotonic()
+    assert hedged(primary, lambda cancel: "secondary", deadline=5) == (1, "secondary")
+    assert time.monotonic() - start < 2
+
+
+def test_last_result_or_error_when_nothing_is_accepted():
+    assert hedged(lambda cancel: "p", lambda cancel: "s", deadline=5, accept=lambda text: False) == (1, "s")
+
+    def fail(cancel):
+        raise RuntimeError("down")
+
+    with pytest.raises(RuntimeError):
+        hedged(fail, fail, deadline=5)
+
+
+def test_overload_halves_the_limit_down_to_the_minimum():
+    limiter = AdaptiveLimiter(max_limit=8, cooldown=0, backoff=0)
+    for expected in (4, 2, 1, 1):
+        limiter.record(OVERLOADED)
+        assert limiter.limit == expected
+    assert limiter.overloads == 4
+
+
+def test_burst_of_overloads_halves_once_per_cooldown():
+    limiter = AdaptiveLimiter(max_limit=8, cooldown=60, backoff=0)
+    for _ in range(5):
+        limiter.record(OVERLOADED)
+    assert (limiter.limit, limiter.overloads) == (4, 5)
+
+
+def test_overload_pauses_new_calls_with_a_doubling_backoff():
+    limiter = AdaptiveLimiter(max_limit=8, cooldown=0, backoff=0.1)
+    limiter.record(OVERLOADED)
+    start = time.monotonic()
+    limiter.wait()
+    assert 0.05 < time.monotonic() - start < 0.5
+    limiter.record(OVERLOADED)
+    start = time.monotonic()
+    limiter.wait()
+    assert 0.15 < time.monotonic() - start < 0.7
+
+
+def test_limit_grows_by_one_after_a_run_of_successes():
+    limiter = AdaptiveLimiter(max_limit=4, initial=2)
+    limiter.record()
+    assert limiter.limit == 2
+    limiter.record()
+    assert limiter.limit == 3
+    for _ in range(3):
+        limiter.record()
+    assert limiter.limit == 4
+    for _ in range(10):
+        limiter.record()
+    assert limiter.limit == 4  # Never above max_limit
+
+
+def test_other_errors_leave_the_limit_alone():
+    limiter = AdaptiveLimiter(max_limit=4, initial=2)
+    limiter.record()
+    limiter.record(RuntimeError("bad response"))
+    assert limiter.limit == 2
+    limiter.record()
+    assert limiter.limit == 3  # The success streak was not reset
+
+
+def test_run_pool_keeps_in_flight_calls_within_the_limit():
+    limiter = AdaptiveLimiter(max_limit=8, initial=2)
+    limiter.record = lambda error=None: None  # Hold the limit still
+    lock = threading.Lock()
+    in_flight, peak = 0, 0
+
+    def worker(item):
+        nonlocal in_flight, peak
+        with lock:
+            in_flight += 1
+            peak = max(peak, in_flight)
+        time.sleep(0.02)
+        with lock:
+            in_flight -= 1
+        return item
+
+    results = sorted(result for _, result, _ in run_pool(range(10), worker, max_workers=8, limiter=limiter))
+    assert results == list(range(10))
+    assert peak == 2
@@ -0,0 +1,51 @@
+"""Golden-file tests for ``latex_utils.normalize_latex``, plus the pre-filter.
+
+``latex_golden.json`` lists inputs with the exact normalized text and problems
+expected for each. Every input must also be a fixed point after one pass, so
+rerunning a cleaner never changes text it already cleaned.
+"""
+import json
+import os
+
+import pytest
+
+from latex_utils import CLEAN, FIXABLE, NEEDS_MODEL, classify_latex, normalize_latex
+
+GOLDEN_PATH = os.path.join(os.path.dirname(__file__), "latex_golden.json")
+
+with open(GOLDEN_PATH, encoding="utf-8") as f:
+    GOLDEN = json.load(f)
+
+
+@pytest.mark.parametrize("case", GOLDEN, ids=[case["name"] for case in GOLDEN])
+def test_golden(case):
+    normalized, problems = normalize_latex(case["input"])
+    assert normalized == case["expected"]
+    assert problems == case["problems"]
+
+
+@pytest.mark.parametrize("case", GOLDEN, ids=[case["name"] for case in GOLDEN])
+def test_idempotent(case):
+    once = normalize_latex(case["input"])[0]
+    assert normalize_latex(once)[0] == once
+
+
+@pytest.mark.parametrize("escape", ["\\$", "\\%", "\\{", "\\}", "\\\\", "\\,"])
+def test_escapes_survive(escape):
+    for text in (f"a {escape} b", f"\\(a {escape} b\\)", f"$a {escape} b$"):
+        assert escape in normalize_latex(text)[0]
+
+
+@pytest.mark.parametrize("text, category", [
+    ("The slope is \\(m = 2\\).", CLEAN),
+    ("The set \\(\\{1,2\\}\\) grew by \\(50\\%\\).", CLEAN),
+    ("The slope is $m = 2$.", FIXABLE),
+    # Delimiters stripped by an earlier export
+    ("We need positive integers (x) and (y) with \\(x > y\\).", NEEDS_MODEL),
+    ("The slope is (m = 2).", NEEDS_MODEL),
+    # Nothing to show the text was ever formatted
+    ("No math here at all.", NEEDS_MODEL),
+    ("Bad \\(x\\] here", NEEDS_MODEL),
+])
+def test_classify(text, category):
+    assert classify_latex(text)[0] == category
@@ -0,0 +1,186 @@
+import json
+import re
+
+import pytest
+
+import model_backends
+from model_backends import BackendError, Completion, get_backend
+
+
+@pytest.fixture
+def fresh_clients(monkeypatch, tmp_path):
+    """Clean client pool and batch state; the LLM cache is turned off."""
+    monkeypatch.setattr(model_backends, "_clients", {})
+    monkeypatch.setattr(model_backends, "BATCH_STATE_PATH", str(tmp_path / "batches.json"))
+    monkeypatch.setenv("LLM_CACHE", "off")
+
+
+class BatchStub:
+    """OpenAI Batch API stand-in: uploads, batch creation, status polls and result files.
+
+    ``status_errors`` transient 503s are returned before the first status
+    answers; a batch then reports ``in_progress`` once and ``completed``.
+    """
+
+    def __init__(self, status_errors=0):
+        self.status_errors = status_errors
+        self.requests = {}  # custom_id -> prompt of the submitted batch
+        self.created = 0
+        self.polls = {}
+
+    def handle(self, method, path, body):
+        if method == "POST" and path == "/v1/files":
+            for line in re.findall(rb'\{"custom_id".*', body):
+                request = json.loads(line)
+                self.requests[request["custom_id"]] = request["body"]["messages"][-1]["content"]
+            return 200, {"id": "file-in", "object": "file", "bytes": len(body), "created_at": 0,
+                         "filename": "batch.jsonl", "purpose": "batch", "status": "processed"}
+        if method == "POST" and path == "/v1/batches":
+            self.created += 1
+            return 200, self.batch(f"batch_{self.created}", "validating")
+        match = re.fullmatch(r"/v1/batches/(\w+)", path)
+        if match:
+            if self.status_errors:
+                self.status_errors -= 1
+                return 503, {"error": {"message": "temporarily unavailable", "type": "server_error"}}
+            batch_id = match.group(1)
+            self.polls[batch_id] = self.polls.get(batch_id, 0) + 1
+            return 200, self.batch(batch_id, "completed" if self.polls[batch_id] > 1 else "in_progress")
+        if path == "/v1/files/file-out/content":
+            lines = [{"custom_id": custom_id, "response": {"status_code": 200, "body": {
+                "choices": [{"message": {"content": f"cleaned {prompt}"}}],
+                "usage": {"prompt_tokens": 10, "completion_tokens": 5}}}}
+                for custom_id, prompt in reversed(list(self.requests.items()))]
+            return 200, "\n".join(json.dumps(line) for line in lines).encode()
+        return 404, {"error": {"message": f"no route for {method} {path}"}}
+
+    def batch(self, batch_id, status):
+        return {"id": batch_id, "object": "batch", "endpoint": "/v1/chat/completions", "input_file_id": "file-in",
+                "completion_window": "24h", "status": status, "created_at": 0,
+                "output_file_id": "file-out" if status == "completed" else None,
+                "request_counts": {"total": len(self.requests), "completed": 0, "failed": 0}}
+
+
+@pytest.fixture
+def openai_stub(stub_server, monkeypatch, fresh_clients):
+    pytest.importorskip("openai")
+    stub = BatchStub(status_errors=2)
+    server = stub_server(stub.handle)
+    monkeypatch.setenv("OPENAI_BASE_URL", f"{server.url}/v1")
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    return stub
+
+
+PROMPTS = {"recA": "first", "recB": "second", "recC": "third"}
+
+
+def test_batch_survives_transient_poll_errors_and_maps_results(openai_stub):
+    results = get_backend("openai", "gpt-4o").complete_batch(PROMPTS, poll_interval=0)
+
+    assert openai_stub.created == 1
+    assert {custom_id: result.text for custom_id, result in results.items()} == {
+        "recA": "cleaned first", "recB": "cleaned second", "recC": "cleaned third"}
+    assert all(isinstance(result, Completion) and result.input_tokens == 10 for result in results.values())
+    assert model_backends._load_batch_state() == {}  # Collected batches are forgotten
+
+
+def test_rerun_resumes_a_submitted_batch(openai_stub):
+    backend = get_backend("openai", "gpt-4o")
+    fingerprint = backend._batch_fingerprint(PROMPTS, None, None, None, None)
+    model_backends._save_batch_id(fingerprint, "batch_earlier")
+    openai_stub.requests = dict(PROMPTS)  # Submitted by the earlier run
+
+    results = backend.complete_batch(PROMPTS, poll_interval=0)
+
+    assert openai_stub.created == 0
+    assert "batch_earlier" in openai_stub.polls
+    assert results["recB"].text == "cleaned second"
+    assert model_backends._load_batch_state() == {}
+
+
+def test_crashed_run_leaves_the_batch_for_the_rerun(openai_stub):
+    openai_stub.status_errors = model_backends.BATCH_POLL_RETRIES  # Outlasts the poll retries
+    backend = get_backend("openai", "gpt-4o")
+    with pytest.raises(BackendError):
+        backend.complete_batch(PROMPTS, poll_interval=0)
+    assert list(model_backends._load_batch_state().values()) == ["batch_1"]
+
+    results = backend.complete_batch(PROMPTS, poll_interval=0)
+    assert openai_stub.created == 1
+    assert results["recA"].text == "cleaned first"
+
+
+def ollama_chunks(*pieces, delay=0.0, stall_after=None, stall=0.0, final=None):
+    """A streamed /api/generate answer: one NDJSON line per piece, then the stats chunk."""
+    import time
+
+    def chunks():
+        for i, piece in enumerate(pieces):
+            if i == stall_after:
+                time.sleep(stall)
+            yield (json.dumps(piece if isinstance(piece, dict) else {"response": piece, "done": False})
+                   + "\n").encode()
+            time.sleep(delay)
+        if final is not None:
+            yield (json.dumps(final) + "\n").encode()
+    return chunks()
+
+
+DONE = {"response": "", "done": True, "prompt_eval_count": 12, "eval_count": 4, "eval_duration": 2_000_000_000}
+
+
+@pytest.fixture
+def ollama(stub_server, monkeypatch, fresh_clients):
+    """Point the Ollama backend at a stub; returns a function that installs the stream to answer with."""
+    answers = []
+    server = stub_server(lambda method, path, body: (200, answers.pop(0)))
+    monkeypatch.setattr(model_backends, "OLLAMA_API_URL", f"{server.url}/api/generate")
+
+    def answer_with(stream):
+        answers.append(stream)
+        return server
+    return answer_with
+
+
+def test_ollama_stream_outlasts_the_timeout_between_tokens(ollama):
+    server = ollama(ollama_chunks("Hel", "lo ", "wor", "ld", delay=0.2, final=DONE))
+    backend = get_backend("ollama", "gemma3", stream=True, timeout=0.5, keep_alive="30m")
+
+    completion = backend.complete("Say hello", use_cache=False)
+
+    assert completion.text == "Hello world"  # Took longer than the timeout in total
+    assert (completion.input_tokens, completion.output_tokens) == (12, 4)
+    assert completion.tokens_per_second == 2
+    request = json.loads(server.requests[0][2])
+    assert request["stream"] is True and request["keep_alive"] == "30m"
+
+
+def test_ollama_numeric_keep_alive_is_sent_as_a_number(ollama):
+    server = ollama(ollama_chunks("ok", final=DONE))
+    get_backend("ollama", "gemma3", stream=True, keep_alive="-1").complete("Hi", use_cache=False)
+    assert json.loads(server.requests[0][2])["keep_alive"] == -1
+
+
+def test_ollama_stall_hits_the_between_token_timeout(ollama):
+    ollama(ollama_chunks("Hel", "lo", stall_after=1, stall=1.5, final=DONE))
+    backend = get_backend("ollama", "gemma3", stream=True, timeout=0.3, max_retries=1)
+
+    with pytest.raises(BackendError, match="stalled") as error:
+        backend.complete("Say hello", use_cache=False)
+    assert error.value.retryable
+
+
+def test_ollama_error_chunk_is_retried(ollama):
+    ollama(ollama_chunks("Hel", {"error": "model runner crashed"}))
+    ollama(ollama_chunks("Hello", final=DONE))
+    backend = get_backend("ollama", "gemma3", stream=True, retry_delay=0)
+
+    assert backend.complete("Say hello", use_cache=False).text == "Hello"
+
+
+def test_ollama_error_chunk_raises_when_retries_run_out(ollama):
+    ollama(ollama_chunks("Hel", {"error": "model runner crashed"}))
+    backend = get_backend("ollama", "gemma3", stream=True, max_retries=1)
+
+    with pytest.raises(BackendError, match="model runner crashed"):
+        backend.complete("Say hello", use_cache=False)
@@ -0,0 +1,75 @@
+from record_packing import (SHORT_TEXT_TOKENS, build_packed_prompt, clean_in_packs, clean_pack, pack_items,
+                            split_packed_response)
+
+TEXTS = ["First explanation with \\( x = 2 \\).", "Second one, \\( y^2 \\).", "Third: \\( 3 + 4 = 7 \\)."]
+
+
+def envelopes(bodies):
+    return "\n".join(f'<record id="{i}">\n{body}\n</record>' for i, body in bodies)
+
+
+def test_round_trip():
+    prompt = build_packed_prompt("Clean these.", TEXTS)
+    for i, text in enumerate(TEXTS, 1):
+        assert f'<record id="{i}">\n{text}\n</record>' in prompt
+    response = envelopes((i, text.upper()) for i, text in enumerate(TEXTS, 1))
+    assert split_packed_response(response, TEXTS) == [text.upper() for text in TEXTS]
+
+
+def test_missing_duplicate_and_truncated_envelopes_do_not_round_trip():
+    missing = envelopes([(1, TEXTS[0]), (3, TEXTS[2])])
+    assert split_packed_response(missing, TEXTS) == [TEXTS[0], None, TEXTS[2]]
+
+    duplicate = envelopes([(1, TEXTS[0]), (2, TEXTS[1]), (2, TEXTS[1]), (3, TEXTS[2])])
+    assert split_packed_response(duplicate, TEXTS) == [TEXTS[0], None, TEXTS[2]]
+
+    cut_short = envelopes([(1, TEXTS[0]), (2, "Sec"), (3, TEXTS[2])])
+    assert split_packed_response(cut_short, TEXTS) == [TEXTS[0], None, TEXTS[2]]
+
+    unclosed = envelopes([(1, TEXTS[0]), (2, TEXTS[1])]) + f'\n<record id="3">\n{TEXTS[2]}'
+    assert split_packed_response(unclosed, TEXTS) == [TEXTS[0], TEXTS[1], None]
+
+    assert split_packed_response("", TEXTS) == [None, None, None]
+    assert split_packed_response(None, TEXTS) == [None, None, None]
+
+
+def test_lost_texts_fall_back_to_single_record_calls():
+    singles, validated = [], []
+
+    def complete(texts, validate):
+        response = envelopes([(1, "clean 1 " + texts[0]), (3, "clean 3 " + texts[2])])
+        validated.append(validate(response))
+        return response
+
+    def clean_one(text):
+        singles.append(text)
+        return f"alone {text}"
+
+    assert clean_pack(TEXTS, complete, clean_one) == [f"clean 1 {TEXTS[0]}", f"alone {TEXTS[1]}",
+                                                  f"clean 3 {TEXTS[2]}"]
+    assert singles == [TEXTS[1]]
+    assert validated == [False]  # Kept out of the LLM cache
+
+
+def test_single_text_is_cleaned_on_its_own():
+    assert clean_pack(["only"], lambda texts, validate: None, lambda text: "alone") == ["alone"]
+
+
+def test_long_texts_are_not_packed():
+    long_text = "x" * (SHORT_TEXT_TOKENS * 8)
+    groups = list(pack_items(["a", "b", long_text, "c"], lambda text: text, token_budget=1000))
+    assert groups == [[long_text], ["a", "b", "c"]]
+
+
+def test_groups_respect_the_budget_and_record_limit():
+    texts = ["y" * 400] * 5  # About 100 tokens each
+    assert [len(group) for group in pack_items(texts, lambda text: text, token_budget=250)] == [2, 2, 1]
+    assert [len(group) for group in pack_items(["z"] * 10, lambda text: text, max_records=4)] == [4, 4, 2]
+
+
+def test_clean_in_packs_stops_when_told():
+    stops = iter([False, True])
+    results = list(clean_in_packs(["a", "b", "c"], lambda text: text,
+                                  lambda texts, validate: envelopes(enumerate(texts, 1)),
+                                  lambda text: text, token_budget=1, stop=lambda: next(stops)))
+    assert results == [("a", "a")]
@@ -0,0 +1,47 @@
+from types import SimpleNamespace
+
+import pytest
+
+from model_backends import Completion, get_backend
+from usage_ledger import UsageLedger, call_cost
+
+# claude-3-5-haiku-20241022 costs $0.80 per million input tokens and $4.00 per million output tokens
+
+
+def test_plain_call_cost():
+    assert call_cost("anthropic", "claude-3-5-haiku-20241022", 1_000_000, 1_000_000) == pytest.approx(4.80)
+    assert call_cost("ollama", "gemma3", 1_000_000, 1_000_000) == 0.0
+    assert call_cost("openai", "unknown-model", 10, 10) is None
+
+
+def test_prefix_cache_reads_and_writes_are_priced_separately():
+    read = call_cost("anthropic", "claude-3-5-haiku-20241022", 1_000_000, 0, cached_input_tokens=1_000_000)
+    written = call_cost("anthropic", "claude-3-5-haiku-20241022", 1_000_000, 0, cache_write_tokens=1_000_000)
+    mixed = call_cost("anthropic", "claude-3-5-haiku-20241022", 1_000_000, 0, cached_input_tokens=500_000,
+                      cache_write_tokens=250_000)
+    assert read == pytest.approx(0.08)
+    assert written == pytest.approx(1.00)
+    assert mixed == pytest.approx(0.80 * (0.25 + 0.5 * 0.1 + 0.25 * 1.25))
+    assert call_cost("anthropic", "claude-3-5-haiku-20241022", 1_000_000, 0, batch=True,
+                     cache_write_tokens=1_000_000) == pytest.approx(0.50)
+
+
+def test_cache_writes_only_cost_extra_at_anthropic():
+    assert call_cost("openai", "gpt-4o", 1_000_000, 0, cache_write_tokens=1_000_000) == pytest.approx(2.50)
+
+
+def test_anthropic_usage_reports_cache_reads_and_writes():
+    message = SimpleNamespace(content=[SimpleNamespace(text="ok")], usage=SimpleNamespace(
+        input_tokens=100, output_tokens=20, cache_read_input_tokens=3000, cache_creation_input_tokens=2000))
+    completion = get_backend("anthropic", "claude-3-5-haiku-20241022")._completion(message)
+    assert (completion.input_tokens, completion.cached_input_tokens, completion.cache_write_tokens) == (5100, 3000, 2000)
+
+
+def test_ledger_bills_cache_writes():
+    ledger = UsageLedger(script="test")
+    ledger.record(Completion("ok", "anthropic", "claude-3-5-haiku-20241022", 1_000_000, 0,
+                             cache_write_tokens=1_000_000))
+    totals = ledger.totals()
+    assert totals["cache_write_tokens"] == 1_000_000
+    assert totals["cost"] == pytest.approx(1.00)
+    assert "1000000 written to it" in ledger.summary()
@@ -0,0 +1,232 @@
+"""Per-run ledger of model token usage and cost, with optional budget caps.
+
+Every call made through ``model_backends`` is recorded here. The ledger keeps
+input, output and reasoning tokens, latency and estimated cost, grouped by
+script, model and table. Scripts call ``configure_ledger`` once to set the
+table they work on and the budget from ``--max-cost``/``--max-tokens`` (see
+``add_budget_arguments``). Before scheduling more model work they check
+``budget_exhausted()``, so a run stops cleanly once the budget is spent. Calls
+already in flight still finish, so a run can overshoot by one call per worker.
+At the end, ``write_usage_report`` saves the breakdown to
+``usage/<script>_<time>.json`` and ``usage_summary`` gives a one-line version.
+
+Costs use the list prices in ``MODEL_PRICES`` (USD per million tokens). Batch
+jobs are billed at half price and cache hits cost nothing. Input tokens the
+provider served from its prompt prefix cache are billed at the provider's
+``CACHED_INPUT_RATE`` share of the input price, and tokens written to that
+cache at the ``CACHE_WRITE_RATE`` multiple (Anthropic). Reasoning tokens
+are reported separately but are already included in the output count the
+providers bill. Models without a price, including local Ollama models, count
+as free.
+"""
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+USAGE_DIR = "usage"
+BATCH_DISCOUNT = 0.5
+
+# (input, output) USD per million tokens
+MODEL_PRICES = {
+    "deepseek-reasoner": (0.55, 2.19),
+    "deepseek-chat": (0.27, 1.10),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-3.5-turbo": (0.50, 1.50),
+    "claude-3-haiku-20240307": (0.25, 1.25),
+    "claude-3-5-haiku-20241022": (0.80, 4.00),
+    "claude-3-5-sonnet-20240620": (3.00, 15.00),
+}
+FREE_PROVIDERS = ("ollama",)
+# Share of the input price charged for tokens read from the provider's prompt prefix cache
+CACHED_INPUT_RATE = {
+    "deepseek": 0.25,
+    "openai": 0.5,
+    "anthropic": 0.1,
+}
+
+# Multiple of the input price charged for tokens written to the prompt prefix cache
+CACHE_WRITE_RATE = {
+    "anthropic": 1.25,
+}
+
+_ledger = None
+_ledger_lock = threading.Lock()
+
+
+def add_budget_arguments(parser):
+    """Add ``--max-cost`` and ``--max-tokens`` to a script's argument parser."""
+    parser.add_argument("--max-cost", type=float,
+                        help="Stop starting new model calls once the run's estimated cost reaches this many USD")
+    parser.add_argument("--max-tokens", type=int,
+                        help="Stop starting new model calls once the run has used this many input + output tokens")
+
+
+def call_cost(provider, model, input_tokens, output_tokens, batch=False, cached_input_tokens=0,
+              cache_write_tokens=0):
+    """Estimated USD cost of one call, or None when the model has no known price.
+
+    ``cached_input_tokens`` and ``cache_write_tokens`` are the parts of
+    ``input_tokens`` read from and written to the prefix cache.
+    """
+    if provider in FREE_PROVIDERS:
+        return 0.0
+    prices = MODEL_PRICES.get(model)
+    if prices is None:
+        return None
+    cached = min(cached_input_tokens or 0, input_tokens)
+    written = min(cache_write_tokens or 0, input_tokens - cached)
+    input_cost = (input_tokens - cached - written + cached * CACHED_INPUT_RATE.get(provider, 1.0)
+                  + written * CACHE_WRITE_RATE.get(provider, 1.0)) * prices[0]
+    cost = (input_cost + output_tokens * prices[1]) / 1e6
+    return cost * BATCH_DISCOUNT if batch else cost
+
+
+class UsageLedger:
+    """Thread-safe usage totals for one run, keyed by (script, model, table)."""
+
+    def __init__(self, script=None, table=None, max_cost=None, max_tokens=None):
+        self.script = script or os.path.splitext(os.path.basename(sys.argv[0]))[0] or "interactive"
+        self.table = table
+        self.max_cost = max_cost
+        self.max_tokens = max_tokens
+        self.started = time.time()
+        self.rows = {}
+        self.exhausted_reason = None
+        self._unpriced = set()
+        self._lock = threading.Lock()
+
+    def record(self, completion, batch=False):
+        """Add one ``Completion`` to the totals; cache hits are counted but cost nothing."""
+        name = f"{completion.provider}:{completion.model}"
+        key = (self.script, name, self.table or "")
+        cost = 0.0
+        if not completion.cached:
+            cost = call_cost(completion.provider, completion.model,
+                             completion.input_tokens, completion.output_tokens, batch,
+                             completion.cached_input_tokens, completion.cache_write_tokens)
+        with self._lock:
+            if cost is None:
+                if name not in self._unpriced:
+                    self._unpriced.add(name)
+                    logging.warning(f"No price for {name} in MODEL_PRICES; its calls are counted as free")
+                cost = 0.0
+            row = self.rows.setdefault(key, {
+                "script": key[0], "model": name, "table": key[2], "calls": 0, "cached_calls": 0,
+                "batch_calls": 0, "input_tokens": 0, "cached_input_tokens": 0, "cache_write_tokens": 0,
+                "output_tokens": 0, "reasoning_tokens": 0, "latency": 0.0, "cost": 0.0,
+            })
+            if completion.cached:
+                row["cached_calls"] += 1
+                return
+            row["calls"] += 1
+            row["batch_calls"] += 1 if batch else 0
+            row["input_tokens"] += completion.input_tokens or 0
+            row["cached_input_tokens"] += completion.cached_input_tokens or 0
+            row["cache_write_tokens"] += completion.cache_write_tokens or 0
+            row["output_tokens"] += completion.output_tokens or 0
+            row["reasoning_tokens"] += completion.reasoning_tokens or 0
+            row["latency"] += completion.latency or 0.0
+            row["cost"] += cost
+
+    def totals(self):
+        with self._lock:
+            rows = list(self.rows.values())
+        return {field: sum(row[field] for row in rows)
+                for field in ("calls", "cached_calls", "batch_calls", "input_tokens", "cached_input_tokens",
+                              "cache_write_tokens", "output_tokens", "reasoning_tokens", "latency", "cost")}
+
+    def exhausted(self):
+        """True once the cost or token budget is used up; logs the first time it happens."""
+        if self.max_cost is None and self.max_tokens is None:
+            return False
+        if self.exhausted_reason:
+            return True
+        totals = self.totals()
+        if self.max_cost is not None and totals["cost"] >= self.max_cost:
+            reason = f"cost ${totals['cost']:.4f} reached --max-cost ${self.max_cost:.4f}"
+        elif self.max_tokens is not None and totals["input_tokens"] + totals["output_tokens"] >= self.max_tokens:
+            reason = (f"{totals['input_tokens'] + totals['output_tokens']} tokens reached "
+                      f"--max-tokens {self.max_tokens}")
+        else:
+            return False
+        with self._lock:
+            if not self.exhausted_reason:
+                self.exhausted_reason = reason
+                logging.warning(f"Budget reached ({reason}); no new model calls will be started")
+        return True
+
+    def summary(self):
+        totals = self.totals()
+        text = (f"Usage: {totals['calls']} model calls ({totals['cached_calls']} more from cache), "
+                f"{totals['input_tokens']} input ({totals['cached_input_tokens']} from prefix cache, "
+                f"{totals['cache_write_tokens']} written to it) / "
+                f"{totals['output_tokens']} output tokens ({totals['reasoning_tokens']} reasoning), "
+                f"{totals['latency']:.0f}s model time, est. ${totals['cost']:.4f}")
+        if self.exhausted_reason:
+            text += f"; stopped early: {self.exhausted_reason}"
+        return text
+
+    def write_report(self, directory=USAGE_DIR):
+        """Write the per-script/model/table breakdown as JSON and return its path."""
+        os.makedirs(directory, exist_ok=True)
+        safe_name = "".join(c if c.isalnum() or c in "-_." else "_" for c in self.script)
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started))
+        path = os.path.join(directory, f"{safe_name}_{stamp}.json")
+        with self._lock:
+            rows = [dict(row) for row in self.rows.values()]
+        report = {
+            "script": self.script,
+            "started": self.started,
+            "finished": time.time(),
+            "max_cost": self.max_cost,
+            "max_tokens": self.max_tokens,
+            "stopped_early": self.exhausted_reason,
+            "totals": self.totals(),
+            "breakdown": rows,
+        }
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        return path
+
+
+def get_ledger():
+    """Return the process-wide ledger, creating one with no budget on first use."""
+    global _ledger
+    with _ledger_lock:
+        if _ledger is None:
+            _ledger = UsageLedger()
+        return _ledger
+
+
+def configure_ledger(table=None, max_cost=None, max_tokens=None, script=None):
+    """Set the table and budget for this run's ledger and return it."""
+    ledger = get_ledger()
+    if script:
+        ledger.script = script
+    ledger.table = table
+    ledger.max_cost = max_cost
+    ledger.max_tokens = max_tokens
+    return ledger
+
+
+def record_usage(completion, batch=False):
+    get_ledger().record(completion, batch)
+
+
+def budget_exhausted():
+    """True once the run's ``--max-cost`` or ``--max-tokens`` budget is spent."""
+    return get_ledger().exhausted()
+
+
+def usage_summary():
+    """One-line usage and cost report for the end of a run."""
+    return get_ledger().summary()
+
+
+def write_usage_report():
+    """Write the run's usage breakdown to ``usage/`` and return the path."""
+    return get_ledger().write_report()